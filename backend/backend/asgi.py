@@ -3,6 +3,10 @@ ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the project through it (e.g. ``uvicorn backend.asgi:application``) so
+the training progress streams at /api/jobs/<id>/events/ run on the event loop
+instead of holding a worker thread each.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -14,3 +18,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+from main.registry import warm_up
+warm_up()
+
+from main.jobs import resume
+resume()
@@ -86,6 +86,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # web and training processes write concurrently, transactions take the write lock up front
+        # and wait for it instead of failing with "database is locked" halfway through
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -131,4 +137,157 @@ STATIC_URL = 'main/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True
+
+
+# Training jobs
+# Models are trained in a separate process pool so TensorFlow never runs inside a web worker.
+
+MODELS_DIR = os.path.join(BASE_DIR, 'models')
+
+TRAINING_POOL_SIZE = int(os.environ.get('TRAINING_POOL_SIZE', 2))
+
+TRAINING_MAX_JOBS_PER_USER = int(os.environ.get('TRAINING_MAX_JOBS_PER_USER', 1))
+
+# A job whose worker died is retried, resuming from its last epoch, until it was picked up this many times
+TRAINING_MAX_ATTEMPTS = int(os.environ.get('TRAINING_MAX_ATTEMPTS', 3))
+
+# Training jobs without a heartbeat for this long are considered stranded by a crashed process
+TRAINING_STALE_SECONDS = int(os.environ.get('TRAINING_STALE_SECONDS', 600))
+
+# How often the worker running a job stamps its heartbeat, well below TRAINING_STALE_SECONDS
+TRAINING_HEARTBEAT_SECONDS = int(os.environ.get('TRAINING_HEARTBEAT_SECONDS', 30))
+
+# TensorFlow threads per training or cross-validation process, 0 shares the cores out between a pool's processes
+TRAINING_WORKER_THREADS = int(os.environ.get('TRAINING_WORKER_THREADS', 0))
+
+# Largest number of processes one job may train on with "workers" in its params, see main/neural_network/parallel.py
+TRAINING_MAX_DATA_PARALLEL_WORKERS = int(os.environ.get('TRAINING_MAX_DATA_PARALLEL_WORKERS', os.cpu_count() or 1))
+
+
+# Training datasets
+# Galleries up to this many images are decoded into memory, larger ones are streamed from the database.
+
+TRAINING_IN_MEMORY_MAX_IMAGES = int(os.environ.get('TRAINING_IN_MEMORY_MAX_IMAGES', 50000))
+
+# Images held in the shuffle buffer of a streamed dataset
+TRAINING_SHUFFLE_BUFFER = int(os.environ.get('TRAINING_SHUFFLE_BUFFER', 10000))
+
+# Batches augmented in parallel, -1 lets tf.data pick
+TRAINING_AUGMENT_PARALLEL_CALLS = int(os.environ.get('TRAINING_AUGMENT_PARALLEL_CALLS', -1))
+
+
+# Training budget
+# Jobs are estimated from their layer config and image count when queued, see main/costs.py.
+# A job over a per-job limit is rejected (a batch size that is too large is lowered first),
+# running jobs together stay within TRAINING_MEMORY_BUDGET.
+
+TRAINING_MAX_PARAMETERS = int(os.environ.get('TRAINING_MAX_PARAMETERS', 20_000_000))
+
+TRAINING_MAX_JOB_BYTES = int(os.environ.get('TRAINING_MAX_JOB_BYTES', 2 * 1024 * 1024 * 1024))
+
+TRAINING_MAX_JOB_SECONDS = int(os.environ.get('TRAINING_MAX_JOB_SECONDS', 3600))
+
+TRAINING_MEMORY_BUDGET = int(os.environ.get('TRAINING_MEMORY_BUDGET', 4 * 1024 * 1024 * 1024))
+
+# Dense layer throughput of one worker, used for the time estimates
+TRAINING_FLOPS_PER_SECOND = float(os.environ.get('TRAINING_FLOPS_PER_SECOND', 4e10))
+
+
+# Hyperparameter sweeps
+# Trials of one sweep may use this many pool slots at once, independent of TRAINING_MAX_JOBS_PER_USER.
+
+SWEEP_MAX_PARALLEL_TRIALS = int(os.environ.get('SWEEP_MAX_PARALLEL_TRIALS', TRAINING_POOL_SIZE))
+
+# Largest number of configurations tried by one sweep
+SWEEP_MAX_TRIALS = int(os.environ.get('SWEEP_MAX_TRIALS', 64))
+
+# Longest option list of a sweep's search space
+SWEEP_MAX_OPTIONS = int(os.environ.get('SWEEP_MAX_OPTIONS', 32))
+
+
+# Cross-validation
+# /api/networks/<id>/cross-validate/ trains the k folds of a network at once on a pool of its own, see main/crossval.py.
+
+CROSSVAL_FOLDS = int(os.environ.get('CROSSVAL_FOLDS', 5))
+
+CROSSVAL_MAX_FOLDS = int(os.environ.get('CROSSVAL_MAX_FOLDS', 10))
+
+# Folds trained at once, one process each
+CROSSVAL_POOL_SIZE = int(os.environ.get('CROSSVAL_POOL_SIZE', min(CROSSVAL_FOLDS, os.cpu_count() or 1)))
+
+
+# Tensor cache
+# Decoded training images are kept per user as memory-mapped blocks, see main/tensor_cache.py.
+
+TENSOR_CACHE_DIR = os.environ.get('TENSOR_CACHE_DIR', os.path.join(BASE_DIR, 'tensor_cache'))
+
+TENSOR_CACHE_MAX_BYTES = int(os.environ.get('TENSOR_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+
+# Bulk ingest
+# /api/ingest/ decodes and encodes images on a thread pool and inserts them in batches, see main/ingest.py.
+
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 4))
+
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+
+# Largest number of images and request (or unpacked archive) size accepted at once
+INGEST_MAX_ITEMS = int(os.environ.get('INGEST_MAX_ITEMS', 20000))
+
+INGEST_MAX_BYTES = int(os.environ.get('INGEST_MAX_BYTES', 64 * 1024 * 1024))
+
+
+# Dataset archives
+# Images per NPZ shard of /api/datasets/export/, one shard is all the memory an export or import needs.
+
+DATASET_SHARD_IMAGES = int(os.environ.get('DATASET_SHARD_IMAGES', 1024))
+
+
+# Model registry
+# Trained models stay loaded between predict requests, the least recently used ones are dropped first.
+
+MODEL_REGISTRY_MAX_ENTRIES = int(os.environ.get('MODEL_REGISTRY_MAX_ENTRIES', 32))
+
+MODEL_REGISTRY_MAX_BYTES = int(os.environ.get('MODEL_REGISTRY_MAX_BYTES', 256 * 1024 * 1024))
+
+# Number of most used models loaded when a web process starts
+MODEL_REGISTRY_WARM = int(os.environ.get('MODEL_REGISTRY_WARM', 8))
+
+
+# Quantized artifacts
+# After training the NumPy model is saved with int8 (or float16) weights instead of float32 ones when that copy
+# keeps the float model's labels, the Keras artifact stays the full precision original.
+# "int8" falls back to float16 when int8 changes too many predictions, "none" keeps only float artifacts.
+
+MODEL_QUANTIZATION = os.environ.get('MODEL_QUANTIZATION', 'int8')
+
+# Share of sample images that must keep the label of the float model
+MODEL_QUANTIZATION_MIN_AGREEMENT = float(os.environ.get('MODEL_QUANTIZATION_MIN_AGREEMENT', 0.99))
+
+
+# Prediction micro-batching
+# Concurrent /api/predict/ calls for the same model share one forward pass.
+
+PREDICT_MAX_BATCH_SIZE = int(os.environ.get('PREDICT_MAX_BATCH_SIZE', 32))
+
+PREDICT_MAX_WAIT_MS = float(os.environ.get('PREDICT_MAX_WAIT_MS', 5))
+
+# Rows per forward pass of /api/predict/batch/ and largest batch_size a client may ask for
+PREDICT_BATCH_SIZE = int(os.environ.get('PREDICT_BATCH_SIZE', 256))
+
+PREDICT_MAX_BATCH_ROWS = int(os.environ.get('PREDICT_MAX_BATCH_ROWS', 4096))
+
+
+# Caches
+# "shared" is visible to every web and training process, it carries live training progress.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('SHARED_CACHE_DIR', os.path.join(BASE_DIR, 'cache')),
+    },
+}
@@ -1,6 +1,8 @@
 from django.contrib import admin
-from .models import NeuralNetwork, Category, Image
+from .models import NeuralNetwork, Category, Image, TrainingJob, Sweep
 
 admin.site.register(NeuralNetwork)
 admin.site.register(Category)
-admin.site.register(Image)
\ No newline at end of file
+admin.site.register(Image)
+admin.site.register(TrainingJob)
+admin.site.register(Sweep)
@@ -0,0 +1,119 @@
+import io
+import json
+import math
+import time
+import tarfile
+
+import numpy as np
+
+from django.conf import settings
+
+from . import grids, ingest
+from .models import Image
+from .tensor_cache import tensor_cache
+
+# Dataset archives: a tar stream that can be written and read one shard at a time.
+#   manifest.json       {"format": 1, "categories": [names], "images": n, "shard_images": k}
+#   shard-00000.npz ... compressed NPZ, every image of a shard has the same size
+#     pixels (uint8, (n, rows, cols, 3)), labels (int32 index into categories), names (str)
+# The shards open with plain NumPy, e.g. for offline training.
+
+FORMAT = 1
+
+def _member(name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    return info.tobuf() + data + b'\0' * (-len(data) % tarfile.BLOCKSIZE)
+
+def _shard(number, pixels, labels, names):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, pixels=np.stack(pixels), labels=np.asarray(labels, dtype='int32'), names=np.asarray(names, dtype=str))
+    return _member(f"shard-{number:05d}.npz", buffer.getvalue())
+
+def _header(shard, key):
+    """(shape, dtype) of an array in an open NPZ, read from its .npy header without decompressing the data"""
+    readers = {(1, 0): np.lib.format.read_array_header_1_0, (2, 0): np.lib.format.read_array_header_2_0}
+    with shard.zip.open(f'{key}.npy') as f:
+        reader = readers.get(np.lib.format.read_magic(f))
+        if reader is None:
+            raise ValueError(f"Unsupported array format in {key}")
+        shape, _, dtype = reader(f)
+    return shape, dtype
+
+def export_stream(categories):
+    """Yields the tar archive of the categories piece by piece, memory stays at about one shard per grid size"""
+    categories = list(categories)
+    labels_of = {category.id: label for label, category in enumerate(categories)}
+    images = Image.objects.filter(category__in=categories)
+
+    manifest = {'format': FORMAT, 'categories': [category.name for category in categories],
+                'images': images.count(), 'shard_images': settings.DATASET_SHARD_IMAGES}
+    yield _member('manifest.json', json.dumps(manifest).encode())
+
+    pending = {}  # (rows, cols) -> (pixels, labels, names) of the shard being filled
+    number = 0
+    for category_id, name, data in images.order_by('category_id', 'id').values_list('category_id', 'name', 'data').iterator(chunk_size=settings.INGEST_BATCH_SIZE):
+        pixels = grids.decode_binary(bytes(data))
+        shard = pending.setdefault(pixels.shape[:2], ([], [], []))
+        for column, value in zip(shard, (pixels, labels_of[category_id], name)):
+            column.append(value)
+        if len(shard[0]) == settings.DATASET_SHARD_IMAGES:
+            yield _shard(number, *pending.pop(pixels.shape[:2]))
+            number += 1
+
+    for shard in pending.values():
+        yield _shard(number, *shard)
+        number += 1
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+def import_stream(user, file):
+    """Reads an archive from a non-seekable stream shard by shard
+    Images are added to (or replace same-named images in) the user's categories of the same names,
+    and their features go straight into the user's tensor cache.
+    Members over INGEST_MAX_BYTES, or shards that would unpack to more than that or hold more than INGEST_MAX_ITEMS
+    images, are refused before they are decompressed.
+    Returns (dict): created, updated, cached (rows added to the tensor cache), version
+    """
+    manifest = None
+    created = updated = cached = 0
+    version = None
+
+    with tarfile.open(fileobj=file, mode='r|') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            if member.size > settings.INGEST_MAX_BYTES:
+                raise ValueError(f"{member.name} is larger than {settings.INGEST_MAX_BYTES} bytes")
+            content = archive.extractfile(member).read()
+            if member.name == 'manifest.json':
+                manifest = json.loads(content)
+                if manifest.get('format') != FORMAT:
+                    raise ValueError(f"Unsupported archive format: {manifest.get('format')}")
+                continue
+            if manifest is None:
+                raise ValueError('Archive must start with manifest.json')
+
+            with np.load(io.BytesIO(content)) as shard:
+                headers = {key: _header(shard, key) for key in ('pixels', 'labels', 'names')}
+                shape = headers['pixels'][0]
+                if len(shape) != 4 or not 0 < min(shape[1:3]) <= max(shape[1:3]) <= 0xFFFF or shape[0] > settings.INGEST_MAX_ITEMS:
+                    raise ValueError(f"Malformed shard {member.name}")
+                if sum(math.prod(shape) * dtype.itemsize for shape, dtype in headers.values()) > settings.INGEST_MAX_BYTES:
+                    raise ValueError(f"{member.name} unpacks to more than {settings.INGEST_MAX_BYTES} bytes")
+                pixels, labels, names = shard['pixels'], shard['labels'], shard['names']
+            if (pixels.dtype != np.uint8 or pixels.ndim != 4 or pixels.shape[-1] != 3 or not len(pixels) == len(labels) == len(names)
+                    or (len(labels) and not 0 <= labels.min() <= labels.max() < len(manifest['categories']))):
+                raise ValueError(f"Malformed shard {member.name}")
+
+            blobs = [grids.encode_binary(image) for image in pixels]
+            for label in np.unique(labels):
+                selected = np.flatnonzero(labels == label)
+                added, replaced, version = ingest.save_blobs(user, manifest['categories'][label], {str(names[i]): blobs[i] for i in selected})
+                created, updated = created + added, updated + replaced
+            cached += tensor_cache.put(user.id, blobs, grids.to_features(pixels))
+
+    if manifest is None:
+        raise ValueError('Archive must start with manifest.json')
+    return {'created': created, 'updated': updated, 'cached': cached, 'version': version}
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+import numpy as np
+
+from django.conf import settings
+
+class _Queue:
+    def __init__(self, loop):
+        self.loop = loop
+        self.items = []
+        self.timer = None
+
+class MicroBatcher:
+    """Groups concurrent predictions for the same model into one forward pass
+    - Callers await a future, the first row of a batch schedules a flush on the event loop after max_wait_ms,
+      a batch that reaches max_batch_size rows is flushed right away
+    - The forward pass runs in a thread, the event loop keeps queueing rows for the next batch meanwhile
+    - Rows only share a batch with rows of the same shape, a malformed row cannot fail the other callers
+    - Meant for async views served by the ASGI application, there all requests share one event loop
+    """
+    def __init__(self, max_batch_size, max_wait_ms):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queues = {}
+        # the event loop only keeps weak references to tasks
+        self.running = set()
+        # only guards stats(), which may be called from another thread
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.batches = 0
+        self.batched_rows = 0
+
+    async def predict(self, key, predict_fn, row):
+        """Returns predict_fn(batch)[i] for the caller's row, predict_fn takes and returns 2D arrays"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            queue = self.queues.get((key, np.shape(row)))
+            if queue is None or queue.loop is not loop:
+                # a queue of another event loop (a WSGI request, a test) keeps its own pending flush
+                queue = self.queues[(key, np.shape(row))] = _Queue(loop)
+            queue.items.append((row, future))
+            self.requests += 1
+
+        if len(queue.items) >= self.max_batch_size:
+            self._flush(queue, predict_fn)
+        elif queue.timer is None:
+            queue.timer = loop.call_later(self.max_wait, self._flush, queue, predict_fn)
+        return await future
+
+    def _flush(self, queue, predict_fn):
+        if queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+        with self.lock:
+            batch = queue.items[:self.max_batch_size]
+            del queue.items[:self.max_batch_size]
+            if batch:
+                self.batches += 1
+                self.batched_rows += len(batch)
+        if queue.items:
+            queue.timer = queue.loop.call_later(self.max_wait, self._flush, queue, predict_fn)
+        if batch:
+            task = queue.loop.create_task(self._run(batch, predict_fn))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch, predict_fn):
+        try:
+            output = await asyncio.to_thread(predict_fn, np.stack([row for row, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), row in zip(batch, output):
+            # a caller that disconnected has a cancelled future
+            if not future.done():
+                future.set_result(row)
+
+    def stats(self):
+        with self.lock:
+            queue_depth = sum(len(queue.items) for queue in self.queues.values())
+            avg_batch_size = self.batched_rows / self.batches if self.batches else 0.0
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000,
+                'queue_depth': queue_depth,
+                'requests': self.requests,
+                'batches': self.batches,
+                'avg_batch_size': avg_batch_size,
+                'batch_fill': avg_batch_size / self.max_batch_size
+            }
+
+batcher = MicroBatcher(settings.PREDICT_MAX_BATCH_SIZE, settings.PREDICT_MAX_WAIT_MS)
@@ -0,0 +1,150 @@
+import os
+import math
+import struct
+
+from django.conf import settings
+from django.db.models.functions import Substr
+
+from . import grids
+from .models import Image
+
+# What a training job will cost, worked out from the layer config and the gallery before anything runs.
+# Kept free of TensorFlow so web processes can check a job when it is submitted.
+# The network is the chain of Dense layers extract_nn_params builds: every layer is fully connected
+# to the previous one, the first one to the rows * cols input values.
+
+VALIDATION_SPLIT = 0.2
+
+MIN_BATCH_SIZE = 4
+MAX_BATCH_SIZE = 256
+STEPS_PER_EPOCH = 32
+
+BYTES_PER_VALUE = 4  # float32
+OPTIMIZER_SLOTS = 2  # Adam keeps two moments per weight
+RUNTIME_BYTES = 256 * 1024 * 1024  # TensorFlow itself in a worker process
+STEP_SECONDS = 0.006  # fixed cost of one optimizer step, dominates for small layers
+
+class OverBudget(ValueError):
+    """The job does not fit the training budget at any batch size, estimate says by how much"""
+    def __init__(self, message, estimate):
+        super().__init__(message)
+        self.estimate = estimate
+
+def count_images(categories):
+    return Image.objects.filter(category__in=categories).count()
+
+def grid_shape(categories):
+    """(rows, cols) of the images, read from the rows and cols of the stored grid headers
+    Raises ValueError when the images do not all have the same size, one network takes one input size.
+    """
+    # header bytes 5 to 8 are rows and cols, the database compares them without sending the grids
+    shapes = (Image.objects.filter(category__in=categories)
+              .annotate(shape=Substr('data', 5, 4))
+              .values_list('shape', flat=True).distinct()[:3])
+    shapes = sorted(struct.unpack('>HH', bytes(shape)) for shape in shapes)
+    if not shapes:
+        return 0, 0
+    if len(shapes) > 1:
+        sizes = ', '.join(f"{rows}x{cols}" for rows, cols in shapes)
+        raise ValueError(f"Selected images have different grid sizes ({sizes}), a network is trained on one size")
+    return shapes[0]
+
+def feature_size(categories):
+    """Number of input values per image"""
+    rows, cols = grid_shape(categories)
+    return rows * cols
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 1 << 30  # no sysconf (Windows), assume 1 GB
+
+def auto_batch_size(count, values_per_sample):
+    """Power of two giving about STEPS_PER_EPOCH steps per epoch, between MIN_BATCH_SIZE and MAX_BATCH_SIZE
+    Halved while one batch of activations and gradients would need more than a tenth of the free memory
+    """
+    target = min(count * (1 - VALIDATION_SPLIT) / STEPS_PER_EPOCH, MAX_BATCH_SIZE)
+    batch_size = MIN_BATCH_SIZE
+    while batch_size * 2 <= target:
+        batch_size *= 2
+
+    bytes_per_sample = values_per_sample * BYTES_PER_VALUE * 3
+    while batch_size > 1 and batch_size * bytes_per_sample > available_memory() // 10:
+        batch_size //= 2
+    return batch_size
+
+def layer_widths(params):
+    return [int(layer.get('neurons')) for layer in params.get('layers', [])]
+
+def estimate(params, count, feature_size, batch_size, epochs, workers=1):
+    """Cost of training the network in params for epochs on count images of feature_size values
+    Returns (dict):
+    - parameters (int): trainable weights and biases
+    - flops_per_sample (int): multiply-adds * 2 of one forward pass
+    - activation_bytes (int): activations and their gradients for one batch
+    - peak_memory_bytes (int): weights with gradients and optimizer state, one batch, the training arrays and the runtime
+    - epoch_seconds, total_seconds (float): expected at TRAINING_FLOPS_PER_SECOND, an upper bound when early stopping is on
+    With workers > 1 (data-parallel training, see neural_network/parallel.py) every worker process runs its share
+    of the steps with its own runtime, model and optimizer, and a coordinator process holds one more model.
+    """
+    widths = layer_widths(params)
+    connections = list(zip([feature_size, *widths], widths))
+
+    parameters = sum(inputs * outputs + outputs for inputs, outputs in connections)
+    flops_per_sample = sum(2 * inputs * outputs for inputs, outputs in connections)
+
+    train_count = max(int(count * (1 - VALIDATION_SPLIT)), 1) if count else 0
+    steps = math.ceil(train_count / workers / batch_size) if batch_size else 0
+    # the backward pass costs about twice the forward pass, validation is forward only
+    epoch_flops = 3 * flops_per_sample * train_count / workers + flops_per_sample * (count - train_count)
+    epoch_seconds = epoch_flops / settings.TRAINING_FLOPS_PER_SECOND + steps * STEP_SECONDS
+
+    weight_bytes = parameters * BYTES_PER_VALUE * (2 + OPTIMIZER_SLOTS)
+    activation_bytes = batch_size * (feature_size + sum(widths)) * BYTES_PER_VALUE * 2
+
+    row_bytes = (feature_size + (widths[-1] if widths else 0)) * BYTES_PER_VALUE
+    if count <= settings.TRAINING_IN_MEMORY_MAX_IMAGES:
+        # the decoded arrays, their tensor copy and the shuffle buffer
+        dataset_bytes = count * row_bytes * 3
+    else:
+        dataset_bytes = min(settings.TRAINING_SHUFFLE_BUFFER, count) * row_bytes
+
+    processes = workers + 1 if workers > 1 else 1
+    return {
+        'images': count,
+        'batch_size': batch_size,
+        'epochs': epochs,
+        'workers': workers,
+        'parameters': parameters,
+        'flops_per_sample': flops_per_sample,
+        'activation_bytes': activation_bytes,
+        'peak_memory_bytes': processes * (RUNTIME_BYTES + weight_bytes) + workers * activation_bytes + dataset_bytes,
+        'epoch_seconds': round(epoch_seconds, 3),
+        'total_seconds': round(epoch_seconds * epochs, 3),
+    }
+
+def admit(params, count, feature_size, batch_size, epochs, workers=1):
+    """Estimate for the job, with the batch size halved until the job fits TRAINING_MAX_JOB_BYTES
+    The estimate has requested_batch_size when the batch size was lowered.
+    Raises OverBudget when the network is over TRAINING_MAX_PARAMETERS, over the memory limit even
+    with a batch of one, or expected to take longer than TRAINING_MAX_JOB_SECONDS.
+    """
+    report = estimate(params, count, feature_size, batch_size, epochs, workers)
+    if report['parameters'] > settings.TRAINING_MAX_PARAMETERS:
+        raise OverBudget(f"Network has {report['parameters']:,} parameters, the limit is {settings.TRAINING_MAX_PARAMETERS:,}", report)
+
+    smaller = batch_size
+    while report['peak_memory_bytes'] > settings.TRAINING_MAX_JOB_BYTES and smaller > 1:
+        smaller //= 2
+        report = estimate(params, count, feature_size, smaller, epochs, workers)
+    if report['peak_memory_bytes'] > settings.TRAINING_MAX_JOB_BYTES:
+        raise OverBudget(f"Training needs about {report['peak_memory_bytes'] >> 20} MB, "
+                         f"the limit is {settings.TRAINING_MAX_JOB_BYTES >> 20} MB", report)
+    if smaller != batch_size:
+        report['requested_batch_size'] = batch_size
+
+    if report['total_seconds'] > settings.TRAINING_MAX_JOB_SECONDS:
+        raise OverBudget(f"Training would take about {report['total_seconds']:.0f}s, "
+                         f"the limit is {settings.TRAINING_MAX_JOB_SECONDS}s", report)
+    return report
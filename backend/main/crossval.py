@@ -0,0 +1,182 @@
+import json
+import math
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import numpy as np
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from . import costs, jobs, workers
+from .models import NeuralNetwork
+
+# k-fold cross-validation of a network's config, a less noisy score than one validation split on small categories.
+# Fold i trains a fresh model on the other k - 1 folds and is scored on its own images, see dataset.fold_of.
+# The folds run at once on a pool of spawned processes with TensorFlow capped at cpu_count // CROSSVAL_POOL_SIZE
+# threads each, so k folds on k cores take about as long as one training run. The trained network is not touched.
+# Results are kept in NeuralNetwork.evaluation:
+#   {"run", "status": "Running" | "Finished" | "Failed", "k", "labels", "started_at", "finished_at", "estimate",
+#    "folds": [{"fold", "train_images", "test_images", "epochs", "loss", "accuracy", "confusion", "seconds"} or {"fold", "error"}],
+#    "aggregate": {"folds", "accuracy", "accuracy_std", "loss", "loss_std", "confusion", "recall", "precision"}}
+# confusion[i][j] counts holdout images of label i predicted as label j.
+
+_executor = None
+_lock = threading.Lock()
+
+class AlreadyRunning(ValueError):
+    pass
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.CROSSVAL_POOL_SIZE,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=workers.init,
+                initargs=(workers.threads_per_process(settings.CROSSVAL_POOL_SIZE),)
+            )
+    return _executor
+
+def running(nn: NeuralNetwork):
+    """Whether a run of the network is still going, a run older than its folds may take was lost with its web process"""
+    evaluation = nn.evaluation or {}
+    if evaluation.get('status') != 'Running':
+        return False
+    rounds = math.ceil(evaluation['k'] / settings.CROSSVAL_POOL_SIZE)
+    return time.time() - evaluation['started_at'] < rounds * settings.TRAINING_MAX_JOB_SECONDS
+
+def start(nn: NeuralNetwork, k=None):
+    """Starts k-fold cross-validation of the network (CROSSVAL_FOLDS by default), the folds train in the background
+    Raises ValueError for a bad k or too few images, costs.OverBudget when one fold does not fit the training budget,
+    AlreadyRunning when a run of the network is still going.
+    Returns (dict): the new evaluation
+    """
+    k = int(k or settings.CROSSVAL_FOLDS)
+    if not 2 <= k <= settings.CROSSVAL_MAX_FOLDS:
+        raise ValueError(f"k must be between 2 and {settings.CROSSVAL_MAX_FOLDS}")
+
+    categories = list(nn.categories.order_by('id'))
+    count, size = costs.count_images(categories), costs.feature_size(categories)
+    if count < k:
+        raise ValueError(f"{k} folds need at least {k} images, found {count}")
+    if count > settings.TRAINING_IN_MEMORY_MAX_IMAGES:
+        raise ValueError(f"Cross-validation holds the images in memory, at most {settings.TRAINING_IN_MEMORY_MAX_IMAGES}")
+
+    # every fold is a training run on (k - 1) / k of the images
+    options = jobs.extract_training_options(nn, count, size)
+    params = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
+    report = costs.admit(params, count, size, options['batch_size'], options['epochs'])
+
+    evaluation = {
+        'run': uuid.uuid4().hex,
+        'status': 'Running',
+        'k': k,
+        'labels': [category.name for category in categories],
+        'started_at': time.time(),
+        'finished_at': None,
+        'estimate': report,
+        'folds': [None] * k,
+    }
+    # two requests must not both see no run and start one, the folds go out once the new run is committed
+    with transaction.atomic():
+        if running(NeuralNetwork.objects.select_for_update().get(id=nn.id)):
+            raise AlreadyRunning('Network is already being cross-validated')
+        NeuralNetwork.objects.filter(id=nn.id).update(evaluation=evaluation)
+    nn.evaluation = evaluation
+
+    executor = get_executor()
+    for fold in range(k):
+        future = executor.submit(run_fold, nn.id, k, fold, report['batch_size'], options['epochs'])
+        future.add_done_callback(partial(_on_fold_done, nn.id, evaluation['run'], fold, executor))
+    return evaluation
+
+def run_fold(network_id, k, fold, batch_size, epochs):
+    """Entry point executed inside a pool process, trains and scores one fold"""
+    from .neural_network import dataset
+
+    began = time.time()
+    nn = NeuralNetwork.objects.get(id=network_id)
+    categories = list(nn.categories.order_by('id'))
+    train, (x_test, y_test), count = dataset.folds(categories, k, fold, batch_size, augment=jobs.extract_augment_params(nn))
+    if not len(y_test) or not count:
+        # images were deleted since the run started
+        raise ValueError(f"Fold {fold} has no {'holdout' if count else 'training'} images")
+
+    options = jobs.extract_training_options(nn, count, x_test.shape[1])
+    user_model, lr = jobs.extract_nn_params(nn)
+    history = user_model.train(train, learning_rate=lr, epochs=epochs, batch_size=batch_size,
+                               early_stopping=options['early_stopping'], reduce_lr=options['reduce_lr'])
+
+    loss = float(user_model.model.evaluate(x_test, y_test, batch_size=batch_size, verbose=0)[0])
+    predicted = user_model.model.predict(x_test, batch_size=batch_size, verbose=0).argmax(axis=1)
+    confusion = np.zeros((len(categories), len(categories)), dtype='int64')
+    np.add.at(confusion, (y_test.argmax(axis=1), predicted), 1)
+
+    return {
+        'fold': fold,
+        'train_images': count,
+        'test_images': len(y_test),
+        'epochs': len(history.epoch),
+        'loss': loss,
+        'accuracy': float(np.trace(confusion) / max(len(y_test), 1)),
+        'confusion': confusion.tolist(),
+        'seconds': round(time.time() - began, 3),
+    }
+
+def _on_fold_done(network_id, run, fold, executor, future):
+    global _executor
+
+    close_old_connections()
+    error = future.exception()
+    if isinstance(error, BrokenProcessPool):
+        with _lock:
+            if _executor is executor:
+                # a worker was killed, the pool refuses new work and is replaced on the next run
+                _executor = None
+    result = {'fold': fold, 'error': str(error) or type(error).__name__} if error is not None else future.result()
+
+    with transaction.atomic():
+        nn = NeuralNetwork.objects.select_for_update().filter(id=network_id).first()
+        # a newer run replaced this one, or the network is gone
+        if nn is None or (nn.evaluation or {}).get('run') != run:
+            return
+        evaluation = nn.evaluation
+        evaluation['folds'][fold] = result
+        if all(evaluation['folds']):
+            evaluation['aggregate'] = aggregate(evaluation['folds'])
+            failed = any('error' in result for result in evaluation['folds'])
+            evaluation['status'] = 'Failed' if failed else 'Finished'
+            evaluation['finished_at'] = time.time()
+        nn.save(update_fields=['evaluation'])
+
+def aggregate(folds):
+    """Mean and standard deviation of the fold scores and the summed confusion matrix, over the folds that finished
+    recall[i] is the share of label i images given label i, precision[i] the share of label i predictions that were right.
+    """
+    scored = [result for result in folds if 'error' not in result]
+    if not scored:
+        return None
+
+    accuracy = np.array([result['accuracy'] for result in scored])
+    loss = np.array([result['loss'] for result in scored])
+    confusion = np.sum([result['confusion'] for result in scored], axis=0)
+    hits = np.diag(confusion)
+    share = lambda totals: [float(hit / total) if total else None for hit, total in zip(hits, totals)]
+
+    return {
+        'folds': len(scored),
+        'accuracy': float(accuracy.mean()),
+        'accuracy_std': float(accuracy.std()),
+        'loss': float(loss.mean()),
+        'loss_std': float(loss.std()),
+        'confusion': confusion.tolist(),
+        'recall': share(confusion.sum(axis=1)),
+        'precision': share(confusion.sum(axis=0)),
+    }
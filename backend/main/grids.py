@@ -0,0 +1,132 @@
+import json
+import base64
+import struct
+from itertools import chain
+
+import numpy as np
+
+# Conversions between the browser's hex color grids ([["#rrggbb", ...], ...]) and NumPy arrays.
+
+LUMA = np.array([0.299, 0.587, 0.114], dtype='float32')
+
+def _hex_to_rgb(cells, count):
+    joined = ''.join(cells)
+    if len(joined) != count * 7 or joined.count('#') != count or joined[::7].count('#') != count:
+        raise ValueError('Grid cells must be "#rrggbb" hex colors')
+    return np.frombuffer(bytes.fromhex(joined.replace('#', '')), dtype=np.uint8)
+
+def decode_grid(grid):
+    """Decodes one grid into a uint8 array of shape (rows, cols, 3) in a single pass"""
+    if not grid or not grid[0]:
+        raise ValueError('Grid must have at least one row and column')
+    rows, cols = len(grid), len(grid[0])
+    if any(len(row) != cols for row in grid):
+        raise ValueError('Grid rows must have the same length')
+
+    return _hex_to_rgb(chain.from_iterable(grid), rows * cols).reshape(rows, cols, 3)
+
+def thumbnail(pixels, size=8):
+    """Downscales uint8 RGB pixels (rows, cols, 3) to at most size x size by averaging blocks"""
+    rows, cols = pixels.shape[:2]
+    step_y, step_x = -(-rows // size), -(-cols // size)
+    padded = np.pad(pixels, ((0, -rows % step_y), (0, -cols % step_x), (0, 0)), mode='edge')
+    blocks = padded.reshape(padded.shape[0] // step_y, step_y, padded.shape[1] // step_x, step_x, 3)
+    return blocks.mean(axis=(1, 3)).round().astype(np.uint8)
+
+def to_features(pixels):
+    """Turns uint8 RGB pixels (..., rows, cols, 3) into flat ink intensities (..., rows * cols)
+    White is 0 and black is 1, one value per input neuron
+    """
+    ink = 1.0 - (pixels.astype('float32') @ LUMA) / 255.0
+    return ink.reshape(*pixels.shape[:-3], -1)
+
+# Compact grid format, version 1 (all integers big-endian):
+#   b"NG" | version u8 | mode u8 | rows u16 | cols u16 | body
+#   mode 0 (rgb):     rows * cols * 3 bytes
+#   mode 1 (palette): colors - 1 u8 | colors * 3 bytes | pixel indices packed at 1, 2, 4 or 8 bits, MSB first
+# Image.data stores it as is, JSON carries it base64 encoded as {"name": ..., "data": ...}.
+
+MAGIC = b'NG'
+VERSION = 1
+MODE_RGB = 0
+MODE_PALETTE = 1
+HEADER = struct.Struct('>2sBBHH')
+
+def index_bits(colors):
+    for bits in (1, 2, 4):
+        if colors <= 1 << bits:
+            return bits
+    return 8
+
+def encode_binary(pixels):
+    """Encodes uint8 RGB pixels (rows, cols, 3), palette mode is used when there are at most 256 colors"""
+    rows, cols = pixels.shape[:2]
+    flat = pixels.reshape(-1, 3)
+    # one uint32 per pixel sorts like the rows do and is much faster to unique than axis=0
+    keys = (flat[:, 0].astype(np.uint32) << 16) | (flat[:, 1].astype(np.uint32) << 8) | flat[:, 2]
+    keys, indices = np.unique(keys, return_inverse=True)
+    palette = np.stack([keys >> 16, (keys >> 8) & 0xFF, keys & 0xFF], axis=1)
+
+    if len(palette) > 256:
+        return HEADER.pack(MAGIC, VERSION, MODE_RGB, rows, cols) + flat.tobytes()
+
+    bits = index_bits(len(palette))
+    indices = indices.reshape(-1, 1).astype(np.uint8)
+    packed = np.packbits(np.unpackbits(indices, axis=1)[:, 8 - bits:])
+    return (HEADER.pack(MAGIC, VERSION, MODE_PALETTE, rows, cols)
+            + bytes([len(palette) - 1]) + palette.astype(np.uint8).tobytes() + packed.tobytes())
+
+def decode_binary(data):
+    """Decodes the compact format back into uint8 RGB pixels (rows, cols, 3)"""
+    if len(data) < HEADER.size:
+        raise ValueError('Truncated grid data')
+    magic, version, mode, rows, cols = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unknown grid format')
+
+    body = np.frombuffer(data, dtype=np.uint8, offset=HEADER.size)
+    count = rows * cols
+
+    if mode == MODE_RGB:
+        if len(body) != count * 3:
+            raise ValueError('Truncated grid data')
+        return body.reshape(rows, cols, 3)
+
+    if mode == MODE_PALETTE:
+        colors = int(body[0]) + 1 if len(body) else 0
+        bits = index_bits(colors)
+        if not colors or len(body) != 1 + colors * 3 + (count * bits + 7) // 8:
+            raise ValueError('Truncated grid data')
+        palette = body[1:1 + colors * 3].reshape(-1, 3)
+        packed = body[1 + colors * 3:]
+
+        bit_rows = np.unpackbits(packed)[:count * bits].reshape(count, bits)
+        indices = np.packbits(np.pad(bit_rows, ((0, 0), (8 - bits, 0))), axis=1).reshape(-1)
+        if indices.max(initial=0) >= colors:
+            raise ValueError('Grid pixel refers to a missing palette color')
+        return palette[indices].reshape(rows, cols, 3)
+
+    raise ValueError('Unknown grid mode')
+
+def encode_payload(pixels):
+    return base64.b64encode(encode_binary(pixels)).decode('ascii')
+
+def decode_payload(value):
+    """Accepts every form a grid can arrive in and returns uint8 RGB pixels (rows, cols, 3)
+    - bytes: the compact format
+    - str: base64 of the compact format, or a JSON hex list (the old wire format)
+    - list: a hex list
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return decode_binary(bytes(value))
+    if isinstance(value, str):
+        if value.lstrip().startswith('['):
+            return decode_grid(json.loads(value))
+        return decode_binary(base64.b64decode(value, validate=True))
+    if isinstance(value, list):
+        return decode_grid(value)
+    raise ValueError('Unsupported grid data')
+
+def decode_image(image):
+    """Pixels of a client image entry, {"name", "data"} or the older {"name", "grid"}"""
+    return decode_payload(image['data'] if 'data' in image else image['grid'])
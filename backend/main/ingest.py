@@ -0,0 +1,147 @@
+import io
+import os
+import hashlib
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+
+from PIL import Image as PILImage
+
+from . import grids, versions
+from .models import Category, Image
+
+# Bulk ingest of many images into one category.
+# Decoding, compact encoding and PNG encoding run on a thread pool (NumPy and zlib release the GIL),
+# the rows go in with bulk statements in one transaction, then the PNG copies are written.
+# PNGs live under MEDIA_ROOT/<user id>/<h[:2]>/<h[2:4]>/<h>.png with h the hash of category and image name,
+# so no directory gets huge and no image name ends up in a path.
+
+_executor = None
+_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.INGEST_WORKERS, thread_name_prefix='ingest')
+    return _executor
+
+def upload_path(user_id, category_name, image_name):
+    digest = hashlib.sha1(f"{category_name}/{image_name}".encode()).hexdigest()
+    return os.path.join(settings.MEDIA_ROOT, str(user_id), digest[:2], digest[2:4], f"{digest}.png")
+
+def png_bytes(pixels):
+    buffer = io.BytesIO()
+    PILImage.fromarray(np.ascontiguousarray(pixels), 'RGB').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def read_archive(file):
+    """An {"name", "data"} item per file in a zip archive, the name is the file name without its extension
+    Entries may be compact grids (any extension) or PNG images
+    """
+    with zipfile.ZipFile(file) as archive:
+        if sum(info.file_size for info in archive.infolist()) > settings.INGEST_MAX_BYTES:
+            raise ValueError(f'Archive unpacks to more than {settings.INGEST_MAX_BYTES} bytes')
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            name = os.path.splitext(os.path.basename(info.filename))[0]
+            yield {'name': name, 'data': archive.read(info)}
+
+CHUNK_SIZE = 64  # items per pool task, one future per image costs more than encoding a small grid
+
+def _prepare_chunk(items):
+    """Runs on the pool: (compact grid, PNG) or the exception per item"""
+    results = []
+    for item in items:
+        try:
+            results.append(_prepare(item))
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            results.append(e)
+    return results
+
+def _prepare(item):
+    """(compact grid, PNG) for one item, a ValueError for bad data"""
+    data = item.get('data', item.get('grid'))
+    if isinstance(data, (bytes, bytearray)) and bytes(data[:8]) == b'\x89PNG\r\n\x1a\n':
+        try:
+            pixels = np.asarray(PILImage.open(io.BytesIO(data)).convert('RGB'))
+        except OSError as e:
+            raise ValueError(f'Invalid PNG: {e}')
+    else:
+        pixels = grids.decode_payload(data)
+    return grids.encode_binary(pixels), png_bytes(pixels)
+
+def _write_chunk(files):
+    for path, content in files:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+def _chunks(values):
+    return [values[start:start + CHUNK_SIZE] for start in range(0, len(values), CHUNK_SIZE)]
+
+def ingest(user, category_name, items):
+    """Adds or replaces the images in items ({"name", "data"} like save_image) in one category
+    Returns (dict): created, updated, errors (one {"index", "name", "error"} per rejected item), version
+    """
+    errors = []
+    accepted = {}  # name -> index, a repeated name keeps its first occurrence
+    for index, item in enumerate(items):
+        name = item.get('name') if isinstance(item, dict) else None
+        if not name or not isinstance(name, str):
+            errors.append({'index': index, 'name': name, 'error': 'Missing image name'})
+        elif name in accepted:
+            errors.append({'index': index, 'name': name, 'error': 'Duplicate image name in batch'})
+        elif item.get('data', item.get('grid')) is None:
+            errors.append({'index': index, 'name': name, 'error': 'Missing image data'})
+        else:
+            accepted[name] = index
+
+    names = list(accepted)
+    results = get_executor().map(_prepare_chunk, _chunks([items[accepted[name]] for name in names]))
+    prepared = {}
+    for name, result in zip(names, (result for chunk in results for result in chunk)):
+        if isinstance(result, Exception):
+            errors.append({'index': accepted[name], 'name': name, 'error': str(result) or type(result).__name__})
+        else:
+            prepared[name] = result
+
+    created = updated = 0
+    version = None
+    if prepared:
+        created, updated, version = save_blobs(user, category_name, {name: blob for name, (blob, _) in prepared.items()})
+        # the rows are the source of truth, the PNG copies follow once they are committed
+        files = [(upload_path(user.id, category_name, name), png) for name, (_, png) in prepared.items()]
+        list(get_executor().map(_write_chunk, _chunks(files)))
+
+    errors.sort(key=lambda error: error['index'])
+    return {'created': created, 'updated': updated, 'errors': errors, 'version': version}
+
+def save_blobs(user, category_name, blobs):
+    """Adds or replaces {image name: compact grid} in the category with bulk statements in one transaction
+    Returns (tuple): created, updated, new gallery version
+    """
+    with transaction.atomic():
+        versions.lock(user.id)
+        category, _ = Category.objects.get_or_create(name=category_name, user=user)
+
+        names = list(blobs)
+        existing = [row for start in range(0, len(names), settings.INGEST_BATCH_SIZE)
+                    for row in category.images.filter(name__in=names[start:start + settings.INGEST_BATCH_SIZE]).only('id', 'name')]
+        for row in existing:
+            row.data = blobs[row.name]
+        Image.objects.bulk_update(existing, ['data'], batch_size=settings.INGEST_BATCH_SIZE)
+
+        known = {row.name for row in existing}
+        Image.objects.bulk_create([
+            Image(category=category, name=name, data=blob) for name, blob in blobs.items() if name not in known
+        ], batch_size=settings.INGEST_BATCH_SIZE)
+
+        return len(blobs) - len(known), len(known), versions.bump(user.id)
@@ -0,0 +1,450 @@
+import os
+import json
+import shutil
+import time
+import hashlib
+import threading
+import multiprocessing
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+
+from . import costs, progress, workers
+from .models import Image, NeuralNetwork, TrainingJob
+from .registry import registry
+from .tensor_cache import content_hash
+
+NUMPY_TOLERANCE = 1e-4
+TRAINING_EPOCHS = 10
+FINE_TUNE_EPOCHS = 3
+
+_executor = None
+_futures = {}  # job id -> future, jobs running in this process's pool
+_lock = threading.RLock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.TRAINING_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=workers.init,
+            initargs=(workers.threads_per_process(settings.TRAINING_POOL_SIZE),)
+        )
+    return _executor
+
+ARTIFACT_EXTENSIONS = ('keras', 'npz', 'q.npz')
+
+def resume():
+    """Called when a web process starts: queued jobs and jobs stranded by a restart are picked up again"""
+    threading.Thread(target=dispatch, daemon=True).start()
+
+def submit(nn: NeuralNetwork, reuse=True) -> TrainingJob:
+    """Queues a training job for the network and starts it as soon as the pool and the user's cap allow
+    With reuse, a network of the same user trained on the same config and images is copied instead,
+    the returned job is finished already.
+    """
+    nn.fingerprint = fingerprint(nn)
+    nn.save(update_fields=['fingerprint'])
+
+    source = find_reusable(nn) if reuse else None
+    if source is not None:
+        return reuse_training(nn, source)
+    return enqueue(nn)
+
+def enqueue(nn: NeuralNetwork, epochs=None) -> TrainingJob:
+    """Queues a job that trains the network up to epochs in total, continuing from its saved model when it has one
+    Raises costs.OverBudget when the job does not fit the training budget and ValueError when the images
+    have different grid sizes, nothing is queued then.
+    """
+    job = create_job(nn, epochs)
+    dispatch()
+    job.refresh_from_db()
+    return job
+
+def create_job(nn: NeuralNetwork, epochs=None) -> TrainingJob:
+    """Admits and records the job without starting it, for callers that dispatch after their transaction"""
+    report = admit(nn, epochs)
+    job = TrainingJob.objects.create(user=nn.user, network=nn, epochs=epochs, estimate=report)
+    NeuralNetwork.objects.filter(id=nn.id).update(status="Queued")
+    # the loaded model is about to be replaced, no need to hold it until the mtime check notices
+    registry.invalidate(nn.id)
+    return job
+
+def admit(nn: NeuralNetwork, epochs=None):
+    """Cost estimate of training the network up to epochs, see costs.admit
+    The estimate's batch_size is the one the job trains with: "auto" resolved once here, lowered when it
+    did not fit the memory limit. The worker takes it from TrainingJob.estimate, the params keep what the user asked for.
+    """
+    categories = list(nn.categories.order_by('id'))
+    count, size = costs.count_images(categories), costs.feature_size(categories)
+    options = extract_training_options(nn, count, size)
+    remaining = max((epochs or options['epochs']) - nn.epochs, 1)
+
+    params = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
+    return costs.admit(params, count, size, options['batch_size'], remaining, options['workers'])
+
+def fingerprint(nn: NeuralNetwork):
+    """Hash of the canonical params and of the image contents per label,
+    image names and row order do not matter, category order does (it decides the labels)
+    """
+    params = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, separators=(',', ':')).encode())
+
+    for category in nn.categories.order_by('id'):
+        hashes = sorted(content_hash(data) for data in Image.objects.filter(category=category).values_list('data', flat=True))
+        digest.update(f"|{len(hashes)}:{','.join(hashes)}".encode())
+    return digest.hexdigest()
+
+def find_reusable(nn: NeuralNetwork):
+    candidates = (NeuralNetwork.objects
+                  .filter(user_id=nn.user_id, fingerprint=nn.fingerprint, status="Trained", sweep__isnull=True)
+                  .exclude(id=nn.id).order_by('-id'))
+    for candidate in candidates:
+        if os.path.exists(candidate.artifact_path()):
+            return candidate
+    return None
+
+def reuse_training(nn: NeuralNetwork, source: NeuralNetwork) -> TrainingJob:
+    """Copies the artifacts and metrics of source, the job is recorded like a finished one"""
+    now = timezone.now()
+    job = TrainingJob.objects.create(user=nn.user, network=nn, status="Training", started_at=now)
+
+    os.makedirs(os.path.dirname(nn.artifact_path()), exist_ok=True)
+    for ext in ARTIFACT_EXTENSIONS:
+        if os.path.exists(source.artifact_path(ext)):
+            shutil.copyfile(source.artifact_path(ext), nn.artifact_path(ext))
+
+    progress.publish(job.id, status="Training", reused_from=source.id)
+    finish_job(job.id, "Trained", accuracy=source.accuracy, loss=source.loss, val_accuracy=source.val_accuracy, epochs=source.epochs)
+    job.refresh_from_db()
+    return job
+
+def dispatch():
+    """Moves queued jobs into the pool in FIFO order
+    - At most TRAINING_POOL_SIZE jobs are training at once
+    - At most TRAINING_MAX_JOBS_PER_USER of them belong to the same user, the rest of that user's jobs wait
+    - Trials of a sweep are capped by SWEEP_MAX_PARALLEL_TRIALS per sweep instead
+    - The estimated peak memory of the running jobs stays within TRAINING_MEMORY_BUDGET,
+      a job that does not fit waits and smaller jobs behind it may go first
+    """
+    with _lock:
+        requeue_stale_jobs()
+
+        running = TrainingJob.objects.filter(status="Training").values_list('user_id', 'network__sweep_id', 'estimate')
+        free = settings.TRAINING_POOL_SIZE - len(running)
+        per_owner = Counter(_owner(user_id, sweep_id)[0] for user_id, sweep_id, _ in running)
+        memory = sum(_memory(estimate) for _, _, estimate in running)
+
+        for job in TrainingJob.objects.filter(status="Queued").select_related('network'):
+            if free <= 0:
+                break
+            owner, cap = _owner(job.user_id, job.network.sweep_id)
+            if per_owner[owner] >= cap:
+                continue
+            # a job alone always runs, admission already held it to TRAINING_MAX_JOB_BYTES
+            if memory and memory + _memory(job.estimate) > settings.TRAINING_MEMORY_BUDGET:
+                continue
+
+            # another web process may have claimed the job in the meantime
+            claimed = (TrainingJob.objects.filter(id=job.id, status="Queued")
+                       .update(status="Training", started_at=timezone.now(), attempts=F('attempts') + 1))
+            if not claimed:
+                continue
+            NeuralNetwork.objects.filter(id=job.network_id).update(status="Training")
+
+            per_owner[owner] += 1
+            free -= 1
+            memory += _memory(job.estimate)
+
+            executor = get_executor()
+            future = executor.submit(run_training_job, str(job.id))
+            _futures[job.id] = future
+            future.add_done_callback(partial(_on_job_done, job.id, executor))
+
+def requeue_stale_jobs():
+    """Jobs left in Training by a web process or worker that died go back to the queue
+    A job counts as stale when it runs in no pool of this process and neither its heartbeat nor its progress
+    moved for TRAINING_STALE_SECONDS. Jobs of other web processes keep beating while their workers are alive.
+    """
+    cutoff = time.time() - settings.TRAINING_STALE_SECONDS
+    for job in TrainingJob.objects.filter(status="Training").exclude(id__in=list(_futures)):
+        snapshot = progress.get(job.id) or {}
+        last_seen = max(snapshot.get('updated_at') or 0, *(stamp.timestamp() for stamp in (job.started_at, job.heartbeat_at) if stamp))
+        if last_seen < cutoff:
+            retry_or_fail(job.id, 'Training stopped responding')
+
+@contextmanager
+def heartbeat(job_id):
+    """Stamps the job's heartbeat_at every TRAINING_HEARTBEAT_SECONDS while the block runs
+    The stamps come from a thread of their own, so a long epoch or data load does not make the job look stale.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while True:
+                try:
+                    TrainingJob.objects.filter(id=job_id).update(heartbeat_at=timezone.now())
+                except Exception:
+                    pass  # a missed beat is harmless, the next one is soon
+                if stop.wait(settings.TRAINING_HEARTBEAT_SECONDS):
+                    return
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True, name=f'heartbeat-{job_id}')
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def retry_or_fail(job_id, error):
+    """Queues the job again, it resumes from its last epoch checkpoint, until TRAINING_MAX_ATTEMPTS is used up"""
+    job = TrainingJob.objects.get(id=job_id)
+    if job.attempts >= settings.TRAINING_MAX_ATTEMPTS:
+        finish_job(job_id, "Failed", error=error)
+        return
+
+    if TrainingJob.objects.filter(id=job_id, status="Training").update(status="Queued", error=error):
+        NeuralNetwork.objects.filter(id=job.network_id).update(status="Queued")
+        progress.publish(job_id, **{**(progress.get(job_id) or {}), 'status': "Queued", 'error': error})
+
+def _owner(user_id, sweep_id):
+    if sweep_id is not None:
+        return ('sweep', sweep_id), settings.SWEEP_MAX_PARALLEL_TRIALS
+    return ('user', user_id), settings.TRAINING_MAX_JOBS_PER_USER
+
+def _memory(estimate):
+    return (estimate or {}).get('peak_memory_bytes', 0)
+
+def _on_job_done(job_id, executor, future):
+    global _executor
+    from . import sweeps
+
+    close_old_connections()
+    error = future.exception()
+    with _lock:
+        _futures.pop(job_id, None)
+        if isinstance(error, BrokenProcessPool) and _executor is executor:
+            # a worker was killed, the pool refuses new work and is replaced on the next dispatch
+            _executor = None
+    if error is not None:
+        # the worker died before it could record the result itself
+        retry_or_fail(job_id, str(error) or type(error).__name__)
+    sweeps.on_job_done(job_id)
+    dispatch()
+
+def finish_job(job_id, status, error='', accuracy=None, loss=None, val_accuracy=None, epochs=None, scaling=None):
+    job = TrainingJob.objects.select_related('network').get(id=job_id)
+    job.status = status
+    job.error = error
+    if scaling is not None:
+        job.scaling = scaling
+    job.finished_at = timezone.now()
+    job.save()
+
+    nn = job.network
+    nn.status = status
+    if accuracy is not None:
+        nn.accuracy = accuracy
+    if loss is not None:
+        nn.loss = loss
+    if val_accuracy is not None:
+        nn.val_accuracy = val_accuracy
+    if epochs is not None:
+        nn.epochs = epochs
+    nn.save()
+
+    snapshot = progress.get(job_id) or {}
+    progress.publish(job_id, **{**snapshot, 'status': status, 'error': error, 'accuracy': nn.accuracy, 'loss': nn.loss})
+
+def run_training_job(job_id):
+    """Entry point executed inside a pool process"""
+    job = TrainingJob.objects.select_related('network').get(id=job_id)
+    progress.publish(job_id, status="Training", attempt=job.attempts)
+    with heartbeat(job_id):
+        try:
+            metrics = train_neural_network(job.network, on_progress=partial(progress.publish, job_id), epochs=job.epochs,
+                                           batch_size=job.estimate.get('batch_size'))
+        except Exception as e:
+            finish_job(job_id, "Failed", error=str(e))
+            return
+        finish_job(job_id, "Trained", **metrics)
+
+def train_neural_network(nn: NeuralNetwork, on_progress=None, epochs=None, batch_size=None):
+    """Trains the network up to epochs in total (TRAINING_EPOCHS by default)
+    - batch_size is the one admitted with the job, worked out from the params again without it
+    - A run that was interrupted continues from its last epoch checkpoint
+    - A network that was trained for fewer epochs before continues from its saved model and optimizer state
+    - With "workers" above 1 in the params the epochs run data-parallel, see neural_network/parallel.py
+    Returns (dict): accuracy, loss, val_accuracy (None without a validation split), epochs, scaling (data-parallel only)
+    """
+    from .neural_network import dataset, parallel, train as training
+
+    # the gallery may have changed while the job was queued
+    NeuralNetwork.objects.filter(id=nn.id).update(fingerprint=fingerprint(nn))
+
+    categories = list(nn.categories.order_by('id'))
+    count = costs.count_images(categories)
+    if count == 0:
+        raise ValueError('No images found for selected categories')
+    options = extract_training_options(nn, count, costs.feature_size(categories))
+    batch_size = batch_size or options['batch_size']
+
+    epochs = epochs or options['epochs']
+    user_model, lr = extract_nn_params(nn)
+    initial_epoch = 0
+    checkpoint = training.latest_checkpoint(nn.checkpoint_dir())
+    if checkpoint is not None and nn.epochs < checkpoint[1] < epochs:
+        user_model.model = training.load_model(checkpoint[0])
+        initial_epoch = checkpoint[1]
+    elif 0 < nn.epochs < epochs and os.path.exists(nn.artifact_path()):
+        user_model.model = training.load_model(nn.artifact_path())
+        initial_epoch = nn.epochs
+
+    if options['workers'] > 1:
+        history = parallel.train(user_model, nn, options['workers'], learning_rate=lr, epochs=epochs, batch_size=batch_size,
+                                 progress=on_progress, initial_epoch=initial_epoch, checkpoint_dir=nn.checkpoint_dir(),
+                                 early_stopping=options['early_stopping'], reduce_lr=options['reduce_lr'],
+                                 augment=extract_augment_params(nn))
+        sample = dataset.holdout(categories, 256)[0]
+    else:
+        train, validation, samples = dataset.build(categories, batch_size, augment=extract_augment_params(nn))
+        history = user_model.train(train, learning_rate=lr, epochs=epochs, batch_size=batch_size, progress=on_progress,
+                                   validation_data=validation, initial_epoch=initial_epoch, checkpoint_dir=nn.checkpoint_dir(),
+                                   early_stopping=options['early_stopping'], reduce_lr=options['reduce_lr'], samples=samples)
+        sample = dataset.sample_features(train, 256)
+    user_model.save(nn.artifact_path())
+    export_numpy_model(user_model.model, nn, sample)
+    # the saved model is the final state now, checkpoints only matter for interrupted runs
+    shutil.rmtree(nn.checkpoint_dir(), ignore_errors=True)
+
+    metrics = history.history
+    return {
+        'accuracy': float(metrics['accuracy'][-1]),
+        'loss': float(metrics['loss'][-1]),
+        'val_accuracy': float(metrics['val_accuracy'][-1]) if 'val_accuracy' in metrics else None,
+        'epochs': initial_epoch + len(history.epoch),  # fewer than asked for when training stopped early
+        'scaling': getattr(history, 'scaling', None)
+    }
+
+def export_numpy_model(keras_model, nn: NeuralNetwork, sample):
+    """Writes the .npz artifact used for TensorFlow-free inference, the registry falls back to .keras without it
+    Returns (str): extension of the artifact written, "q.npz" when quantized, None when only the .keras one is left
+    """
+    from .neural_network import engine
+
+    path = nn.artifact_path('npz')
+    try:
+        numpy_model = engine.export(keras_model, path)
+        difference = engine.max_difference(keras_model, numpy_model, sample)
+        if difference > NUMPY_TOLERANCE:
+            raise ValueError(f"NumPy engine differs from Keras by {difference}")
+    except ValueError:
+        for stale in (path, nn.artifact_path('q.npz')):
+            if os.path.exists(stale):
+                os.remove(stale)
+        return None
+    return 'q.npz' if export_quantized_model(numpy_model, nn, sample) else 'npz'
+
+def export_quantized_model(numpy_model, nn: NeuralNetwork, sample):
+    """Writes the .q.npz artifact the registry prefers, the first of MODEL_QUANTIZATION's dtypes
+    that still gives the float model's label for MODEL_QUANTIZATION_MIN_AGREEMENT of the sample.
+    The float .npz it replaces is removed, the .keras artifact keeps full precision.
+    Returns (str): the dtype used, None when the network keeps only float artifacts
+    """
+    from .neural_network import engine
+
+    path = nn.artifact_path('q.npz')
+    dtypes = {'int8': ('int8', 'float16'), 'float16': ('float16',)}.get(settings.MODEL_QUANTIZATION, ())
+    for dtype in dtypes:
+        quantized = engine.quantize(numpy_model, path, dtype)
+        if engine.agreement(numpy_model, quantized, sample) >= settings.MODEL_QUANTIZATION_MIN_AGREEMENT:
+            if os.path.exists(nn.artifact_path('npz')):
+                os.remove(nn.artifact_path('npz'))
+            return dtype
+
+    if os.path.exists(path):
+        os.remove(path)
+    return None
+
+def extract_augment_params(nn):
+    """augment.apply arguments from params["augment"]: false/missing is off, true uses the defaults,
+    a dict overrides some of them (rotation_range, ..., seed)
+    """
+    from .neural_network import augment
+
+    data = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
+    options = data.get('augment')
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        return {}
+    return {key: value for key, value in options.items() if key in augment.DEFAULTS or key == 'seed'}
+
+def extract_training_options(nn, count, feature_size):
+    """epochs, batch_size, early_stopping and reduce_lr from the network params
+    - epochs (int): TRAINING_EPOCHS when missing
+    - batch_size (int or "auto"): "auto" (the default) picks one from the dataset size and free memory
+    - early_stopping, reduce_lr (bool or dict): on by default, a dict overrides the defaults in train.py
+    - workers (int): data-parallel worker processes, 1 (the default) trains in the job's own process,
+      at most TRAINING_MAX_DATA_PARALLEL_WORKERS
+    """
+    data = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
+
+    batch_size = data.get('batch_size', 'auto')
+    if batch_size in (None, 'auto'):
+        neurons = sum(costs.layer_widths(data))
+        batch_size = costs.auto_batch_size(count, feature_size + neurons)
+
+    return {
+        'epochs': int(data.get('epochs') or TRAINING_EPOCHS),
+        'batch_size': int(batch_size),
+        'early_stopping': _callback_options(data.get('early_stopping', True)),
+        'reduce_lr': _callback_options(data.get('reduce_lr', True)),
+        'workers': min(max(int(data.get('workers') or 1), 1), settings.TRAINING_MAX_DATA_PARALLEL_WORKERS),
+    }
+
+def _callback_options(value):
+    if not value:
+        return None
+    return value if isinstance(value, dict) else {}
+
+def extract_nn_params(nn):
+    from .neural_network import train
+
+    data = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
+
+    layers = data.get('layers', [])
+    lr = float(data.get('loss'))
+
+    model_layers = []
+    start_shape = 0
+    num_classes = 0
+
+    for layer_data in layers:
+        lrname = layer_data.get('name')
+        neurons = int(layer_data.get('neurons'))
+        activation = layer_data.get('activation')
+
+        if lrname == 'Input Layer':
+            start_shape = (neurons**0.5, neurons**0.5)
+        elif lrname == 'Output Layer':
+            num_classes = neurons
+
+        model_layers.append(train.Layer(neurons, activation))
+
+    user_model = train.CustomModel(start_shape, num_classes)
+    user_model.build(model_layers)
+
+    return user_model, lr
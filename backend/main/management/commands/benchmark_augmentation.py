@@ -0,0 +1,63 @@
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = "Compares training throughput (samples/s) with and without the augmentation stage on synthetic grids"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=4000)
+        parser.add_argument('--size', type=int, default=28, help="Grids are size x size")
+        parser.add_argument('--batch-size', type=int, default=32)
+        parser.add_argument('--epochs', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--max-slowdown', type=float, default=0.25, help="Allowed drop in samples/s, 0.25 is 25%%")
+
+    def handle(self, *args, **options):
+        import tensorflow as tf
+        from main.neural_network import augment
+        from main.neural_network.train import CustomModel, Layer
+
+        size, count, batch_size = options['size'], options['images'], options['batch_size']
+        rng = np.random.default_rng(options['seed'])
+        x = (rng.random((count, size * size)) < 0.3).astype('float32')
+        y = np.eye(2, dtype='float32')[rng.integers(0, 2, count)]
+
+        def pipeline(augmented):
+            dataset = tf.data.Dataset.from_tensor_slices((x, y)).shuffle(count, seed=options['seed']).batch(batch_size)
+            if augmented:
+                dataset = augment.apply(dataset, shape=(size, size), seed=options['seed'],
+                                        num_parallel_calls=settings.TRAINING_AUGMENT_PARALLEL_CALLS)
+            return dataset.prefetch(tf.data.AUTOTUNE)
+
+        def input_only(augmented):
+            start = time.perf_counter()
+            for _ in pipeline(augmented):
+                pass
+            return count / (time.perf_counter() - start)
+
+        def training(augmented):
+            model = CustomModel((size, size), 2)
+            model.build([Layer(size * size, 'relu'), Layer(64, 'relu'), Layer(2, 'softmax')])
+            dataset = pipeline(augmented)
+            model.train(dataset.take(1), epochs=1)  # traces the graph outside the measurement
+            start = time.perf_counter()
+            model.model.fit(dataset, epochs=options['epochs'], shuffle=False, verbose=0)
+            return count * options['epochs'] / (time.perf_counter() - start)
+
+        results = {}
+        for augmented in (False, True):
+            input_only(augmented)  # warm-up
+            results[augmented] = (input_only(augmented), training(augmented))
+
+        for augmented, (input_rate, train_rate) in results.items():
+            label = "with augmentation:   " if augmented else "without augmentation:"
+            self.stdout.write(f"{label} input {input_rate:,.0f} samples/s, training {train_rate:,.0f} samples/s")
+
+        slowdown = 1 - results[True][1] / results[False][1]
+        self.stdout.write(f"training slowdown: {slowdown:.1%}")
+        if slowdown > options['max_slowdown']:
+            raise CommandError(f"Augmentation slows training down by {slowdown:.1%}, limit is {options['max_slowdown']:.0%}")
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import NeuralNetwork
+
+class Command(BaseCommand):
+    help = "Trains a network's config data-parallel with each worker count and reports the scaling efficiency, nothing is saved"
+
+    def add_arguments(self, parser):
+        parser.add_argument('network_id', type=int)
+        parser.add_argument('--workers', default='1,2,4', help="Comma separated worker counts, the first one is the baseline")
+        parser.add_argument('--epochs', type=int, default=3)
+        parser.add_argument('--batch-size', type=int, default=None, help="The network's batch size by default")
+
+    def handle(self, *args, **options):
+        from main import costs, jobs
+        from main.neural_network import parallel
+
+        nn = NeuralNetwork.objects.filter(id=options['network_id']).first()
+        if nn is None:
+            raise CommandError(f"Network {options['network_id']} not found")
+        counts = [int(count) for count in options['workers'].split(',')]
+        if not counts or min(counts) < 1:
+            raise CommandError('Worker counts must be at least 1')
+
+        categories = list(nn.categories.order_by('id'))
+        batch_size = options['batch_size'] or jobs.extract_training_options(nn, costs.count_images(categories), costs.feature_size(categories))['batch_size']
+
+        per_worker = None
+        self.stdout.write(f"{'workers':>7} {'samples/s':>10} {'speedup':>8} {'efficiency':>10} {'in-run':>7} {'sync s':>7} {'val_acc':>7}")
+        for workers in counts:
+            user_model, lr = jobs.extract_nn_params(nn)
+            history = parallel.train(user_model, nn, workers, learning_rate=lr, epochs=options['epochs'], batch_size=batch_size)
+            scaling = history.scaling
+            if per_worker is None:
+                # throughput of one worker, taken as linear when the baseline has several
+                per_worker = scaling['samples_per_sec'] / workers
+            speedup = scaling['samples_per_sec'] / per_worker
+            val_accuracy = history.history.get('val_accuracy', [None])[-1]
+            self.stdout.write(
+                f"{workers:>7} {scaling['samples_per_sec']:>10,.0f} {speedup:>7.2f}x {speedup / workers:>10.0%} "
+                f"{scaling['efficiency']:>7.0%} {scaling['sync_seconds']:>7.3f} "
+                f"{val_accuracy if val_accuracy is None else round(val_accuracy, 3)!s:>7}"
+            )
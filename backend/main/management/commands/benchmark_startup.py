@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# wsgi.py warms the model registry like in production, the warm-up thread must not import TensorFlow either
+FIRST_REQUEST_SCRIPT = """
+import os, sys, time, threading
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+from django.core.wsgi import get_wsgi_application
+from django.test import Client
+application = get_wsgi_application()
+Client().get('/login/')
+elapsed = time.perf_counter() - start
+for thread in threading.enumerate():
+    if thread.name == 'registry-warm':
+        thread.join()
+print(elapsed, 'tensorflow' in sys.modules)
+"""
+
+class Command(BaseCommand):
+    help = "Measures `manage.py check` and first-request latency in fresh processes and fails when they are too slow"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3)
+        parser.add_argument('--max-check-seconds', type=float, default=3.0)
+        parser.add_argument('--max-first-request-seconds', type=float, default=3.0)
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        manage_py = os.path.join(settings.BASE_DIR, 'manage.py')
+
+        check_times = []
+        for _ in range(options['runs']):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, manage_py, 'check'], check=True, capture_output=True, env=env, cwd=settings.BASE_DIR)
+            check_times.append(time.perf_counter() - start)
+
+        request_times = []
+        for _ in range(options['runs']):
+            result = subprocess.run([sys.executable, '-c', FIRST_REQUEST_SCRIPT], check=True, capture_output=True, text=True, env=env, cwd=settings.BASE_DIR)
+            elapsed, tf_loaded = result.stdout.split()
+            request_times.append(float(elapsed))
+
+        check = statistics.median(check_times)
+        first_request = statistics.median(request_times)
+        self.stdout.write(f"manage.py check: {check:.2f}s (median of {options['runs']})")
+        self.stdout.write(f"first request:   {first_request:.2f}s (median of {options['runs']})")
+        self.stdout.write(f"tensorflow imported by the web process: {tf_loaded}")
+
+        if tf_loaded == 'True':
+            raise CommandError("TensorFlow was imported while serving an auth-only view or warming the registry")
+        if check > options['max_check_seconds']:
+            raise CommandError(f"manage.py check took {check:.2f}s, limit is {options['max_check_seconds']}s")
+        if first_request > options['max_first_request_seconds']:
+            raise CommandError(f"First request took {first_request:.2f}s, limit is {options['max_first_request_seconds']}s")
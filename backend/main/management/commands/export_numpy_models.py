@@ -0,0 +1,40 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from main import grids
+from main.jobs import export_numpy_model, export_quantized_model
+from main.models import Image, NeuralNetwork
+from main.neural_network.engine import NumpyModel
+
+class Command(BaseCommand):
+    help = "Writes the NumPy inference artifacts for trained networks that only have a Keras one or no quantized one"
+
+    def handle(self, *args, **options):
+        for nn in NeuralNetwork.objects.filter(status="Trained"):
+            if os.path.exists(nn.artifact_path('q.npz')):
+                continue
+            if os.path.exists(nn.artifact_path('npz')):
+                numpy_model = NumpyModel.load(nn.artifact_path('npz'))
+                dtype = export_quantized_model(numpy_model, nn, sample_features(nn, numpy_model.layers[0][0].shape[0]))
+                self.stdout.write(f"{nn.name}: {f'quantized to {dtype}' if dtype else 'kept float artifact'}")
+                continue
+            if not os.path.exists(nn.artifact_path()):
+                continue
+
+            import tensorflow as tf
+
+            keras_model = tf.keras.models.load_model(nn.artifact_path())
+            ext = export_numpy_model(keras_model, nn, sample_features(nn, keras_model.input_shape[-1]))
+            self.stdout.write(f"{nn.name}: {f'exported .{ext}' if ext else 'kept Keras artifact'}")
+
+def sample_features(nn, size, count=256):
+    """Features of up to count images of the network's categories, random rows when they no longer fit the network"""
+    import numpy as np
+
+    blobs = Image.objects.filter(category__in=nn.categories.all()).values_list('data', flat=True)[:count]
+    rows = [grids.to_features(grids.decode_binary(bytes(data))) for data in blobs]
+    rows = [row for row in rows if row.shape[-1] == size]
+    if not rows:
+        return np.random.rand(64, size).astype('float32')
+    return np.stack(rows)
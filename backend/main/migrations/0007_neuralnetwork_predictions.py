@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_trainingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='neuralnetwork',
+            name='predictions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,159 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:40
+
+import json
+import base64
+import struct
+from itertools import chain
+
+import numpy as np
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# A frozen copy of the main.grids codec as it was when images moved to rows, so that later changes to the
+# live module cannot change what this migration reads or writes.
+
+HEADER = struct.Struct('>2sBBHH')
+
+
+def decode_grid(grid):
+    rows, cols = len(grid), len(grid[0])
+    cells = ''.join(chain.from_iterable(grid))
+    if any(len(row) != cols for row in grid) or len(cells) != rows * cols * 7 or cells.count('#') != rows * cols:
+        raise ValueError('Grid cells must be "#rrggbb" hex colors')
+    return np.frombuffer(bytes.fromhex(cells.replace('#', '')), dtype=np.uint8).reshape(rows, cols, 3)
+
+
+def index_bits(colors):
+    for bits in (1, 2, 4):
+        if colors <= 1 << bits:
+            return bits
+    return 8
+
+
+def encode_binary(pixels):
+    rows, cols = pixels.shape[:2]
+    flat = pixels.reshape(-1, 3)
+    keys = (flat[:, 0].astype(np.uint32) << 16) | (flat[:, 1].astype(np.uint32) << 8) | flat[:, 2]
+    keys, indices = np.unique(keys, return_inverse=True)
+    palette = np.stack([keys >> 16, (keys >> 8) & 0xFF, keys & 0xFF], axis=1)
+
+    if len(palette) > 256:
+        return HEADER.pack(b'NG', 1, 0, rows, cols) + flat.tobytes()
+
+    bits = index_bits(len(palette))
+    indices = indices.reshape(-1, 1).astype(np.uint8)
+    packed = np.packbits(np.unpackbits(indices, axis=1)[:, 8 - bits:])
+    return HEADER.pack(b'NG', 1, 1, rows, cols) + bytes([len(palette) - 1]) + palette.astype(np.uint8).tobytes() + packed.tobytes()
+
+
+def decode_binary(data):
+    if len(data) < HEADER.size:
+        raise ValueError('Truncated grid data')
+    magic, version, mode, rows, cols = HEADER.unpack_from(data)
+    if magic != b'NG' or version != 1:
+        raise ValueError('Unknown grid format')
+
+    body = np.frombuffer(data, dtype=np.uint8, offset=HEADER.size)
+    count = rows * cols
+    if mode == 0:
+        if len(body) != count * 3:
+            raise ValueError('Truncated grid data')
+        return body.reshape(rows, cols, 3)
+    if mode == 1:
+        colors = int(body[0]) + 1 if len(body) else 0
+        bits = index_bits(colors)
+        if not colors or len(body) != 1 + colors * 3 + (count * bits + 7) // 8:
+            raise ValueError('Truncated grid data')
+        palette = body[1:1 + colors * 3].reshape(-1, 3)
+        bit_rows = np.unpackbits(body[1 + colors * 3:])[:count * bits].reshape(count, bits)
+        indices = np.packbits(np.pad(bit_rows, ((0, 0), (8 - bits, 0))), axis=1).reshape(-1)
+        if indices.max(initial=0) >= colors:
+            raise ValueError('Grid pixel refers to a missing palette color')
+        return palette[indices].reshape(rows, cols, 3)
+    raise ValueError('Unknown grid mode')
+
+
+def decode_image(image):
+    value = image['data'] if 'data' in image else image['grid']
+    if isinstance(value, str):
+        if value.lstrip().startswith('['):
+            return decode_grid(json.loads(value))
+        return decode_binary(base64.b64decode(value, validate=True))
+    if isinstance(value, list):
+        return decode_grid(value)
+    raise ValueError('Unsupported grid data')
+
+
+def images_to_rows(apps, schema_editor):
+    Category = apps.get_model('main', 'Category')
+    Image = apps.get_model('main', 'Image')
+
+    # rows from the old standalone image table belong to no category and cannot be reached
+    Image.objects.filter(category__isnull=True).delete()
+
+    for category in Category.objects.all():
+        rows = {}
+        for entry in category.images or []:
+            if entry.get('name') not in rows:
+                rows[entry['name']] = Image(category=category, name=entry['name'], data=encode_binary(decode_image(entry)))
+        Image.objects.bulk_create(rows.values())
+
+
+def rows_to_images(apps, schema_editor):
+    Category = apps.get_model('main', 'Category')
+    Image = apps.get_model('main', 'Image')
+
+    for category in Category.objects.all():
+        category.images = [
+            {'name': img.name, 'data': base64.b64encode(bytes(img.data)).decode('ascii')}
+            for img in category.image_rows.order_by('id')
+        ]
+        category.save()
+
+    # the old image table has no place for these rows, they live in the blobs again
+    Image.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_neuralnetwork_predictions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='category',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='image_rows', to='main.category'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='data',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RemoveField(
+            model_name='image',
+            name='image',
+        ),
+        migrations.RunPython(images_to_rows, rows_to_images),
+        migrations.RemoveField(
+            model_name='category',
+            name='images',
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='main.category'),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='data',
+            field=models.BinaryField(),
+        ),
+        migrations.AddConstraint(
+            model_name='image',
+            constraint=models.UniqueConstraint(fields=('category', 'name'), name='unique_image_name_per_category'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:55
+
+from django.db import migrations, models
+
+
+def count_default_epochs(apps, schema_editor):
+    # networks trained before epochs were recorded ran the default 10, continuing them needs that number
+    NeuralNetwork = apps.get_model('main', 'NeuralNetwork')
+    NeuralNetwork.objects.filter(status='Trained', epochs=0).update(epochs=10)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_sweep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trainingjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(count_default_epochs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_trainingjob_estimate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='neuralnetwork',
+            name='evaluation',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -1,4 +1,6 @@
+import os
 import uuid
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils.text import slugify
@@ -10,16 +12,27 @@ class NeuralNetwork(models.Model):
     accuracy = models.FloatField(default=0.0)
     loss = models.FloatField(default=0.0)
     status = models.CharField(max_length=20, default="Not Trained")
+    predictions = models.PositiveIntegerField(default=0)
+    fingerprint = models.CharField(max_length=64, blank=True, default='', db_index=True)  # see jobs.fingerprint
+    epochs = models.PositiveIntegerField(default=0)  # epochs trained so far
+    val_accuracy = models.FloatField(null=True, blank=True)
+    sweep = models.ForeignKey('Sweep', on_delete=models.SET_NULL, null=True, blank=True, related_name="trials")
+    evaluation = models.JSONField(null=True, blank=True)  # latest k-fold cross-validation, see crossval.py
     categories = models.ManyToManyField('Category', related_name="neural_networks")
 
     def __str__(self):
         return f"NeuralNetwork {self.id} by {self.user.username} - {self.status}"
 
+    def artifact_path(self, ext: str = 'keras'):
+        return os.path.join(settings.MODELS_DIR, str(self.user_id), f"{self.id}.{ext}")
+
+    def checkpoint_dir(self):
+        return os.path.join(settings.MODELS_DIR, str(self.user_id), 'checkpoints', str(self.id))
+
 class Category(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="categories")
     name = models.CharField(max_length=255, unique=True)
     slug = models.SlugField(unique=True, blank=True)
-    images = models.JSONField(default=list)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -29,10 +42,75 @@ class Category(models.Model):
     def __str__(self):
         return f"{self.name} (User: {self.user.username})"
 
+class GalleryVersion(models.Model):
+    """Incremented on every change to a user's categories or images, it backs the listing ETags"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="gallery_version")
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Gallery of {self.user.username} - v{self.version}"
+
 class Image(models.Model):
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="images")
     name = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
-    image = models.JSONField()
+    data = models.BinaryField()  # compact grid format, see grids.py
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'name'], name='unique_image_name_per_category'),
+        ]
 
     def __str__(self):
         return self.name
+
+class TrainingJob(models.Model):
+    STATUS_CHOICES = [
+        ("Queued", "Queued"),
+        ("Training", "Training"),
+        ("Trained", "Trained"),
+        ("Failed", "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="training_jobs")
+    network = models.ForeignKey(NeuralNetwork, on_delete=models.CASCADE, related_name="jobs")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="Queued", db_index=True)
+    error = models.TextField(blank=True, default='')
+    epochs = models.PositiveIntegerField(null=True, blank=True)  # epochs the network has after the job, default when empty
+    attempts = models.PositiveSmallIntegerField(default=0)  # times a worker picked the job up
+    estimate = models.JSONField(default=dict, blank=True)  # costs.estimate at admission, empty for reused results
+    scaling = models.JSONField(default=dict, blank=True)  # throughput of a data-parallel run, see neural_network/parallel.py
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # stamped by the worker while the job runs, see jobs.heartbeat
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"TrainingJob {self.id} for {self.network.name} - {self.status}"
+
+class Sweep(models.Model):
+    """Hyperparameter search over many trial networks, see sweeps.py"""
+    STATUS_CHOICES = [
+        ("Running", "Running"),
+        ("Finished", "Finished"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sweeps")
+    name = models.CharField(max_length=255)
+    categories = models.ManyToManyField(Category, related_name="sweeps")
+    pending = models.JSONField(default=list)  # params of the trials not started yet
+    rungs = models.JSONField(default=list)  # epoch budgets in ascending order
+    reduction = models.PositiveSmallIntegerField(default=3)  # 1 in reduction trials is promoted per rung
+    results = models.JSONField(default=dict)  # trial network id -> {rung index: validation accuracy}
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="Running")
+    best = models.ForeignKey(NeuralNetwork, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Sweep {self.name} by {self.user.username} - {self.status}"
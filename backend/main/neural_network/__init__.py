@@ -0,0 +1,3 @@
+# train and dataset import TensorFlow at module level: import them inside the functions
+# that need them (training jobs), never at the top of modules loaded by the web process.
+# engine is TensorFlow-free and safe to import anywhere.
@@ -0,0 +1,81 @@
+import math
+import tensorflow as tf
+
+# Random affine augmentation as batched tensor ops inside a tf.data pipeline.
+# The parameters mean the same as for ImageDataGenerator: angles in degrees, shifts and zoom as fractions.
+
+DEFAULTS = {
+    'rotation_range': 20,
+    'width_shift_range': 0.2,
+    'height_shift_range': 0.2,
+    'shear_range': 0.2,
+    'zoom_range': 0.2,
+    'horizontal_flip': True,
+    'fill_mode': 'nearest',
+}
+
+def transforms(batch, height, width, seed, rotation_range=0, width_shift_range=0, height_shift_range=0,
+               shear_range=0, zoom_range=0, horizontal_flip=False, **_):
+    """One random projective transform per image, shape (batch, 8), mapping output pixels to input pixels"""
+    seeds = tf.random.experimental.stateless_split(seed, 7)
+
+    def uniform(i, limit):
+        return tf.random.stateless_uniform([batch], seeds[i], -limit, limit)
+
+    theta = uniform(0, rotation_range * math.pi / 180)
+    shear = uniform(1, shear_range * math.pi / 180)
+    zoom_x = 1 + uniform(2, zoom_range)
+    zoom_y = 1 + uniform(3, zoom_range)
+    shift_x = uniform(4, width_shift_range) * tf.cast(width, tf.float32)
+    shift_y = uniform(5, height_shift_range) * tf.cast(height, tf.float32)
+    flip = 1.0
+    if horizontal_flip:
+        flip = tf.where(tf.random.stateless_uniform([batch], seeds[6]) < 0.5, -1.0, 1.0)
+
+    # rotation @ shear @ zoom, the flip mirrors the x axis of the output
+    a0 = (tf.cos(theta) * zoom_x) * flip
+    a1 = -tf.sin(theta + shear) * zoom_y
+    b0 = (tf.sin(theta) * zoom_x) * flip
+    b1 = tf.cos(theta + shear) * zoom_y
+
+    # every transform is taken around the image center
+    cx = (tf.cast(width, tf.float32) - 1) / 2
+    cy = (tf.cast(height, tf.float32) - 1) / 2
+    a2 = cx + shift_x - a0 * cx - a1 * cy
+    b2 = cy + shift_y - b0 * cx - b1 * cy
+
+    zeros = tf.zeros([batch])
+    return tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+
+def augment_images(images, seed, fill_mode='nearest', **params):
+    """Augments a float batch of shape (batch, height, width, channels)"""
+    shape = tf.shape(images)
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms(shape[0], shape[1], shape[2], seed, **params),
+        output_shape=shape[1:3],
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode=fill_mode.upper()
+    )
+
+def apply(dataset, shape=None, seed=None, num_parallel_calls=tf.data.AUTOTUNE, **params):
+    """Adds the augmentation stage to a batched dataset of (images, labels)
+    - shape (tuple): (rows, cols) when the images are flat feature rows
+    - seed (int): makes the sequence of transforms repeatable, a random one is used otherwise
+    Every pass over the dataset (every epoch) draws new transforms.
+    """
+    params = {**DEFAULTS, **params}
+    # a stateless seed per batch keeps parallel map calls independent of scheduling,
+    # rerandomizing gives each iteration its own seeds instead of replaying the first epoch's
+    seeds = tf.data.Dataset.random(seed=seed, rerandomize_each_iteration=True).batch(2)
+
+    def augment(batch, batch_seed):
+        images, labels = batch
+        if shape is None:
+            return augment_images(images, batch_seed, **params), labels
+
+        flat = tf.reshape(images, [-1, shape[0], shape[1], 1])
+        return tf.reshape(augment_images(flat, batch_seed, **params), tf.shape(images)), labels
+
+    return tf.data.Dataset.zip((dataset, seeds)).map(augment, num_parallel_calls=num_parallel_calls)
@@ -1,8 +1,20 @@
+from collections import Counter
+
 import numpy as np
+import tensorflow as tf
+
+from django.conf import settings
+from django.db.models.functions import Mod
 
-from tensorflow.keras.preprocessing.image import img_to_array, ImageDataGenerator
 from tensorflow.keras.preprocessing import image
 
+from . import augment as augmentation
+from ..costs import VALIDATION_SPLIT, count_images, feature_size, grid_shape
+from ..models import Image
+from ..tensor_cache import tensor_cache
+
+CHUNK_SIZE = 500
+
 class CustomDataset:
     def __init__(self, images, labels):
         self.images = images
@@ -13,17 +25,211 @@ class CustomDataset:
         self.images.append(image.img_to_array(img)/255.0)
         self.labels.append(label)
 
-        self.images = np.array(self.images)
-        self.labels = np.array(self.labels)
-
-    def augment(self):
-        augmented_data = ImageDataGenerator(
-            rotation_range=20,
-            width_shift_range=0.2,
-            height_shift_range=0.2,
-            shear_range=0.2,
-            zoom_range=0.2,
-            horizontal_flip=True,
-            fill_mode='nearest'
-        )
-        return augmented_data.fit(x=self.images)
\ No newline at end of file
+    @classmethod
+    def from_categories(cls, categories):
+        return cls(*from_categories(categories))
+
+    def arrays(self):
+        """Stacks the images and labels once, after all of them were added"""
+        return np.asarray(self.images), np.asarray(self.labels)
+
+    def augment(self, batch_size=32, seed=None, **params):
+        """Batched dataset of randomly transformed copies of the images, new transforms on every pass"""
+        images, labels = self.arrays()
+        dataset = tf.data.Dataset.from_tensor_slices((images.astype('float32'), labels)).batch(batch_size)
+        return augmentation.apply(dataset, seed=seed, num_parallel_calls=settings.TRAINING_AUGMENT_PARALLEL_CALLS, **params)
+
+def _images(categories):
+    return Image.objects.filter(category__in=categories)
+
+def _image_rows(images, fields=('category_id', 'data')):
+    return images.order_by('id').values_list(*fields).iterator(chunk_size=CHUNK_SIZE)
+
+def from_categories(categories):
+    """Builds training arrays from Category objects, the label of an image is the index of its category
+    - Returns (tuple): features of shape (n, rows * cols), one-hot labels of shape (n, len(categories))
+    The features come from the user's tensor cache, only images it has not seen yet are decoded.
+    Each image lands directly in a random row of the preallocated arrays, so no shuffled copy is made.
+    """
+    rows = list(_image_rows(_images(categories)))
+    if not rows:
+        return np.empty((0, 0), dtype='float32'), np.empty((0, len(categories)), dtype='float32')
+
+    labels_of = {category.id: label for label, category in enumerate(categories)}
+    n, size = len(rows), feature_size(categories)
+
+    x = np.empty((n, size), dtype='float32')
+    y = np.zeros((n, len(categories)), dtype='float32')
+
+    order = np.random.permutation(n)
+    tensor_cache.fill(categories[0].user_id, [data for _, data in rows], x, order)
+    y[order, [labels_of[category_id] for category_id, _ in rows]] = 1.0
+    return x, y
+
+HOLDOUT = round(1 / VALIDATION_SPLIT)
+
+def is_validation(image_id):
+    """Every fifth image by id is held out for validation, the split is the same in every epoch and process"""
+    return image_id % HOLDOUT == 0
+
+def _split(images, validation):
+    """The images is_validation holds out (or keeps for training), filtered in the database"""
+    images = images.annotate(holdout=Mod('id', HOLDOUT))
+    return images.filter(holdout=0) if validation else images.exclude(holdout=0)
+
+def _shard(images, shards, index):
+    """Training images of part index of shards, filtered in the database: the ids whose id % (HOLDOUT * shards)
+    falls in the index-th run of HOLDOUT - 1 ids between two validation ids
+    """
+    slot = HOLDOUT * index
+    return images.annotate(slot=Mod('id', HOLDOUT * shards)).filter(slot__gt=slot, slot__lt=slot + HOLDOUT)
+
+def training_images(categories):
+    """Number of images is_validation keeps for training, counted in the database"""
+    return _split(_images(categories), False).count()
+
+def stream_categories(categories, validation=False):
+    """Yields (features, one-hot label) per image without holding the gallery in memory, split by is_validation"""
+    yield from _stream(categories, _split(_images(categories), validation))
+
+def _stream(categories, images):
+    for x, y in _chunks(categories, images):
+        yield from zip(x, y)
+
+def _chunks(categories, images):
+    """(features, one-hot labels) arrays of up to CHUNK_SIZE images at a time, in id order"""
+    labels_of = {category.id: label for label, category in enumerate(categories)}
+    eye = np.eye(len(categories), dtype='float32')
+    size = feature_size(categories)
+
+    chunk = []
+    for row in _image_rows(images, ('id', 'category_id', 'data')):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield _cached_chunk(categories[0].user_id, chunk, size, labels_of, eye)
+            chunk = []
+    if chunk:
+        yield _cached_chunk(categories[0].user_id, chunk, size, labels_of, eye)
+
+def _streamed(categories, images):
+    """tf.data dataset of (features, one-hot label) read from the database and tensor cache on every pass"""
+    signature = (tf.TensorSpec((feature_size(categories),), tf.float32), tf.TensorSpec((len(categories),), tf.float32))
+    return tf.data.Dataset.from_generator(lambda: _stream(categories, images), output_signature=signature)
+
+def _cached_chunk(user_id, chunk, size, labels_of, eye):
+    x = np.empty((len(chunk), size), dtype='float32')
+    tensor_cache.fill(user_id, [data for _, _, data in chunk], x)
+    return x, eye[[labels_of[category_id] for _, category_id, _ in chunk]]
+
+def _arrays(categories, rows):
+    """Features and one-hot labels of (id, category_id, data) rows"""
+    labels_of = {category.id: label for label, category in enumerate(categories)}
+    x = np.empty((len(rows), feature_size(categories)), dtype='float32')
+    tensor_cache.fill(categories[0].user_id, [data for _, _, data in rows], x)
+    y = np.zeros((len(rows), len(categories)), dtype='float32')
+    y[np.arange(len(rows)), [labels_of[category_id] for _, category_id, _ in rows]] = 1.0
+    return x, y
+
+def build(categories, batch_size, augment=None):
+    """Training and validation tf.data pipelines for the selected categories
+    - Up to TRAINING_IN_MEMORY_MAX_IMAGES images are decoded into one preallocated array
+    - Larger galleries are streamed from the database, memory is bounded by TRAINING_SHUFFLE_BUFFER
+    - augment (dict): augment.apply parameters, training batches get random transforms when given
+    Both are shuffled every epoch, batched and prefetched.
+    Returns (tuple): train dataset, validation dataset (None when there are too few images), training image count
+    """
+    n = count_images(categories)
+    if n == 0:
+        return None, None, 0
+
+    if n <= settings.TRAINING_IN_MEMORY_MAX_IMAGES:
+        x, y = from_categories(categories)
+        n = len(x)
+        split = int(n * (1 - VALIDATION_SPLIT)) if n > 1 else n
+        train = tf.data.Dataset.from_tensor_slices((x[:split], y[:split])).shuffle(split, reshuffle_each_iteration=True)
+        validation = tf.data.Dataset.from_tensor_slices((x[split:], y[split:])) if split < n else None
+        n = split
+    else:
+        images = _images(categories)
+        train = _streamed(categories, _split(images, False)).shuffle(min(settings.TRAINING_SHUFFLE_BUFFER, n), reshuffle_each_iteration=True)
+        validation = _streamed(categories, _split(images, True))
+        n = training_images(categories)
+
+    train = train.batch(batch_size)
+    if augment is not None:
+        train = augmentation.apply(train, shape=grid_shape(categories), num_parallel_calls=settings.TRAINING_AUGMENT_PARALLEL_CALLS, **augment)
+    train = train.prefetch(tf.data.AUTOTUNE)
+    if validation is not None:
+        validation = validation.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    return train, validation, n
+
+def fold_of(category_ids, labels_of, k):
+    """Cross-validation fold per image, given its category ids in id order
+    The images of every category are dealt round-robin into the k folds, each category going on from the fold the
+    categories before it ended at, so each fold holds about 1/k of every category, no fold is empty with k images
+    or more, and the assignment is the same in every process.
+    """
+    counts = Counter(category_ids)
+    dealt, start = {}, 0
+    for category_id in sorted(labels_of, key=labels_of.get):
+        dealt[category_id] = start
+        start += counts[category_id]
+    folds = np.empty(len(category_ids), dtype='int64')
+    for index, category_id in enumerate(category_ids):
+        folds[index] = dealt[category_id] % k
+        dealt[category_id] += 1
+    return folds
+
+def folds(categories, k, fold, batch_size, augment=None):
+    """Training pipeline and holdout arrays of fold (0 <= fold < k) of a k-fold cross-validation
+    - augment (dict): augment.apply parameters, training batches get random transforms when given
+    Returns (tuple): shuffled and batched training dataset, (holdout features, holdout one-hot labels), training image count
+    """
+    rows = list(_image_rows(_images(categories), ('id', 'category_id', 'data')))
+    labels_of = {category.id: label for label, category in enumerate(categories)}
+    x, y = _arrays(categories, rows)
+
+    held_out = fold_of([category_id for _, category_id, _ in rows], labels_of, k) == fold
+    count = int((~held_out).sum())
+    train = tf.data.Dataset.from_tensor_slices((x[~held_out], y[~held_out]))
+    train = train.shuffle(max(count, 1), reshuffle_each_iteration=True).batch(batch_size)
+    if augment is not None:
+        train = augmentation.apply(train, shape=grid_shape(categories), num_parallel_calls=settings.TRAINING_AUGMENT_PARALLEL_CALLS, **augment)
+    return train.prefetch(tf.data.AUTOTUNE), (x[held_out], y[held_out]), count
+
+def holdout(categories, limit=None):
+    """Validation features and one-hot labels, the images is_validation holds out (the first limit of them)"""
+    images = _split(_images(categories), True).order_by('id').values_list('id', 'category_id', 'data')
+    return _arrays(categories, list(images[:limit]))
+
+def holdout_chunks(categories):
+    """The holdout of holdout() in arrays of up to CHUNK_SIZE images, for galleries too large to hold it at once"""
+    return _chunks(categories, _split(_images(categories), True))
+
+def shard(categories, shards, index, batch_size, augment=None):
+    """Training pipeline of one of shards disjoint parts of the training images (those is_validation keeps),
+    picked in the database by id (see _shard) so every process of a data-parallel run loads only its own part
+    - Galleries over TRAINING_IN_MEMORY_MAX_IMAGES images are streamed like build streams them
+    - augment (dict): augment.apply parameters, training batches get random transforms when given
+    Returns (tuple): shuffled and batched dataset, image count
+    """
+    images = _shard(_images(categories), shards, index)
+    count = images.count()
+    if count_images(categories) <= settings.TRAINING_IN_MEMORY_MAX_IMAGES:
+        train = tf.data.Dataset.from_tensor_slices(_arrays(categories, list(_image_rows(images, ('id', 'category_id', 'data')))))
+        train = train.shuffle(max(count, 1), reshuffle_each_iteration=True)
+    else:
+        train = _streamed(categories, images).shuffle(max(min(settings.TRAINING_SHUFFLE_BUFFER, count), 1), reshuffle_each_iteration=True)
+    train = train.batch(batch_size)
+    if augment is not None:
+        train = augmentation.apply(train, shape=grid_shape(categories), num_parallel_calls=settings.TRAINING_AUGMENT_PARALLEL_CALLS, **augment)
+    return train.prefetch(tf.data.AUTOTUNE), count
+
+def sample_features(dataset, count):
+    """First count feature rows of a batched dataset, used to check exported artifacts"""
+    rows = []
+    for x, _ in dataset:
+        rows.append(x.numpy())
+        if sum(len(r) for r in rows) >= count:
+            break
+    return np.concatenate(rows)[:count]
@@ -0,0 +1,128 @@
+import json
+import numpy as np
+
+# Pure NumPy forward pass for the Sequential/Dense networks built by CustomModel.build,
+# importing this module never pulls in TensorFlow.
+
+def relu(x):
+    return np.maximum(x, 0)
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def tanh(x):
+    return np.tanh(x)
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def linear(x):
+    return x
+
+ACTIVATIONS = {
+    'relu': relu,
+    'sigmoid': sigmoid,
+    'tanh': tanh,
+    'softmax': softmax,
+    'linear': linear,
+    None: linear,
+}
+
+class NumpyModel:
+    """Dense layers as (weights, bias, activation) triples, accepts a single row or a batch of rows"""
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype='float32')
+        if x.ndim == 1:
+            x = x.reshape(1, -1)
+        for weights, bias, activation in self.layers:
+            x = ACTIVATIONS[activation](x @ weights + bias)
+        return x
+
+    @property
+    def nbytes(self):
+        return sum(weights.nbytes + bias.nbytes for weights, bias, _ in self.layers)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a float artifact or a quantized one, quantized weights are turned back into float32 once here"""
+        with np.load(path) as data:
+            if 'layout' in data:
+                return cls(_unpack(json.loads(str(data['layout'])), data['weights'], data['floats']))
+            activations = json.loads(str(data['activations']))
+            layers = [(data[f'w{i}'], data[f'b{i}'], activation) for i, activation in enumerate(activations)]
+        return cls(layers)
+
+def export(keras_model, path):
+    """Pulls the weight and bias matrices out of a trained Sequential of Dense layers and saves them as .npz"""
+    arrays = {}
+    activations = []
+    for i, layer in enumerate(keras_model.layers):
+        activation = layer.get_config().get('activation')
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Unsupported activation for NumPy inference: {activation}")
+
+        weights, bias = layer.get_weights()
+        arrays[f'w{i}'] = weights.astype('float32')
+        arrays[f'b{i}'] = bias.astype('float32')
+        activations.append(activation)
+
+    with open(path, 'wb') as f:
+        np.savez(f, activations=json.dumps(activations), **arrays)
+    return NumpyModel.load(path)
+
+# Quantized artifacts pack every layer into three arrays, fewer members make np.load several times faster:
+#   layout:  JSON {"dtype", "activations", "shapes": [[inputs, outputs], ...]}
+#   weights: all weight matrices flattened, int8 or float16
+#   floats:  float32, per layer the bias and for int8 one symmetric scale per output column (weights = w * scale)
+
+def quantize(model: NumpyModel, path, dtype='int8'):
+    """Saves a quantized copy of a float model and returns it loaded back"""
+    if dtype not in ('int8', 'float16'):
+        raise ValueError(f"Unsupported quantization: {dtype}")
+
+    weights, floats = [], []
+    for w, bias, _ in model.layers:
+        floats.append(bias.astype('float32'))
+        if dtype == 'int8':
+            scale = np.abs(w).max(axis=0) / 127
+            scale[scale == 0] = 1
+            weights.append(np.round(w / scale).astype('int8').ravel())
+            floats.append(scale.astype('float32'))
+        else:
+            weights.append(w.astype('float16').ravel())
+
+    layout = {
+        'dtype': dtype,
+        'activations': [activation for _, _, activation in model.layers],
+        'shapes': [list(w.shape) for w, _, _ in model.layers],
+    }
+    with open(path, 'wb') as f:
+        np.savez(f, layout=json.dumps(layout), weights=np.concatenate(weights), floats=np.concatenate(floats))
+    return NumpyModel.load(path)
+
+def _unpack(layout, weights, floats):
+    layers = []
+    w_at = f_at = 0
+    for (inputs, outputs), activation in zip(layout['shapes'], layout['activations']):
+        w = weights[w_at:w_at + inputs * outputs].reshape(inputs, outputs).astype('float32')
+        w_at += inputs * outputs
+        bias = floats[f_at:f_at + outputs]
+        f_at += outputs
+        if layout['dtype'] == 'int8':
+            w *= floats[f_at:f_at + outputs]
+            f_at += outputs
+        layers.append((w, bias, activation))
+    return layers
+
+def agreement(reference, candidate, x):
+    """Share of the rows of x both models give the same label"""
+    return float(np.mean(reference(x).argmax(axis=-1) == candidate(x).argmax(axis=-1)))
+
+def max_difference(keras_model, engine, x):
+    """Largest absolute difference between Keras and NumPy outputs on the same inputs"""
+    expected = keras_model(x, training=False).numpy()
+    return float(np.abs(expected - engine(x)).max())
@@ -0,0 +1,227 @@
+import time
+import types
+import multiprocessing
+
+import numpy as np
+
+# Data-parallel training by parameter averaging over local processes.
+# Every worker holds a copy of the model with its own optimizer and trains one epoch on its shard of the training
+# images (dataset.shard), then the coordinator averages the weights, weighted by shard size, validates the average
+# and sends it back out for the next epoch. Only weights travel between processes, once per epoch, so the exchange
+# stays small next to an epoch of work. Early stopping and learning rate reduction watch the averaged model's
+# validation loss like the callbacks of CustomModel.train do.
+# Workers are spawned and import this module before Django is set up, so everything else is imported inside the functions.
+
+class WorkerError(RuntimeError):
+    pass
+
+class Patience:
+    """Counts epochs without an improvement of more than min_delta, like the Keras callbacks do"""
+    def __init__(self, patience, min_delta = 0.0):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = np.inf
+        self.wait = 0
+
+    def update(self, value):
+        """True when value improved on the best one so far"""
+        if value < self.best - self.min_delta:
+            self.best = value
+            self.wait = 0
+            return True
+        self.wait += 1
+        return False
+
+    def exhausted(self):
+        return self.wait >= self.patience
+
+def _worker(connection, network_id, shards, index, batch_size, augment, learning_rate, threads):
+    """Runs in a spawned process: answers ("ready", images) once its shard is loaded, then trains an epoch for every
+    (epoch, weights, learning rate) it receives and answers with (weights, images, seconds, logs), None ends it
+    """
+    from ..workers import init
+    init(threads)
+    from .. import jobs
+    from ..models import NeuralNetwork
+    from . import dataset
+
+    try:
+        nn = NeuralNetwork.objects.get(id=network_id)
+        categories = list(nn.categories.order_by('id'))
+        train, count = dataset.shard(categories, shards, index, batch_size, augment=augment)
+        user_model, _ = jobs.extract_nn_params(nn)
+        user_model.model.build((None, dataset.feature_size(categories)))
+        user_model.compile(learning_rate)
+    except Exception as e:
+        connection.send(WorkerError(f"Worker {index}: {e}"))
+        return
+    connection.send(('ready', count))
+
+    while True:
+        message = connection.recv()
+        if message is None:
+            return
+        epoch, weights, rate = message
+        try:
+            began = time.time()
+            user_model.model.set_weights(weights)
+            user_model.model.optimizer.learning_rate.assign(rate)
+            history = user_model.model.fit(train, epochs=epoch + 1, initial_epoch=epoch, shuffle=False, verbose=0)
+            logs = {name: float(values[-1]) for name, values in history.history.items()}
+            connection.send((user_model.model.get_weights(), count, time.time() - began, logs))
+        except Exception as e:
+            connection.send(WorkerError(f"Worker {index}: {e}"))
+
+def _receive(connection, deadline):
+    """Next answer of a worker, WorkerError when it exited or sent nothing before deadline (a time.time() value)"""
+    if not connection.poll(max(deadline - time.time(), 0)):
+        raise WorkerError("A worker did not answer within TRAINING_MAX_JOB_SECONDS")
+    try:
+        result = connection.recv()
+    except EOFError:
+        raise WorkerError("A worker exited without answering")
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def _validate(model, chunks, chunk_size = 4096):
+    """Loss and accuracy of the compiled model over (x, y) chunks, direct forward passes cost less than a model.evaluate call per epoch"""
+    import tensorflow as tf
+
+    loss = accuracy = count = 0.0
+    for x, y in chunks:
+        for start in range(0, len(x), chunk_size):
+            outputs = model(x[start:start + chunk_size], training=False).numpy()
+            targets = y[start:start + chunk_size]
+            # weighted by rows, the metrics come back per row or per value depending on the Keras version
+            loss += float(np.mean(tf.keras.losses.binary_crossentropy(targets, outputs))) * len(outputs)
+            accuracy += float(np.mean(tf.keras.metrics.binary_accuracy(targets, outputs))) * len(outputs)
+            count += len(outputs)
+    return loss / count, accuracy / count
+
+def train(user_model, nn, workers, learning_rate = 1e-3, epochs = 10, batch_size = 4, checkpoint_dir = None, progress = None,
+          initial_epoch = 0, early_stopping = None, reduce_lr = None, augment = None):
+    """Trains user_model (built, or loaded from a checkpoint) on the network's categories with workers processes
+    Takes the arguments of CustomModel.train, the images come from the network and workers split them.
+    Returns (SimpleNamespace): history and epoch like a Keras History, plus scaling (dict):
+    - workers (int), images (int): training images per epoch
+    - startup_seconds (float): spawning the workers and loading their shards
+    - samples_per_sec (float): training images per wall second once the workers were up
+    - compute_seconds, sync_seconds (float): per epoch, the mean time a worker trained and the time on top of the
+      slowest worker (exchanging and averaging weights, validating)
+    - efficiency (float): share of the workers' time spent training, 1.0 would be a perfect linear speedup
+    """
+    from django.conf import settings
+    from ..workers import threads_per_process
+    from . import dataset
+    from .train import EARLY_STOPPING, REDUCE_LR, EpochCheckpoint
+
+    categories = list(nn.categories.order_by('id'))
+    count = dataset.count_images(categories)
+    validation_count = count - dataset.training_images(categories)
+    # the holdout of an in-memory sized gallery is kept, a larger one is read again in chunks every epoch
+    validation = [dataset.holdout(categories)] if count <= settings.TRAINING_IN_MEMORY_MAX_IMAGES else None
+    model = user_model.model
+    if not model.built:
+        model.build((None, dataset.feature_size(categories)))
+    if not model.compiled:
+        user_model.compile(learning_rate)
+    rate = float(model.optimizer.learning_rate.numpy())
+
+    began = time.time()
+    deadline = began + settings.TRAINING_MAX_JOB_SECONDS
+    context = multiprocessing.get_context('spawn')
+    connections, processes = [], []
+    for index in range(workers):
+        parent, child = context.Pipe()
+        process = context.Process(target=_worker, daemon=True,
+                                  args=(child, nn.id, workers, index, batch_size, augment, rate, threads_per_process(workers)))
+        process.start()
+        # only the worker holds its end now, so the pipe reports EOF when the worker dies
+        child.close()
+        connections.append(parent)
+        processes.append(process)
+
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = EpochCheckpoint(checkpoint_dir)
+        checkpoint.set_model(model)
+    stopping = plateau = None
+    if early_stopping is not None:
+        options = {**EARLY_STOPPING, **early_stopping}
+        stopping = Patience(options['patience'], options['min_delta'])
+    if reduce_lr is not None:
+        reduce_options = {**REDUCE_LR, **reduce_lr}
+        plateau = Patience(reduce_options['patience'], 1e-4)  # the ReduceLROnPlateau default
+    monitor = 'val_loss' if validation_count else 'loss'
+
+    history, completed = {}, []
+    compute = sync = 0.0
+    try:
+        images = sum(_receive(connection, deadline)[1] for connection in connections)
+        startup = time.time() - began
+        began = time.time()
+
+        weights = best_weights = model.get_weights()
+        for epoch in range(initial_epoch, epochs):
+            started = time.time()
+            for connection in connections:
+                connection.send((epoch, weights, rate))
+            results = [_receive(connection, deadline) for connection in connections]
+
+            # shards differ by at most one image, weighting keeps the average exact for any split
+            shares = [count / images if images else 1 / workers for _, count, _, _ in results]
+            weights = [sum(share * result[0][layer] for share, result in zip(shares, results)) for layer in range(len(weights))]
+            model.set_weights(weights)
+
+            logs = {name: sum(share * result[3][name] for share, result in zip(shares, results)) for name in results[0][3]}
+            if validation_count:
+                logs['val_loss'], logs['val_accuracy'] = _validate(model, validation or dataset.holdout_chunks(categories))
+            logs['learning_rate'] = rate
+            for name, value in logs.items():
+                history.setdefault(name, []).append(value)
+            completed.append(epoch)
+
+            slowest = max(seconds for _, _, seconds, _ in results)
+            compute += sum(seconds for _, _, seconds, _ in results) / workers
+            sync += time.time() - started - slowest
+            if checkpoint is not None:
+                checkpoint.on_epoch_end(epoch)
+            if progress:
+                elapsed = time.time() - began
+                progress(status="Training", event='epoch', epoch=epoch + 1, epochs=epochs, workers=workers,
+                         samples_per_sec=images * len(completed) / elapsed, eta=elapsed / len(completed) * (epochs - epoch - 1), **logs)
+
+            if plateau is not None:
+                plateau.update(logs[monitor])
+                if plateau.exhausted():
+                    rate, plateau.wait = max(rate * reduce_options['factor'], reduce_options['min_lr']), 0
+            if stopping is not None:
+                if stopping.update(logs[monitor]):
+                    best_weights = weights
+                if stopping.exhausted():
+                    model.set_weights(best_weights)
+                    break
+    finally:
+        for connection in connections:
+            try:
+                connection.send(None)
+            except (OSError, ValueError):
+                pass
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    model.optimizer.learning_rate.assign(rate)
+    elapsed = time.time() - began
+    trained = len(completed) or 1
+    return types.SimpleNamespace(history=history, epoch=completed, scaling={
+        'workers': workers,
+        'images': images,
+        'startup_seconds': round(startup, 3),
+        'samples_per_sec': round(images * len(completed) / elapsed, 1) if elapsed else None,
+        'compute_seconds': round(compute / trained, 4),
+        'sync_seconds': round(sync / trained, 4),
+        'efficiency': round(compute / elapsed, 4) if elapsed else None,
+    })
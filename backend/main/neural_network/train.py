@@ -1,3 +1,7 @@
+import os
+import json
+import math
+import time
 import tensorflow as tf
 import numpy as np
 
@@ -5,11 +9,108 @@ from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense
 from tensorflow.keras.optimizers import Adam
 
+# Defaults for the early_stopping and reduce_lr options of CustomModel.train
+EARLY_STOPPING = {'patience': 3, 'min_delta': 0.0}
+REDUCE_LR = {'factor': 0.5, 'patience': 2, 'min_lr': 1e-6}
+
+def load_model(filepath):
+    return tf.keras.models.load_model(filepath)
+
+def latest_checkpoint(directory):
+    """(path, epochs completed) of the last epoch checkpoint in directory, None when there is none"""
+    try:
+        with open(os.path.join(directory, 'state.json')) as f:
+            epoch = json.load(f)['epoch']
+    except (OSError, ValueError, KeyError):
+        return None
+    path = os.path.join(directory, 'last.keras')
+    return (path, epoch) if os.path.exists(path) else None
+
 class Layer:
     def __init__(self, neurons_amount, activation_function):
         self.neurons_amount = neurons_amount
         self.activation_function = activation_function
 
+class ProgressCallback(tf.keras.callbacks.Callback):
+    """Reports loss, accuracy, throughput (samples/s) and ETA through publish(**metrics) while fit runs
+    - Batch updates are throttled to one per interval seconds, epoch updates are always sent
+    - samples (int): training images per epoch, the last batch of an epoch is counted with its real size
+    """
+    def __init__(self, publish, batch_size, interval = 0.5, samples = None):
+        super().__init__()
+        self.publish = publish
+        self.batch_size = batch_size
+        self.interval = interval
+        self.samples_per_epoch = samples
+
+    def on_train_begin(self, logs=None):
+        self.epochs = self.params.get('epochs')
+        self.steps = self.params.get('steps')
+        self.epoch = 0
+        self.first_epoch = None  # later than 0 when training continues a saved model
+        self.samples = 0
+        self.epoch_samples = 0
+        self.start = time.time()
+        self.last_publish = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_samples = 0
+        if self.first_epoch is None:
+            self.first_epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        size = self.batch_size
+        if self.samples_per_epoch is not None:
+            size = max(min(size, self.samples_per_epoch - self.epoch_samples), 0)
+        self.epoch_samples += size
+        self.samples += size
+        if time.time() - self.last_publish >= self.interval:
+            self._report('batch', batch + 1, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._report('epoch', self.steps, logs)
+
+    def _report(self, event, step, logs):
+        elapsed = time.time() - self.start
+        eta = None
+        if self.steps and step:
+            done = (self.epoch - self.first_epoch) * self.steps + step
+            eta = elapsed / done * ((self.epochs - self.first_epoch) * self.steps - done)
+
+        metrics = {name: float(value) for name, value in (logs or {}).items()}
+        self.last_publish = time.time()
+        self.publish(
+            status = "Training",
+            event = event,
+            epoch = self.epoch + 1,
+            epochs = self.epochs,
+            step = step,
+            steps = self.steps,
+            samples_per_sec = self.samples / elapsed if elapsed else None,
+            eta = eta,
+            **metrics
+        )
+
+class EpochCheckpoint(tf.keras.callbacks.Callback):
+    """Saves the model with its optimizer state after every epoch, training can resume from the last one
+    Files are written aside and renamed, a crash during the save leaves the previous checkpoint intact
+    """
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'last.keras')
+        self.model.save(path + '.tmp.keras')
+        os.replace(path + '.tmp.keras', path)
+
+        state = os.path.join(self.directory, 'state.json')
+        with open(state + '.tmp', 'w') as f:
+            json.dump({'epoch': epoch + 1}, f)
+        os.replace(state + '.tmp', state)
+
 class CustomModel:
     def __init__(self, input_shape, num_classes, model = None, model_name = None):
         self.input_shape = input_shape
@@ -22,28 +123,75 @@ class CustomModel:
         for layer in layers:
             self.model.add(Dense(layer.neurons_amount, activation=layer.activation_function))
 
-    def create_checkpoint(self, filepath):
-        checkpoint = tf.keras.callbacks.ModelCheckpoint(
-            filepath=filepath,
+    def compile(self, learning_rate = 1e-3):
+        self.model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=learning_rate), metrics=['accuracy'])
+
+    def create_checkpoint(self, directory):
+        """best.keras keeps the most accurate epoch, last.keras the latest one to resume from"""
+        best = tf.keras.callbacks.ModelCheckpoint(
+            filepath=os.path.join(directory, 'best.keras'),
             monitor='accuracy',
             save_best_only=True,
             mode='max',
             verbose=1
         )
-        return checkpoint
+        return [best, EpochCheckpoint(directory)]
+
+    def train(self, train_data, labels = None, learning_rate = 1e-3, epochs = 10, batch_size = 4, checkpoint_dir = None, progress = None,
+              validation_data = None, initial_epoch = 0, early_stopping = None, reduce_lr = None, samples = None):
+        """train_data is either an array (labels given, 20% is held out) or a batched tf.data.Dataset of (features, labels)
+        - A loaded model is already compiled and keeps its optimizer state, training continues from initial_epoch
+        - early_stopping (dict): stops once the validation loss stops improving and restores the best weights
+        - reduce_lr (dict): lowers the learning rate when the validation loss plateaus
+        Both take the keys of EARLY_STOPPING / REDUCE_LR and watch the training loss without a validation split.
+        - samples (int): training images per epoch of a dataset, for the progress throughput
+        """
+        if not self.model.compiled:
+            self.compile(learning_rate)
+        callbacks = self.create_checkpoint(checkpoint_dir) if checkpoint_dir else []
+
+        has_validation = validation_data is not None or not isinstance(train_data, tf.data.Dataset)
+        monitor = 'val_loss' if has_validation else 'loss'
+        if early_stopping is not None:
+            options = {**EARLY_STOPPING, **early_stopping}
+            callbacks.append(tf.keras.callbacks.EarlyStopping(
+                monitor=monitor, patience=options['patience'], min_delta=options['min_delta'], restore_best_weights=True))
+        if reduce_lr is not None:
+            options = {**REDUCE_LR, **reduce_lr}
+            callbacks.append(tf.keras.callbacks.ReduceLROnPlateau(
+                monitor=monitor, factor=options['factor'], patience=options['patience'], min_lr=options['min_lr']))
+
+        if progress:
+            if samples is None and not isinstance(train_data, tf.data.Dataset):
+                samples = math.ceil(len(train_data) * (1 - 0.2))  # what fit keeps before the validation split
+            callbacks.append(ProgressCallback(progress, batch_size, samples=samples))
+
+        if isinstance(train_data, tf.data.Dataset):
+            # the dataset is batched already and brings its own validation split
+            return self.model.fit(
+                train_data,
+                epochs = epochs,
+                initial_epoch = initial_epoch,
+                shuffle = False,
+                validation_data = validation_data,
+                callbacks = callbacks
+            )
 
-    def train(self, train_data, learning_rate = 1e-3, epochs = 10, batch_size = 4):
-        self.model.compile(loss='binary_crossentropy', optimizer=Adam(learning_rate=learning_rate), metrics=['accuracy'])
-        callback = self.create_checkpoint("models")
         history = self.model.fit(
             train_data,
+            labels,
             epochs = epochs,
+            initial_epoch = initial_epoch,
             batch_size = batch_size,
             validation_split = 0.2,
-            callbacks = [callback]
+            callbacks = callbacks
         )
         return history
 
+    def save(self, filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self.model.save(filepath)
+
     def evaluate(self, test_data):
         score = self.model.evaluate(test_data, verbose=False)
         print('Test loss:', score[0])
@@ -55,7 +203,7 @@ class CustomModel:
             self.model = tf.keras.models.load_model(model)
         elif model_name:
             self.model = tf.keras.models.load_model(f"{model_name}.h5")
-        else:
+        elif self.model is None:
             print("No model specified!")
             return
         return self.model.predict(test_data)
@@ -0,0 +1,19 @@
+import time
+
+from django.core.cache import caches
+
+PROGRESS_TIMEOUT = 60 * 60
+
+def _key(job_id):
+    return f"training-progress:{job_id}"
+
+def publish(job_id, **data):
+    """Stores the latest progress snapshot of a training job, readers only ever see the newest one"""
+    data['updated_at'] = time.time()
+    caches['shared'].set(_key(job_id), data, PROGRESS_TIMEOUT)
+
+def get(job_id):
+    return caches['shared'].get(_key(job_id))
+
+async def aget(job_id):
+    return await caches['shared'].aget(_key(job_id))
@@ -0,0 +1,134 @@
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import NeuralNetwork
+from .neural_network.engine import NumpyModel
+
+def load_model(path):
+    """NumPy artifacts are preferred, TensorFlow is only imported for networks without one"""
+    if path.endswith('.npz'):
+        return NumpyModel.load(path)
+
+    import tensorflow as tf
+    return tf.keras.models.load_model(path)
+
+def model_size(model):
+    if isinstance(model, NumpyModel):
+        return model.nbytes
+    return sum(w.nbytes for w in model.get_weights())
+
+def forward(model, batch):
+    """Runs a loaded model on a 2D batch and returns a NumPy array"""
+    if isinstance(model, NumpyModel):
+        return model(batch)
+    # calling a Keras model directly skips the per-call setup of model.predict
+    return model(batch, training=False).numpy()
+
+def artifact_path(nn: NeuralNetwork):
+    """Quantized artifact, then the float NumPy one, then Keras"""
+    for ext in ('q.npz', 'npz'):
+        path = nn.artifact_path(ext)
+        if os.path.exists(path):
+            return path
+    return nn.artifact_path()
+
+class ModelRegistry:
+    """Keeps loaded models in memory, keyed by NeuralNetwork.id
+    - Least recently used models are evicted once max_entries or max_bytes is exceeded
+    - An entry is reloaded when the artifact on disk is newer than the cached one (the network was retrained)
+    - get raises FileNotFoundError when the network has no artifact on disk (any more)
+    """
+    def __init__(self, max_entries, max_bytes, loader=load_model, sizeof=model_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # nn.id -> (model, size, (path, mtime))
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def get(self, nn: NeuralNetwork):
+        path = artifact_path(nn)
+        try:
+            version = (path, os.path.getmtime(path))
+        except FileNotFoundError:
+            self.invalidate(nn.id)
+            raise
+
+        cached = self._lookup(nn.id, version)
+        if cached is not None:
+            return cached
+
+        # one load per model, concurrent requests for the same model wait for it
+        with self.lock:
+            load_lock = self.load_locks.setdefault(nn.id, threading.Lock())
+        with load_lock:
+            cached = self._lookup(nn.id, version)
+            if cached is not None:
+                return cached
+
+            model = self.loader(path)
+            self._store(nn.id, model, self.sizeof(model), version)
+            return model
+
+    def invalidate(self, nn_id):
+        with self.lock:
+            self._remove(nn_id)
+
+    def warm(self, count):
+        """Loads the most used trained models, meant to run once at startup
+        Only networks with a NumPy artifact are loaded, a Keras one would import TensorFlow into the web process.
+        """
+        networks = NeuralNetwork.objects.filter(status="Trained").order_by('-predictions')[:count]
+        for nn in networks:
+            if not artifact_path(nn).endswith('.npz'):
+                continue
+            try:
+                self.get(nn)
+            except (OSError, ValueError):
+                continue  # trained before artifacts were kept or the file is gone
+
+    def _lookup(self, nn_id, version):
+        with self.lock:
+            entry = self.entries.get(nn_id)
+            if entry is None:
+                return None
+            if entry[2] != version:
+                self._remove(nn_id)
+                return None
+            self.entries.move_to_end(nn_id)
+            return entry[0]
+
+    def _store(self, nn_id, model, size, version):
+        with self.lock:
+            self._remove(nn_id)
+            self.entries[nn_id] = (model, size, version)
+            self.total_bytes += size
+
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, nn_id):
+        entry = self.entries.pop(nn_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+registry = ModelRegistry(settings.MODEL_REGISTRY_MAX_ENTRIES, settings.MODEL_REGISTRY_MAX_BYTES)
+
+@receiver(post_delete, sender=NeuralNetwork)
+def _forget_deleted(sender, instance, **kwargs):
+    registry.invalidate(instance.id)
+
+def warm_up():
+    """Starts warming the registry in the background, returns the thread (None when MODEL_REGISTRY_WARM is 0)"""
+    if settings.MODEL_REGISTRY_WARM:
+        thread = threading.Thread(target=registry.warm, args=(settings.MODEL_REGISTRY_WARM,), daemon=True, name='registry-warm')
+        thread.start()
+        return thread
+    return None
@@ -0,0 +1,114 @@
+import json
+
+import numpy as np
+
+from django.db.models import F
+
+from . import grids
+from .models import Image, NeuralNetwork
+from .neural_network.engine import NumpyModel
+from .registry import forward
+from .tensor_cache import tensor_cache
+
+# Batch prediction: rows are scored in chunks with one forward pass each and streamed back
+# as NDJSON, one line per row and a summary line at the end.
+
+CHUNK_SIZE = 1024  # images read and looked up in the tensor cache at once, independent of the batch size
+
+def labels(nn: NeuralNetwork):
+    """Class names in output order, training labels its categories by id"""
+    return list(nn.categories.order_by('id').values_list('name', flat=True))
+
+def input_size(model):
+    if isinstance(model, NumpyModel):
+        return model.layers[0][0].shape[0]
+    return model.input_shape[-1]
+
+def input_rows(inputs, size):
+    """(index, name, features or error) per client input: a feature vector, or a grid {"name", "data"}"""
+    for index, item in enumerate(inputs):
+        name = item.get('name') if isinstance(item, dict) else None
+        try:
+            if isinstance(item, dict):
+                features = grids.to_features(grids.decode_image(item))
+            else:
+                features = np.asarray(item, dtype='float32').reshape(-1)
+            if features.shape[0] != size:
+                raise ValueError(f"Expected {size} input values, got {features.shape[0]}")
+        except (ValueError, TypeError, KeyError) as e:
+            features = e
+        yield index, name, features
+
+def category_rows(category, size, chunk_size=CHUNK_SIZE):
+    """(index, name, features or error) per image of the category, features come from the tensor cache"""
+    rows = Image.objects.filter(category=category).order_by('id').values_list('name', 'data').iterator(chunk_size=chunk_size)
+    chunk = []
+    index = 0
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield from _cached(category.user_id, chunk, index, size)
+            index += len(chunk)
+            chunk = []
+    yield from _cached(category.user_id, chunk, index, size)
+
+def _grid_size(data):
+    _, _, _, rows, cols = grids.HEADER.unpack_from(bytes(data))
+    return rows * cols
+
+def _cached(user_id, chunk, start, size):
+    # images of another size than the network's input cannot be scored
+    fits = [_grid_size(data) == size for _, data in chunk]
+    x = np.empty((sum(fits), size), dtype='float32')
+    tensor_cache.fill(user_id, [data for (_, data), fit in zip(chunk, fits) if fit], x)
+
+    row = 0
+    for offset, ((name, _), fit) in enumerate(zip(chunk, fits)):
+        if fit:
+            yield start + offset, name, x[row]
+            row += 1
+        else:
+            yield start + offset, name, ValueError(f"Image size does not match the network's {size} inputs")
+
+def stream(nn: NeuralNetwork, model, rows, batch_size, top_k=0, expected=None):
+    """NDJSON lines for rows from input_rows or category_rows
+    - Every row: {"index", "name", "prediction"} plus "top_k" [{"label", "score"}] when top_k > 0, or {"index", "name", "error"}
+    - Last line: {"done": true, "count", "errors"} plus "accuracy" when expected (a label index) is given
+    """
+    names = labels(nn)
+    count = errors = correct = 0
+
+    def flush(batch):
+        # one chunk per batch, a write per row would cost more than the forward pass
+        nonlocal count, correct
+        outputs = forward(model, np.stack([features for _, _, features in batch]))
+        lines = []
+        for (index, name, _), output in zip(batch, outputs):
+            line = {'index': index, 'name': name, 'prediction': output.tolist()}
+            if top_k:
+                best = np.argsort(output)[::-1][:top_k]
+                line['top_k'] = [{'label': names[i] if i < len(names) else str(i), 'score': float(output[i])} for i in best]
+            if expected is not None:
+                correct += int(output.argmax() == expected)
+            count += 1
+            lines.append(json.dumps(line) + '\n')
+        return ''.join(lines)
+
+    batch = []
+    for index, name, features in rows:
+        if isinstance(features, Exception):
+            errors += 1
+            yield json.dumps({'index': index, 'name': name, 'error': str(features)}) + '\n'
+            continue
+        batch.append((index, name, features))
+        if len(batch) == batch_size:
+            yield flush(batch)
+            batch = []
+    if batch:
+        yield flush(batch)
+
+    NeuralNetwork.objects.filter(id=nn.id).update(predictions=F('predictions') + count)
+    summary = {'done': True, 'count': count, 'errors': errors}
+    if expected is not None:
+        summary['accuracy'] = correct / count if count else None
+    yield json.dumps(summary) + '\n'
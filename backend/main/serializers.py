@@ -1,10 +1,44 @@
+import base64
 from rest_framework import serializers
+from . import grids
 from .models import Category, Image
 
+class CompactGridField(serializers.Field):
+    """Image.data as base64 compact grid data, the old hex list form is accepted on input"""
+    def to_representation(self, value):
+        return base64.b64encode(bytes(value)).decode('ascii')
+
+    def to_internal_value(self, data):
+        try:
+            return grids.encode_binary(grids.decode_payload(data))
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+
+IMAGE_FIELDS = ['name', 'created_at', 'data', 'thumbnail']
+DEFAULT_IMAGE_FIELDS = ['name', 'created_at', 'data']
+
 class ImageSerializer(serializers.ModelSerializer):
+    """Only the fields listed in context["image_fields"] are rendered (all but thumbnail by default)
+    category is written by name, one of the requesting user's categories, and never rendered
+    """
+    data = CompactGridField()
+    thumbnail = serializers.SerializerMethodField()
+    category = serializers.SlugRelatedField(slug_field='name', queryset=Category.objects.all(), write_only=True)
+
     class Meta:
         model = Image
-        fields = ['name', 'created_at', 'image']
+        fields = IMAGE_FIELDS + ['category']
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        if request is not None:
+            fields['category'].queryset = Category.objects.filter(user=request.user)
+        selected = self.context.get('image_fields', DEFAULT_IMAGE_FIELDS)
+        return {name: field for name, field in fields.items() if name in selected or name == 'category'}
+
+    def get_thumbnail(self, img):
+        return grids.encode_payload(grids.thumbnail(grids.decode_binary(bytes(img.data))))
 
 class CategorySerializer(serializers.ModelSerializer):
     images = ImageSerializer(many=True, read_only=True)
@@ -13,3 +47,7 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = ['name', 'images']
 
+def parse_image_fields(value):
+    """Turns the fields= query parameter into a list of image fields, unknown names are ignored"""
+    selected = [name for name in (value or '').split(',') if name in IMAGE_FIELDS]
+    return selected or DEFAULT_IMAGE_FIELDS
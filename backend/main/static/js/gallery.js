@@ -5,6 +5,21 @@ const galleryModule = (() => {
 
     let chosenCategories = new Set();
 
+    // gallery version the local copy is based on, and the edits made since that have not reached the server
+    let galleryVersion = null;
+    let pendingChanges = {};
+
+    const pendingFor = (categoryName) => {
+        if (!pendingChanges[categoryName]) {
+            pendingChanges[categoryName] = { added: [], changed: [], removed: [] };
+        }
+        return pendingChanges[categoryName];
+    };
+
+    const setGalleryVersion = (version) => {
+        if (version !== undefined && version !== null) galleryVersion = Number(version);
+    };
+
     const updateCategoryDropdown = () => {
         categoryDropdown.innerHTML = '';
         Object.keys(categories).forEach((name) => {
@@ -20,6 +35,7 @@ const galleryModule = (() => {
         const name = prompt('Enter the new category name:', 'Category' + (Object.keys(categories).length + 1));
         if (name && !categories[name]) {
             categories[name] = [];
+            pendingFor(name);
             updateCategoryDropdown();
             renderGallery();
         } else {
@@ -51,7 +67,9 @@ const galleryModule = (() => {
                 });
 
                 if (response.ok) {
+                    setGalleryVersion((await response.json()).version);
                     delete categories[categoryName];
+                    delete pendingChanges[categoryName];
                     chosenCategories.delete(categoryName);
                     saveCategoriesToStorage();
                     updateCategoryDropdown();
@@ -156,7 +174,7 @@ const galleryModule = (() => {
             });
 
             if (response.ok) {
-                console.log(category, imageName, index);
+                setGalleryVersion((await response.json()).version);
                 categories[category].splice(index, 1);
                 saveCategoriesToStorage();
                 renderGallery();
@@ -170,41 +188,56 @@ const galleryModule = (() => {
         }
     };
 
+    // the listing is cursor-paginated; fields=name skips the grids when only image names are needed
+    const fetchAllCategories = async (fields) => {
+        let url = fields ? `/api/categories/?fields=${fields}` : '/api/categories/';
+        const results = [];
+
+        let version = null;
+
+        while (url) {
+            const response = await fetch(url, { credentials: 'include' });
+            if (!response.ok) throw new Error(response.statusText);
+            version = version ?? response.headers.get('X-Gallery-Version');
+
+            const page = await response.json();
+            results.push(...page.results);
+            url = page.next;
+        }
+        setGalleryVersion(version);
+        return results;
+    };
+
     const syncLocalStorageWithServer = async () => {
         try {
-            const response = await fetch('/api/categories/', { credentials: 'include' });
-            if (response.ok) {
-                const serverCategories = await response.json();
-                const serverImagesMap = {};
+            const serverCategories = await fetchAllCategories('name');
+            const serverImagesMap = {};
 
-                serverCategories.forEach(category => {
-                    serverImagesMap[category.name] = new Set(category.images.map(img => img.name));
-                });
+            serverCategories.forEach(category => {
+                serverImagesMap[category.name] = new Set(category.images.map(img => img.name));
+            });
 
-                let updated = false;
-
-                Object.keys(categories).forEach(category => {
-                    if (!serverImagesMap[category]) {
-                        delete categories[category];
-                        updated = true;
-                    } else {
-                        categories[category] = categories[category].filter(image => {
-                            if (!serverImagesMap[category].has(image.name)) {
-                                updated = true;
-                                return false;
-                            }
-                            return true;
-                        });
-                    }
-                });
+            let updated = false;
 
-                if (updated) {
-                    saveCategoriesToStorage();
-                    renderGallery();
-                    console.log("Local storage synced with server.");
+            Object.keys(categories).forEach(category => {
+                if (!serverImagesMap[category]) {
+                    delete categories[category];
+                    updated = true;
+                } else {
+                    categories[category] = categories[category].filter(image => {
+                        if (!serverImagesMap[category].has(image.name)) {
+                            updated = true;
+                            return false;
+                        }
+                        return true;
+                    });
                 }
-            } else {
-                console.error("Failed to fetch categories from server.");
+            });
+
+            if (updated) {
+                saveCategoriesToStorage();
+                renderGallery();
+                console.log("Local storage synced with server.");
             }
         } catch (error) {
             console.error("Error syncing with server:", error);
@@ -229,9 +262,11 @@ const galleryModule = (() => {
         const currentGrid = gridModule.getCurrentGrid();
 
         if (category && name && !categories[category].some((img) => img.name === name)) {
-            categories[category].push({ name, grid: JSON.parse(JSON.stringify(currentGrid)) });
+            const image = { name, grid: JSON.parse(JSON.stringify(currentGrid)) };
+            categories[category].push(image);
+            pendingFor(category).added.push(image);
             saveCategoriesToStorage();
-            saveCategoriesData();
+            syncChanges();
             renderGallery();
             console.log(`Image "${name}" saved to category "${category}".`);
         } else {
@@ -243,7 +278,7 @@ const galleryModule = (() => {
         const imageData = {
             name: categories[category][index].name,
             category: category,
-            data: JSON.stringify(categories[category][index].grid)
+            data: gridCodecModule.encode(categories[category][index].grid)
         };
 
         try {
@@ -254,7 +289,8 @@ const galleryModule = (() => {
             });
 
             if (response.ok) {
-                console.log(`Image "${name}" saved successfully.`);
+                setGalleryVersion((await response.json()).version);
+                console.log(`Image "${imageData.name}" saved successfully.`);
             } else {
                 const errorData = await response.json();
                 console.log(`Error: ${JSON.stringify(errorData)}`);
@@ -273,15 +309,25 @@ const galleryModule = (() => {
         });
     };
 
+    const encodeCategories = () => {
+        const encoded = {};
+        Object.entries(categories).forEach(([category, images]) => {
+            encoded[category] = images.map(image => ({ name: image.name, data: gridCodecModule.encode(image.grid) }));
+        });
+        return encoded;
+    };
+
     const saveCategoriesData = async () => {
         try {
             const response = await fetch('/api/save-categories/', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ categories })
+                body: JSON.stringify({ categories: encodeCategories() })
             });
 
             if (response.ok) {
+                setGalleryVersion((await response.json()).version);
+                pendingChanges = {};
                 console.log("Categories and images saved successfully.");
             } else {
                 const errorData = await response.json();
@@ -292,10 +338,62 @@ const galleryModule = (() => {
         }
     };
 
+    const encodeChanges = (changes) => {
+        const encoded = {};
+        const encodeImage = (image) => ({ name: image.name, data: gridCodecModule.encode(image.grid) });
+        Object.entries(changes).forEach(([category, change]) => {
+            encoded[category] = {
+                added: change.added.map(encodeImage),
+                changed: change.changed.map(encodeImage),
+                removed: change.removed
+            };
+        });
+        return encoded;
+    };
+
+    // sends only the pending edits; without a known version or when the server moved on, the whole gallery is saved instead
+    const syncChanges = async () => {
+        if (galleryVersion === null) return saveCategoriesData();
+
+        // edits made while the request is in flight collect in a fresh set for the next sync
+        const sent = pendingChanges;
+        pendingChanges = {};
+        const restore = () => {
+            Object.entries(sent).forEach(([category, change]) => {
+                const pending = pendingFor(category);
+                pending.added.unshift(...change.added);
+                pending.changed.unshift(...change.changed);
+                pending.removed.unshift(...change.removed);
+            });
+        };
+
+        try {
+            const response = await fetch('/api/save-categories/', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ base_version: galleryVersion, changes: encodeChanges(sent) })
+            });
+
+            if (response.ok) {
+                setGalleryVersion((await response.json()).version);
+                console.log("Gallery changes saved successfully.");
+            } else if (response.status === 409) {
+                await saveCategoriesData();
+            } else {
+                restore();
+                const errorData = await response.json();
+                console.log(`Error: ${JSON.stringify(errorData)}`);
+            }
+        } catch (error) {
+            restore();
+            console.error("Error saving gallery changes:", error);
+        }
+    };
+
     const loadCategories = (categoriesData) => {
         categories = {};
         categoriesData.forEach(category => {
-            categories[category.name] = category.images || [];
+            categories[category.name] = (category.images || []).map(image => ({ name: image.name, grid: gridCodecModule.toGrid(image) }));
         });
         updateCategoryDropdown();
         renderGallery();
@@ -314,14 +412,9 @@ const galleryModule = (() => {
         loadCategoriesFromStorage();
 
         try {
-            const response = await fetch('/api/categories/', { credentials: 'include' });
-            if (response.ok) {
-                const categoriesData = await response.json();
-                loadCategories(categoriesData);
-                saveCategoriesToStorage();
-            } else {
-                console.error("Failed to load categories:", response.statusText);
-            }
+            const categoriesData = await fetchAllCategories();
+            loadCategories(categoriesData);
+            saveCategoriesToStorage();
         } catch (error) {
             console.error("Error fetching categories:", error);
         }
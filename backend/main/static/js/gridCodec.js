@@ -0,0 +1,96 @@
+// Compact grid format shared with main/grids.py (version 1, integers big-endian):
+//   "NG" | version u8 | mode u8 | rows u16 | cols u16 | body
+//   mode 0 (rgb):     rows * cols * 3 bytes
+//   mode 1 (palette): colors - 1 u8 | colors * 3 bytes | pixel indices packed at 1, 2, 4 or 8 bits, MSB first
+const gridCodecModule = (() => {
+    const VERSION = 1;
+    const MODE_RGB = 0;
+    const MODE_PALETTE = 1;
+    const HEADER_SIZE = 8;
+
+    const indexBits = (colors) => colors <= 2 ? 1 : colors <= 4 ? 2 : colors <= 16 ? 4 : 8;
+
+    const hexToRgb = (hex) => [1, 3, 5].map(i => parseInt(hex.slice(i, i + 2), 16));
+
+    const rgbToHex = (r, g, b) => '#' + [r, g, b].map(v => v.toString(16).padStart(2, '0')).join('').toUpperCase();
+
+    const writeHeader = (bytes, mode, rows, cols) => {
+        bytes.set([0x4E, 0x47, VERSION, mode, rows >> 8, rows & 0xFF, cols >> 8, cols & 0xFF]);
+    };
+
+    const toBase64 = (bytes) => {
+        let binary = '';
+        for (let i = 0; i < bytes.length; i++) binary += String.fromCharCode(bytes[i]);
+        return btoa(binary);
+    };
+
+    const fromBase64 = (data) => Uint8Array.from(atob(data), c => c.charCodeAt(0));
+
+    const encode = (grid) => {
+        const rows = grid.length;
+        const cols = grid[0].length;
+        const cells = grid.flat().map(hex => hex.toUpperCase());
+
+        const palette = [...new Set(cells)];
+        if (palette.length > 256) {
+            const bytes = new Uint8Array(HEADER_SIZE + cells.length * 3);
+            writeHeader(bytes, MODE_RGB, rows, cols);
+            cells.forEach((hex, i) => bytes.set(hexToRgb(hex), HEADER_SIZE + i * 3));
+            return toBase64(bytes);
+        }
+
+        const bits = indexBits(palette.length);
+        const lookup = new Map(palette.map((hex, i) => [hex, i]));
+        const packedStart = HEADER_SIZE + 1 + palette.length * 3;
+        const bytes = new Uint8Array(packedStart + Math.ceil(cells.length * bits / 8));
+
+        writeHeader(bytes, MODE_PALETTE, rows, cols);
+        bytes[HEADER_SIZE] = palette.length - 1;
+        palette.forEach((hex, i) => bytes.set(hexToRgb(hex), HEADER_SIZE + 1 + i * 3));
+        cells.forEach((hex, i) => {
+            const bit = i * bits;
+            bytes[packedStart + (bit >> 3)] |= lookup.get(hex) << (8 - bits - (bit & 7));
+        });
+        return toBase64(bytes);
+    };
+
+    const decode = (data) => {
+        const bytes = fromBase64(data);
+        if (bytes[0] !== 0x4E || bytes[1] !== 0x47 || bytes[2] !== VERSION) throw new Error('Unknown grid format');
+
+        const mode = bytes[3];
+        const rows = (bytes[4] << 8) | bytes[5];
+        const cols = (bytes[6] << 8) | bytes[7];
+
+        let pixel;
+        if (mode === MODE_RGB) {
+            pixel = (i) => {
+                const at = HEADER_SIZE + i * 3;
+                return rgbToHex(bytes[at], bytes[at + 1], bytes[at + 2]);
+            };
+        } else {
+            const colors = bytes[HEADER_SIZE] + 1;
+            const palette = Array.from({ length: colors }, (_, i) => {
+                const at = HEADER_SIZE + 1 + i * 3;
+                return rgbToHex(bytes[at], bytes[at + 1], bytes[at + 2]);
+            });
+            const bits = indexBits(colors);
+            const packedStart = HEADER_SIZE + 1 + colors * 3;
+            pixel = (i) => {
+                const bit = i * bits;
+                return palette[(bytes[packedStart + (bit >> 3)] >> (8 - bits - (bit & 7))) & ((1 << bits) - 1)];
+            };
+        }
+
+        return Array.from({ length: rows }, (_, y) => Array.from({ length: cols }, (_, x) => pixel(y * cols + x)));
+    };
+
+    // server entries are {name, data}, entries stored before the compact format still carry {name, grid}
+    const toGrid = (image) => image.grid || decode(image.data);
+
+    return {
+        encode,
+        decode,
+        toGrid
+    };
+})();
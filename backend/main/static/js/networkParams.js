@@ -139,6 +139,66 @@ const networkParamsModule = (() => {
         return `Your current network parameters:\n\nLayers:\n${layerInfo}\n\nLoss: ${loss}\n\nCategories:\n${categoryInfo}`;
     };    
 
+    const showTrainingResult = (result) => {
+        document.getElementById('status-value').textContent = result.status;
+
+        if (result.status === 'Trained') {
+            document.getElementById('accuracy-value').textContent = result.accuracy.toFixed(2);
+            document.getElementById('loss-value').textContent = result.loss.toFixed(2);
+            loadModels();
+        } else if (result.status === 'Failed') {
+            console.error('Training failed:', result.error);
+        }
+    };
+
+    const formatProgress = (p) => {
+        const parts = [`epoch ${p.epoch}/${p.epochs}`];
+        if (p.steps) parts.push(`step ${p.step}/${p.steps}`);
+        if (p.loss !== undefined) parts.push(`loss ${p.loss.toFixed(3)}`);
+        if (p.accuracy !== undefined) parts.push(`acc ${p.accuracy.toFixed(2)}`);
+        if (p.samples_per_sec) parts.push(`${Math.round(p.samples_per_sec)} samples/s`);
+        if (p.eta !== null && p.eta !== undefined) parts.push(`ETA ${Math.ceil(p.eta)}s`);
+        return parts.join(', ');
+    };
+
+    // used when the progress stream cannot be reopened, the job status is read until it finishes
+    const pollTrainingJob = (jobId) => {
+        fetch(`/api/jobs/${jobId}/`)
+            .then(response => response.json())
+            .then(job => {
+                if (job.status === 'Trained' || job.status === 'Failed') showTrainingResult(job);
+                else {
+                    document.getElementById('status-value').textContent = job.status;
+                    setTimeout(() => pollTrainingJob(jobId), 2000);
+                }
+            })
+            .catch(() => setTimeout(() => pollTrainingJob(jobId), 5000));
+    };
+
+    const watchTrainingJob = (jobId) => {
+        const events = new EventSource(`/api/jobs/${jobId}/events/`);
+
+        events.addEventListener('progress', (e) => {
+            const p = JSON.parse(e.data);
+            document.getElementById('status-value').textContent = p.status;
+            document.getElementById('progress-value').textContent = formatProgress(p);
+        });
+
+        events.addEventListener('done', (e) => {
+            events.close();
+            showTrainingResult(JSON.parse(e.data));
+        });
+
+        events.onerror = () => {
+            // the browser reconnects by itself and the server replays the latest snapshot,
+            // only a stream it gave up on (readyState CLOSED) needs the polling fallback
+            if (events.readyState === EventSource.CLOSED) {
+                console.error('Lost connection to training progress stream, polling the job instead.');
+                pollTrainingJob(jobId);
+            }
+        };
+    };
+
     const sendNetworkConfigToBackend = () => {
         setNetworkName();
         if (networkName == "") return;
@@ -160,10 +220,11 @@ const networkParamsModule = (() => {
             })
             .then(response => response.json())
             .then(data => {
-                document.getElementById('accuracy-value').textContent = data.accuracy.toFixed(2);
-                document.getElementById('loss-value').textContent = data.loss.toFixed(2);
-                document.getElementById('status-value').textContent = data.status;
-                loadModels();
+                if (data.error && data.estimate) alert(data.error);  // over the training budget
+                if (data.error) throw new Error(data.error);
+                const seconds = data.estimate && data.estimate.total_seconds;
+                document.getElementById('status-value').textContent = seconds ? `${data.status} (about ${Math.ceil(seconds)}s)` : data.status;
+                watchTrainingJob(data.job_id);
             })
             .catch(error => console.error('Error:', error));
         }
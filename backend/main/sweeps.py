@@ -0,0 +1,216 @@
+import math
+import random
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import costs, jobs
+from .models import NeuralNetwork, Sweep, TrainingJob
+
+# Asynchronous successive halving (ASHA) over the training pool.
+# Every trial starts with the smallest epoch budget (rung 0). Whenever a trial finishes a rung,
+# the best 1/reduction of the trials that finished that rung may continue to the next budget,
+# resuming from their saved model. A slot left over starts a new configuration, so weak
+# configurations stop after a few epochs and only the promising ones get the full budget.
+
+_lock = threading.Lock()
+
+SPACE_KEYS = ('hidden_neurons', 'activation', 'learning_rate', 'batch_size')
+
+def rungs(min_epochs, max_epochs, reduction):
+    """Epoch budgets min_epochs * reduction**k that do not exceed max_epochs"""
+    budgets = [min_epochs]
+    while budgets[-1] * reduction <= max_epochs:
+        budgets.append(budgets[-1] * reduction)
+    return budgets
+
+def options(base, space):
+    """Option lists of the search space, missing keys keep the value of base
+    Raises ValueError for an option that is not a non-empty list of at most SWEEP_MAX_OPTIONS values.
+    """
+    if not isinstance(space, dict):
+        raise ValueError('space must be an object of option lists')
+    for key in SPACE_KEYS:
+        values = space.get(key)
+        if values is not None and not (isinstance(values, list) and 0 < len(values) <= settings.SWEEP_MAX_OPTIONS):
+            raise ValueError(f"{key} must be a list of 1 to {settings.SWEEP_MAX_OPTIONS} options")
+
+    _, *hidden, _ = base['layers']
+    return [
+        space.get('hidden_neurons') or [[layer['neurons'] for layer in hidden]],
+        space.get('activation') or [hidden[0]['activation'] if hidden else 'relu'],
+        space.get('learning_rate') or [base['loss']],
+        space.get('batch_size') or [base.get('batch_size', 'auto')],
+    ]
+
+def configurations(base, space, count):
+    """count distinct combinations of the search space in random order, as NeuralNetwork params
+    base is a merge_nn_config result, space has option lists for SPACE_KEYS:
+    - hidden_neurons (list): options for the hidden layers, each a list of neuron counts (or one count)
+    - activation (list): activation of the hidden layers
+    - learning_rate (list), batch_size (list)
+    Combinations are drawn by index, the product of the options is never built.
+    Input and output layers always come from base. Early stopping is off for trials,
+    the rungs already cut weak ones short and every trial must reach its budget.
+    """
+    choices = options(base, space)
+    total = math.prod(len(values) for values in choices)
+    return [configuration(base, _combination(choices, index)) for index in random.sample(range(total), min(count, total))]
+
+def _combination(choices, index):
+    """The index-th element of itertools.product(*choices)"""
+    combination = []
+    for values in reversed(choices):
+        index, position = divmod(index, len(values))
+        combination.append(values[position])
+    return combination[::-1]
+
+def configuration(base, combination):
+    input_layer, *_, output_layer = base['layers']
+    neurons, activation, learning_rate, batch_size = combination
+    neurons = neurons if isinstance(neurons, list) else [neurons]
+    hidden_layers = [
+        {'name': f"Hidden Layer {i + 1}", 'neurons': int(count), 'activation': activation}
+        for i, count in enumerate(neurons)
+    ]
+    return {
+        'layers': [input_layer, *hidden_layers, output_layer],
+        'loss': float(learning_rate),
+        'batch_size': batch_size if batch_size == 'auto' else int(batch_size),
+        'augment': base.get('augment', False),
+        'early_stopping': False,
+        'reduce_lr': base.get('reduce_lr', True)
+    }
+
+def create(user, name, base, categories, space, max_trials=None, min_epochs=1, max_epochs=jobs.TRAINING_EPOCHS, reduction=3):
+    """Creates a sweep over a random order of the search space (at most max_trials configurations) and starts it"""
+    if min_epochs < 1 or max_epochs < min_epochs or reduction < 2:
+        raise ValueError('Expected 1 <= min_epochs <= max_epochs and reduction >= 2')
+    if max_trials is not None and max_trials < 1:
+        raise ValueError('max_trials must be at least 1')
+    # every trial would fail on images of mixed sizes
+    costs.grid_shape(categories)
+
+    configs = configurations(base, space, min(max_trials or settings.SWEEP_MAX_TRIALS, settings.SWEEP_MAX_TRIALS))
+
+    sweep = Sweep.objects.create(user=user, name=name, pending=configs,
+                                 rungs=rungs(min_epochs, max_epochs, reduction), reduction=reduction)
+    sweep.categories.set(categories)
+
+    with _lock, transaction.atomic():
+        _advance(Sweep.objects.select_for_update().get(id=sweep.id))
+    # jobs are dispatched after the commit, pool processes must see them
+    jobs.dispatch()
+    sweep.refresh_from_db()
+    return sweep
+
+def on_job_done(job_id):
+    """Records the score of a finished trial and fills the free slots, called for every finished job"""
+    job = TrainingJob.objects.select_related('network').get(id=job_id)
+    if job.network.sweep_id is None:
+        return
+
+    with _lock, transaction.atomic():
+        sweep = Sweep.objects.select_for_update().get(id=job.network.sweep_id)
+        nn = NeuralNetwork.objects.get(id=job.network_id)
+        if job.status == "Trained" and nn.epochs in sweep.rungs:
+            score = nn.val_accuracy if nn.val_accuracy is not None else nn.accuracy
+            sweep.results.setdefault(str(nn.id), {})[str(sweep.rungs.index(nn.epochs))] = score
+        _advance(sweep)
+
+def _advance(sweep: Sweep):
+    if sweep.status != "Running":
+        return
+
+    trials = {str(nn.id): nn for nn in sweep.trials.all()}
+    active = sum(nn.status in ("Queued", "Training") for nn in trials.values())
+    over_budget = set()  # promotions the training budget refused, they keep their last rung
+
+    while active < settings.SWEEP_MAX_PARALLEL_TRIALS:
+        promotion = _promotion(sweep, trials, over_budget)
+        if promotion is not None:
+            nn, epochs = promotion
+        elif sweep.pending:
+            nn = NeuralNetwork.objects.create(
+                user=sweep.user, sweep=sweep, params=sweep.pending.pop(0), status="Queued",
+                name=f"{sweep.name} #{len(trials) + 1} ({sweep.id.hex[:8]})"
+            )
+            nn.categories.set(sweep.categories.all())
+            trials[str(nn.id)] = nn
+            epochs = sweep.rungs[0]
+        else:
+            break
+
+        if _queue(nn, epochs):
+            active += 1
+        elif promotion is not None:
+            over_budget.add(str(nn.id))
+
+    if active == 0:
+        # nothing left to try, the best trial still gets the full budget before the sweep ends
+        best = _best(sweep, trials)
+        if not (best is not None and best.epochs < sweep.rungs[-1] and best.status == "Trained" and _queue(best, sweep.rungs[-1])):
+            sweep.best = best
+            sweep.status = "Finished"
+            sweep.finished_at = timezone.now()
+    sweep.save()
+
+def _queue(nn, epochs):
+    """Queues the trial for epochs, False when it is over the training budget
+    A new trial over the budget fails, a trained one stays as it is
+    """
+    try:
+        jobs.create_job(nn, epochs)
+    except costs.OverBudget:
+        if nn.epochs == 0:
+            nn.status = "Failed"
+            nn.save(update_fields=['status'])
+        return False
+    nn.status = "Queued"
+    return True
+
+def _promotion(sweep: Sweep, trials, skip=()):
+    """A trial in the top 1/reduction of a rung that has not moved on yet, higher rungs first"""
+    for rung in reversed(range(len(sweep.rungs) - 1)):
+        finished = sorted(((scores[str(rung)], nn_id) for nn_id, scores in sweep.results.items() if str(rung) in scores), reverse=True)
+        for _, nn_id in finished[:len(finished) // sweep.reduction]:
+            nn = trials.get(nn_id)
+            if nn is not None and nn_id not in skip and nn.status == "Trained" and nn.epochs == sweep.rungs[rung]:
+                return nn, sweep.rungs[rung + 1]
+    return None
+
+def _best(sweep: Sweep, trials):
+    """Trial with the best score on the highest rung any trial reached"""
+    ranked = [
+        (max(int(rung) for rung in scores), scores[str(max(int(rung) for rung in scores))], nn_id)
+        for nn_id, scores in sweep.results.items() if scores and nn_id in trials
+    ]
+    return trials[max(ranked)[2]] if ranked else None
+
+def summary(sweep: Sweep):
+    trials = list(sweep.trials.order_by('id'))
+    total = len(trials) + len(sweep.pending)
+    return {
+        'sweep_id': str(sweep.id),
+        'name': sweep.name,
+        'status': sweep.status,
+        'rungs': sweep.rungs,
+        'reduction': sweep.reduction,
+        'best_network_id': sweep.best_id,
+        'trials': [{
+            'network_id': nn.id,
+            'status': nn.status,
+            'hidden_neurons': [layer['neurons'] for layer in nn.params['layers'][1:-1]],
+            'activation': nn.params['layers'][1]['activation'] if len(nn.params['layers']) > 2 else None,
+            'learning_rate': nn.params['loss'],
+            'batch_size': nn.params['batch_size'],
+            'epochs': nn.epochs,
+            'scores': sweep.results.get(str(nn.id), {})
+        } for nn in trials],
+        'pending': len(sweep.pending),
+        # compute spent so far against training every configuration for the full budget
+        'epochs_used': sum(nn.epochs for nn in trials),
+        'grid_epochs': total * sweep.rungs[-1]
+    }
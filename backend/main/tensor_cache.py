@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.core.signals import setting_changed
+
+from . import grids
+
+# Decoded training features (grids.to_features of an image) kept on disk between training runs.
+# Every user has a directory of blocks, each block is one float32 .npy of shape (rows, features)
+# opened as a memmap, and index.json maps the content hash of an image to (block, row).
+# Images with the same content share a row, whole blocks are evicted least recently used first.
+# Every read-modify-write of a user's index holds an flock on the user's lock file, so training processes
+# filling the cache at once neither lose each other's entries nor leave blocks the index does not list.
+# A fill that finds every image only takes the lock shared and leaves index.json alone, the parsed index
+# is kept per process until the file is replaced. Block use times are only written once they are
+# USED_RESOLUTION old, eviction order does not need finer times.
+
+FEATURES_VERSION = 1  # bump when grids.to_features changes, old entries stop matching
+USED_RESOLUTION = 60  # seconds
+
+def content_hash(data):
+    return hashlib.sha1(bytes([FEATURES_VERSION]) + bytes(data)).hexdigest()
+
+class TensorCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.indexes = {}  # user_id -> (stat of index.json, parsed index), read-only copies for hits
+
+    def fill(self, user_id, blobs, out, positions=None):
+        """Writes the features of every compact grid in blobs into out[positions[i]] (out[i] by default)
+        Cached rows are gathered straight from the memmaps, the rest is decoded once and added as a new block.
+        Returns (int): number of images that had to be decoded
+        """
+        positions = np.arange(len(blobs)) if positions is None else np.asarray(positions)
+        hashes = [content_hash(data) for data in blobs]
+        with self._locked(user_id, fcntl.LOCK_SH):
+            if self._hit(user_id, self._cached_index(user_id), blobs, out, positions, hashes):
+                return 0
+        with self._locked(user_id):
+            return self._fill(user_id, blobs, out, positions, hashes)
+
+    def put(self, user_id, blobs, features):
+        """Adds already decoded features (one row per compact grid in blobs) for the images the cache does not have
+        Returns (int): number of rows added
+        """
+        missing = {}
+        for data, row in zip(blobs, features):
+            missing.setdefault(content_hash(data), row)
+        with self._locked(user_id):
+            index = self._load_index(user_id)
+            missing = {key: row for key, row in missing.items() if key not in index['entries']}
+            if missing:
+                self._write_block(user_id, index, list(missing), np.stack(list(missing.values())))
+                self._evict(user_id, index, keep=set())
+                self._save_index(user_id, index)
+        return len(missing)
+
+    def clear(self, user_id):
+        directory = self._directory(user_id)
+        if os.path.isdir(directory):
+            with self._locked(user_id):
+                for name in os.listdir(directory):
+                    if name != 'lock':
+                        os.remove(os.path.join(directory, name))
+
+    def usage(self, user_id):
+        return sum(block['bytes'] for block in self._load_index(user_id)['blocks'].values())
+
+    def _hit(self, user_id, index, blobs, out, positions, hashes):
+        """Serves the fill from the cache alone under the shared lock
+        False when an image is missing or the use of one of its blocks is due to be recorded, nothing is written then
+        """
+        entries = index['entries']
+        if any(key not in entries for key in hashes):
+            return False
+        by_block = self._by_block(entries, hashes)
+        stale = time.time() - USED_RESOLUTION
+        if any(index['blocks'][block]['used'] < stale for block in by_block):
+            return False
+        self._gather(user_id, entries, by_block, blobs, out, positions, hashes)
+        return True
+
+    def _fill(self, user_id, blobs, out, positions, hashes):
+        index = self._load_index(user_id)
+        entries = index['entries']
+
+        missing = {}
+        for i, key in enumerate(hashes):
+            if key not in entries:
+                missing.setdefault(key, i)
+        if missing:
+            self._add_block(user_id, index, {key: blobs[i] for key, i in missing.items()})
+
+        by_block = self._by_block(entries, hashes)
+        self._gather(user_id, entries, by_block, blobs, out, positions, hashes)
+
+        now = time.time()
+        touched = [block for block in by_block if index['blocks'][block]['used'] < now - USED_RESOLUTION]
+        for block in touched:
+            index['blocks'][block]['used'] = now
+
+        evicted = self._evict(user_id, index, keep=set(by_block))
+        if missing or touched or evicted:
+            self._save_index(user_id, index)
+        return len(missing)
+
+    def _by_block(self, entries, hashes):
+        by_block = {}
+        for i, key in enumerate(hashes):
+            by_block.setdefault(entries[key][0], []).append(i)
+        return by_block
+
+    def _gather(self, user_id, entries, by_block, blobs, out, positions, hashes):
+        for block, items in by_block.items():
+            rows = [entries[hashes[i]][1] for i in items]
+            try:
+                out[positions[items]] = self._open(user_id, block)[rows]
+            except OSError:
+                # the block file was removed behind the cache's back
+                for i in items:
+                    out[positions[i]] = grids.to_features(grids.decode_binary(bytes(blobs[i])))
+
+    def _add_block(self, user_id, index, blobs_by_hash):
+        # grids of different sizes cannot share a 2D block
+        by_size = {}
+        for key, data in blobs_by_hash.items():
+            features = grids.to_features(grids.decode_binary(bytes(data)))
+            by_size.setdefault(features.shape[-1], []).append((key, features))
+
+        for items in by_size.values():
+            self._write_block(user_id, index, [key for key, _ in items], np.stack([features for _, features in items]))
+
+    def _write_block(self, user_id, index, keys, features):
+        os.makedirs(self._directory(user_id), exist_ok=True)
+        block = uuid.uuid4().hex
+        path = self._path(user_id, block)
+        array = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype='float32', shape=features.shape)
+        array[:] = features
+        array.flush()
+        del array
+        os.replace(path + '.tmp', path)
+
+        index['blocks'][block] = {'bytes': os.path.getsize(path), 'used': time.time()}
+        for row, key in enumerate(keys):
+            index['entries'][key] = (block, row)
+
+    def _evict(self, user_id, index, keep):
+        """Drops least recently used blocks over max_bytes and files no block lists, returns whether the index changed"""
+        blocks = index['blocks']
+        before = len(blocks)
+        total = sum(block['bytes'] for block in blocks.values())
+        for block in sorted(blocks, key=lambda name: blocks[name]['used']):
+            if total <= self.max_bytes:
+                break
+            if block in keep:
+                continue
+            total -= blocks.pop(block)['bytes']
+            try:
+                os.remove(self._path(user_id, block))
+            except FileNotFoundError:
+                pass
+
+        evicted = len(blocks) < before
+        if evicted:
+            index['entries'] = {key: entry for key, entry in index['entries'].items() if entry[0] in blocks}
+
+        # blocks and temporary files of a process that died before saving the index
+        directory = self._directory(user_id)
+        for name in os.listdir(directory):
+            block = name.split('.')[0]
+            if name.endswith(('.npy', '.npy.tmp')) and block not in blocks:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return evicted
+
+    def _open(self, user_id, block):
+        return np.load(self._path(user_id, block), mmap_mode='r')
+
+    def _directory(self, user_id):
+        return os.path.join(self.root, str(user_id))
+
+    def _path(self, user_id, block):
+        return os.path.join(self._directory(user_id), f"{block}.npy")
+
+    @contextmanager
+    def _locked(self, user_id, mode=fcntl.LOCK_EX):
+        """Holds the user's lock file, exclusively by default, across processes"""
+        os.makedirs(self._directory(user_id), exist_ok=True)
+        with open(os.path.join(self._directory(user_id), 'lock'), 'w') as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _cached_index(self, user_id):
+        """The parsed index, parsed again only when index.json was replaced, must not be modified"""
+        try:
+            stat = os.stat(os.path.join(self._directory(user_id), 'index.json'))
+        except OSError:
+            return {'blocks': {}, 'entries': {}}
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self.indexes.get(user_id)
+        if cached is None or cached[0] != key:
+            cached = self.indexes[user_id] = (key, self._load_index(user_id))
+        return cached[1]
+
+    def _load_index(self, user_id):
+        try:
+            with open(os.path.join(self._directory(user_id), 'index.json')) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {'blocks': {}, 'entries': {}}
+        index['entries'] = {key: tuple(entry) for key, entry in index['entries'].items()}
+        return index
+
+    def _save_index(self, user_id, index):
+        # written aside and renamed so concurrent readers never see half an index
+        path = os.path.join(self._directory(user_id), 'index.json')
+        os.makedirs(self._directory(user_id), exist_ok=True)
+        with open(path + f'.{os.getpid()}.tmp', 'w') as f:
+            f.write(json.dumps(index))  # dumps uses the C encoder, dump streams through the Python one
+        os.replace(path + f'.{os.getpid()}.tmp', path)
+
+tensor_cache = TensorCache(settings.TENSOR_CACHE_DIR, settings.TENSOR_CACHE_MAX_BYTES)
+
+@receiver(setting_changed)
+def _follow_settings(setting, value, **kwargs):
+    """Keeps the shared instance in step with override_settings, so tests do not write into the default directory"""
+    if setting == 'TENSOR_CACHE_DIR':
+        tensor_cache.root = value
+        tensor_cache.indexes.clear()
+    elif setting == 'TENSOR_CACHE_MAX_BYTES':
+        tensor_cache.max_bytes = value
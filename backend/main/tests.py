@@ -1,3 +1,1151 @@
-from django.test import TestCase
+import io
+import json
+import asyncio
+import os
+import sys
+import time
+import types
+import tempfile
+import zipfile
+import threading
+import subprocess
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from PIL import Image as PILImage
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import grids
+from .models import Category, Image, NeuralNetwork, TrainingJob
+
+_isolation = []
+
+def setUpModule():
+    """Points the tensor cache, the shared cache and uploads at a temporary directory for the whole module
+    The environment variables reach the spawned training processes, override_settings only this one.
+    """
+    directory = tempfile.TemporaryDirectory()
+    paths = {name: os.path.join(directory.name, name) for name in ('tensor_cache', 'cache', 'uploads')}
+    environ = mock.patch.dict(os.environ, {'TENSOR_CACHE_DIR': paths['tensor_cache'], 'SHARED_CACHE_DIR': paths['cache']})
+    caches = {**settings.CACHES, 'shared': {**settings.CACHES['shared'], 'LOCATION': paths['cache']}}
+    overrides = override_settings(TENSOR_CACHE_DIR=paths['tensor_cache'], CACHES=caches, MEDIA_ROOT=paths['uploads'])
+    environ.start()
+    overrides.enable()
+    _isolation.extend([overrides.disable, environ.stop, directory.cleanup])
+
+def tearDownModule():
+    for undo in _isolation:
+        undo()
+    _isolation.clear()
+
+def make_images(user, category_name, count, size=4, seed=0):
+    """count random size x size images in a new category of user"""
+    rng = np.random.default_rng(seed)
+    category = Category.objects.create(user=user, name=category_name)
+    Image.objects.bulk_create([
+        Image(category=category, name=f"{category_name}-{i}", data=grids.encode_binary(rng.integers(0, 2, (size, size, 3), dtype='uint8') * 255))
+        for i in range(count)
+    ])
+    return category
+
+class WorkerPoolTests(SimpleTestCase):
+    def test_pool_starts_when_main_module_does_not_set_up_django(self):
+        # like manage.py or an app server: spawned workers load their initializer before Django is set up
+        script = (
+            "import django\n"
+            "if __name__ == '__main__':\n"
+            "    django.setup()\n"
+            "    from main import jobs\n"
+            "    print(jobs.get_executor().submit(sum, [1, 2]).result(timeout=120))\n"
+        )
+        result = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=180)
+        self.assertEqual(result.stdout.strip(), '3', result.stderr[-2000:])
+
+class ProgressCallbackTests(SimpleTestCase):
+    def test_last_partial_batch_counts_its_real_size(self):
+        from .neural_network.train import ProgressCallback
+
+        callback = ProgressCallback(lambda **metrics: None, batch_size=4, interval=0, samples=10)
+        callback.set_params({'epochs': 2, 'steps': 3})
+        callback.on_train_begin()
+        for epoch in range(2):
+            callback.on_epoch_begin(epoch)
+            for batch in range(3):
+                callback.on_train_batch_end(batch)
+            callback.on_epoch_end(epoch)
+        self.assertEqual(callback.samples, 20)
+
+class EarlyStoppingTests(SimpleTestCase):
+    def test_best_validation_weights_are_restored(self):
+        import tensorflow as tf
+        from .neural_network.train import CustomModel, Layer
+
+        tf.keras.utils.set_random_seed(0)
+        rng = np.random.default_rng(0)
+        x = rng.random((64, 8), dtype='float32')
+        y = np.eye(2, dtype='float32')[(x[:, 0] > 0.5).astype(int)]
+        # the validation labels are flipped, the better the fit the worse the validation loss
+        train = tf.data.Dataset.from_tensor_slices((x, y)).batch(16)
+        validation = tf.data.Dataset.from_tensor_slices((x, y[:, ::-1])).batch(16)
+
+        user_model = CustomModel(8, 2)
+        user_model.build([Layer(16, 'relu'), Layer(2, 'softmax')])
+        history = user_model.train(train, learning_rate=0.05, epochs=30, validation_data=validation,
+                                   early_stopping={'patience': 2})
+
+        self.assertLess(len(history.epoch), 30)
+        restored = user_model.model.evaluate(validation, verbose=0)[0]
+        self.assertAlmostEqual(restored, min(history.history['val_loss']), places=4)
+        self.assertLess(restored, history.history['val_loss'][-1])
+
+class TrainingImagesTests(TestCase):
+    def test_database_count_matches_the_validation_split(self):
+        from .neural_network import dataset
+
+        category = make_images(User.objects.create(username='u'), 'a', 23)
+        ids = category.images.values_list('id', flat=True)
+        self.assertEqual(dataset.training_images([category]), sum(not dataset.is_validation(i) for i in ids))
+
+class RegistryWarmTests(TestCase):
+    def test_only_numpy_artifacts_are_warmed(self):
+        from .registry import ModelRegistry
+
+        user = User.objects.create(username='u')
+        with tempfile.TemporaryDirectory() as models_dir, override_settings(MODELS_DIR=models_dir):
+            networks = {}
+            for name, ext in (('keras-only', 'keras'), ('numpy', 'npz'), ('quantized', 'q.npz')):
+                nn = NeuralNetwork.objects.create(user=user, name=name, params={}, status="Trained")
+                os.makedirs(os.path.dirname(nn.artifact_path(ext)), exist_ok=True)
+                open(nn.artifact_path(ext), 'wb').close()
+                networks[name] = nn
+
+            loaded = []
+            registry = ModelRegistry(10, 1 << 30, loader=lambda path: loaded.append(path) or object(), sizeof=lambda model: 1)
+            registry.warm(10)
+            self.assertEqual(sorted(loaded), sorted([networks['numpy'].artifact_path('npz'), networks['quantized'].artifact_path('q.npz')]))
+
+class MissingArtifactTests(TestCase):
+    def setUp(self):
+        settings_override = override_settings(MODELS_DIR=tempfile.mkdtemp())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create(username='u')
+        self.client.force_login(self.user)
+        self.nn = NeuralNetwork.objects.create(user=self.user, name='gone', params={}, status="Trained")
+
+    def test_predict_answers_409_without_an_artifact(self):
+        for url, body in (('/api/predict/', {'model_id': self.nn.id, 'input': [0.0]}),
+                          ('/api/predict/batch/', {'model_id': self.nn.id, 'inputs': [[0.0]]})):
+            response = self.client.post(url, body, content_type='application/json')
+            self.assertEqual(response.status_code, 409, url)
+
+    def test_deleting_a_network_drops_its_loaded_model(self):
+        from .registry import registry
+
+        nn_id = self.nn.id
+        registry._store(nn_id, object(), 1, ('path', 0))
+        self.nn.delete()
+        self.assertNotIn(nn_id, registry.entries)
+
+class PredictBatchTests(TestCase):
+    def setUp(self):
+        from .neural_network.engine import NumpyModel
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        models_dir = override_settings(MODELS_DIR=directory.name)
+        models_dir.enable()
+        self.addCleanup(models_dir.disable)
+
+        self.user = User.objects.create(username='u')
+        self.client.force_login(self.user)
+        self.categories = [make_images(self.user, 'a', 5, seed=1), make_images(self.user, 'b', 3, seed=2)]
+        Image.objects.create(category=self.categories[0], name='large', data=grids.encode_binary(np.zeros((6, 6, 3), dtype='uint8')))
+        self.nn = NeuralNetwork.objects.create(user=self.user, name='n', params={}, status="Trained")
+        self.nn.categories.set(self.categories)
+
+        rng = np.random.default_rng(0)
+        os.makedirs(os.path.dirname(self.nn.artifact_path('npz')), exist_ok=True)
+        with open(self.nn.artifact_path('npz'), 'wb') as f:
+            np.savez(f, activations='["softmax"]', w0=rng.normal(size=(16, 2)).astype('float32'), b0=np.zeros(2, dtype='float32'))
+        self.model = NumpyModel.load(self.nn.artifact_path('npz'))
+
+    def lines(self, **body):
+        response = self.client.post('/api/predict/batch/', {'model_id': self.nn.id, 'batch_size': 2, **body},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_inputs_stream_a_line_per_row_with_top_k(self):
+        rng = np.random.default_rng(3)
+        vectors = rng.random((3, 16), dtype='float32')
+        inputs = [vectors[0].tolist(), [0.5] * 3, {'name': 'grid', 'data': grids.encode_payload(np.zeros((4, 4, 3), dtype='uint8'))},
+                  vectors[1].tolist(), vectors[2].tolist()]
+        *rows, summary = self.lines(inputs=inputs, top_k=1)
+
+        self.assertEqual(sorted(row['index'] for row in rows), [0, 1, 2, 3, 4])
+        by_index = {row['index']: row for row in rows}
+        self.assertIn('Expected 16 input values', by_index[1]['error'])
+        for index, vector in ((0, vectors[0]), (3, vectors[1]), (4, vectors[2])):
+            output = self.model(vector)[0]
+            np.testing.assert_allclose(by_index[index]['prediction'], output, rtol=1e-5)
+            self.assertEqual(by_index[index]['top_k'][0]['label'], 'ab'[output.argmax()])
+        self.assertEqual(by_index[2]['name'], 'grid')
+        self.assertEqual(summary, {'done': True, 'count': 4, 'errors': 1})
+        self.nn.refresh_from_db()
+        self.assertEqual(self.nn.predictions, 4)
+
+    def test_category_summary_has_the_accuracy(self):
+        *rows, summary = self.lines(category='a')
+
+        errors = [row for row in rows if 'error' in row]
+        self.assertEqual([row['name'] for row in errors], ['large'])
+        features = grids.to_features(np.stack([grids.decode_binary(bytes(data)) for data in
+                                               Image.objects.filter(category__name='a').exclude(name='large').order_by('id').values_list('data', flat=True)]))
+        expected = float(np.mean(self.model(features).argmax(axis=1) == 0))
+        self.assertEqual((summary['count'], summary['errors']), (5, 1))
+        self.assertAlmostEqual(summary['accuracy'], expected)
+
+class MicroBatcherTests(SimpleTestCase):
+    def predict_concurrently(self, batcher, rows, predict_fn):
+        async def call_all():
+            return await asyncio.gather(*(batcher.predict('model', predict_fn, row) for row in rows), return_exceptions=True)
+        return asyncio.run(call_all())
+
+    def test_callers_get_their_own_row_of_a_shared_batch(self):
+        from .batching import MicroBatcher
+
+        batcher = MicroBatcher(max_batch_size=8, max_wait_ms=200)
+        rows = [np.full(3, index, dtype='float32') for index in range(8)]
+        results = self.predict_concurrently(batcher, rows, lambda batch: batch * 2)
+
+        for row, result in zip(rows, results):
+            np.testing.assert_array_equal(result, row * 2)
+        self.assertEqual(batcher.stats()['requests'], 8)
+        self.assertEqual(batcher.stats()['batches'], 1)
+
+    def test_rows_beyond_max_batch_size_go_into_the_next_batch(self):
+        from .batching import MicroBatcher
+
+        batcher = MicroBatcher(max_batch_size=4, max_wait_ms=50)
+        rows = [np.full(3, index, dtype='float32') for index in range(10)]
+        results = self.predict_concurrently(batcher, rows, lambda batch: batch + 1)
+
+        for row, result in zip(rows, results):
+            np.testing.assert_array_equal(result, row + 1)
+        self.assertEqual(batcher.stats()['batches'], 3)
+        self.assertEqual(batcher.stats()['queue_depth'], 0)
+
+    def test_a_row_of_another_length_does_not_fail_the_others(self):
+        from .batching import MicroBatcher
+
+        def predict_fn(batch):
+            if batch.shape[1] != 3:
+                raise ValueError("Bad input size")
+            return batch + 1
+
+        batcher = MicroBatcher(max_batch_size=8, max_wait_ms=200)
+        rows = [np.zeros(3, dtype='float32') for _ in range(4)] + [np.zeros(5, dtype='float32')]
+        results = self.predict_concurrently(batcher, rows, predict_fn)
+
+        for result in results[:4]:
+            np.testing.assert_array_equal(result, np.ones(3))
+        self.assertIsInstance(results[4], ValueError)
+
+class PredictViewTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        models_dir = override_settings(MODELS_DIR=directory.name)
+        models_dir.enable()
+        self.addCleanup(models_dir.disable)
+
+        self.user = User.objects.create(username='u')
+        self.nn = NeuralNetwork.objects.create(user=self.user, name='n', params={}, status="Trained")
+        os.makedirs(os.path.dirname(self.nn.artifact_path('npz')), exist_ok=True)
+        self.weights = np.random.default_rng(0).normal(size=(4, 3)).astype('float32')
+        with open(self.nn.artifact_path('npz'), 'wb') as f:
+            np.savez(f, activations='["softmax"]', w0=self.weights, b0=np.zeros(3, dtype='float32'))
+
+    async def test_concurrent_requests_share_a_forward_pass(self):
+        from django.test import AsyncClient
+        from .batching import MicroBatcher
+        from .neural_network.engine import NumpyModel
+
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        rows = np.random.default_rng(1).random((8, 4), dtype='float32')
+        batcher = MicroBatcher(max_batch_size=8, max_wait_ms=2000)
+        with mock.patch('main.views.batcher', batcher):
+            responses = await asyncio.gather(*(client.post('/api/predict/', {'model_id': self.nn.id, 'input': row.tolist()},
+                                                           content_type='application/json') for row in rows))
+
+        expected = NumpyModel.load(self.nn.artifact_path('npz'))(rows)
+        for response, row in zip(responses, expected):
+            self.assertEqual(response.status_code, 200)
+            np.testing.assert_allclose(response.json()['prediction'][0], row, rtol=1e-5)
+        # 8 rows fill the batch, nobody waits out the 2 second window
+        self.assertEqual(batcher.stats()['batches'], 1)
+        await self.nn.arefresh_from_db()
+        self.assertEqual(self.nn.predictions, 8)
+
+class GridCodecTests(SimpleTestCase):
+    def test_binary_round_trip(self):
+        rng = np.random.default_rng(0)
+        cases = {
+            'one color': np.full((3, 5, 3), 200, dtype='uint8'),
+            'two colors': rng.integers(0, 2, (7, 9, 3), dtype='uint8') * 255,
+            'palette': rng.integers(0, 6, (16, 16, 3), dtype='uint8') * 51,
+            'rgb': rng.integers(0, 256, (20, 20, 3), dtype='uint8'),
+        }
+        for name, pixels in cases.items():
+            with self.subTest(name):
+                np.testing.assert_array_equal(grids.decode_binary(grids.encode_binary(pixels)), pixels)
+                np.testing.assert_array_equal(grids.decode_payload(grids.encode_payload(pixels)), pixels)
+
+    def test_hex_grid_decoding(self):
+        np.testing.assert_array_equal(grids.decode_grid([["#ff0000", "#00ff00", "#0000ff"], ["#000000", "#ffffff", "#102030"]]),
+                                      [[[255, 0, 0], [0, 255, 0], [0, 0, 255]], [[0, 0, 0], [255, 255, 255], [16, 32, 48]]])
+        cases = {
+            'bad hex': [["#ff00zz", "#000000"]],
+            'missing #': [["ff0000#", "#000000"]],
+            'short cell': [["#fff", "#000000"]],
+            'ragged rows': [["#000000", "#000000"], ["#000000"]],
+            'empty': [],
+            'empty row': [[]],
+        }
+        for name, grid in cases.items():
+            with self.subTest(name), self.assertRaises(ValueError):
+                grids.decode_grid(grid)
+
+    def test_png_is_as_wide_as_a_grid_row(self):
+        from .views import save_as_png
+
+        grid = [["#000000", "#ffffff", "#ff0000"], ["#00ff00", "#0000ff", "#000000"]]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'grid.png')
+            save_as_png(grid, path)
+            with PILImage.open(path) as png:
+                self.assertEqual(png.size, (3, 2))
+                self.assertEqual(png.getpixel((2, 0)), (255, 0, 0))
+                self.assertEqual(png.getpixel((0, 1)), (0, 255, 0))
+
+    def test_short_bodies_raise_value_error(self):
+        rng = np.random.default_rng(1)
+        for pixels in (rng.integers(0, 2, (4, 4, 3), dtype='uint8') * 255, rng.integers(0, 256, (4, 4, 3), dtype='uint8')):
+            data = grids.encode_binary(pixels)
+            for end in range(len(data)):
+                with self.subTest(mode=data[3], end=end), self.assertRaises(ValueError):
+                    grids.decode_binary(data[:end])
+
+class ImageApiTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.user = User.objects.create(username='u')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.data = grids.encode_payload(np.zeros((4, 4, 3), dtype='uint8'))
+
+    def test_create_in_own_category(self):
+        category = Category.objects.create(user=self.user, name='a')
+        response = self.client.post('/api/images/', {'name': 'x', 'category': 'a', 'data': self.data}, format='json')
+
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertNotIn('category', response.json())
+        self.assertEqual(category.images.get().name, 'x')
+
+    def test_bad_creates_are_rejected_with_400(self):
+        Category.objects.create(user=User.objects.create(username='other'), name='theirs')
+        Category.objects.create(user=self.user, name='a')
+        self.client.post('/api/images/', {'name': 'x', 'category': 'a', 'data': self.data}, format='json')
+
+        for body in ({'name': 'y', 'data': self.data}, {'name': 'y', 'category': 'theirs', 'data': self.data},
+                     {'name': 'x', 'category': 'a', 'data': self.data}):
+            with self.subTest(body=body):
+                self.assertEqual(self.client.post('/api/images/', body, format='json').status_code, 400)
+        self.assertEqual(Image.objects.count(), 1)
+
+class CategoryApiTests(TestCase):
+    def setUp(self):
+        from django.core.cache import caches
+        from rest_framework.test import APIClient
+
+        caches['shared'].clear()
+        self.user = User.objects.create(username='u')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for index, name in enumerate('abcde'):
+            make_images(self.user, name, 2, seed=index)
+        make_images(User.objects.create(username='other'), 'theirs', 2)
+
+    def test_cursor_pages_cover_every_category_once(self):
+        names, url = [], '/api/categories/?page_size=2'
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 2)
+            names += [category['name'] for category in page['results']]
+            url = page['next']
+        self.assertEqual(names, list('abcde'))
+
+    def test_fields_selects_image_fields(self):
+        for fields, expected in (('name,thumbnail', {'name', 'thumbnail'}), ('name,bogus', {'name'}), ('', {'name', 'created_at', 'data'})):
+            with self.subTest(fields=fields):
+                images = self.client.get(f'/api/categories/?fields={fields}').json()['results'][0]['images']
+                self.assertEqual(len(images), 2)
+                self.assertEqual(set(images[0]), expected)
+
+        thumbnail = self.client.get('/api/categories/?fields=thumbnail').json()['results'][0]['images'][0]['thumbnail']
+        self.assertEqual(grids.decode_payload(thumbnail).shape, (4, 4, 3))
+
+    def test_matching_etag_is_answered_with_304_until_the_gallery_changes(self):
+        response = self.client.get('/api/categories/?fields=name')
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/categories/?fields=name', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # another query is another representation
+        self.assertEqual(self.client.get('/api/categories/?fields=data', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/api/categories/', {'name': 'f'}, format='json').status_code, 201)
+        response = self.client.get('/api/categories/?fields=name', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_fetch_categories_projection_and_etag(self):
+        from django.test import RequestFactory
+        from .views import fetch_categories
+
+        def get(**headers):
+            request = RequestFactory().get('/', {'fields': 'name,thumbnail'}, **headers)
+            request.user = self.user
+            return fetch_categories(request)
+
+        response = get()
+        categories = json.loads(response.content)
+        self.assertEqual([category['name'] for category in categories], list('abcde'))
+        self.assertEqual(set(categories[0]['images'][0]), {'name', 'thumbnail'})
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+class IngestTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='u')
+        self.client.force_login(self.user)
+        rng = np.random.default_rng(0)
+        self.pixels = [rng.integers(0, 2, (4, 4, 3), dtype='uint8') * 255 for _ in range(3)]
+
+    def post_json(self, images, category='a'):
+        return self.client.post('/api/ingest/', {'category': category, 'images': images}, content_type='application/json')
+
+    def stored(self, name):
+        return grids.decode_binary(bytes(Image.objects.get(category__name='a', name=name).data))
+
+    def test_json_items_are_saved_next_to_per_item_errors(self):
+        from .ingest import upload_path
+
+        hex_grid = [['#%02x%02x%02x' % tuple(pixel) for pixel in row] for row in self.pixels[1]]
+        response = self.post_json([
+            {'name': 'base64', 'data': grids.encode_payload(self.pixels[0])},
+            {'name': 'hex', 'grid': hex_grid},
+            {'name': 'bad', 'data': 'not a grid'},
+            {'data': grids.encode_payload(self.pixels[2])},
+            {'name': 'base64', 'data': grids.encode_payload(self.pixels[2])},
+            {'name': 'empty'},
+        ])
+
+        self.assertEqual(response.status_code, 201)
+        result = response.json()
+        self.assertEqual((result['created'], result['updated']), (2, 0))
+        self.assertEqual([(error['index'], error['name']) for error in result['errors']],
+                         [(2, 'bad'), (3, None), (4, 'base64'), (5, 'empty')])
+        self.assertIn('Duplicate', result['errors'][2]['error'])
+        np.testing.assert_array_equal(self.stored('base64'), self.pixels[0])
+        np.testing.assert_array_equal(self.stored('hex'), self.pixels[1])
+        self.assertTrue(os.path.exists(upload_path(self.user.id, 'a', 'hex')))
+
+        result = self.post_json([{'name': 'hex', 'data': grids.encode_payload(self.pixels[2])}]).json()
+        self.assertEqual((result['created'], result['updated']), (0, 1))
+        np.testing.assert_array_equal(self.stored('hex'), self.pixels[2])
+
+    def test_zip_entries_are_named_after_their_files(self):
+        archive = io.BytesIO()
+        png = io.BytesIO()
+        PILImage.fromarray(self.pixels[1], 'RGB').save(png, format='PNG')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('grids/first.grid', grids.encode_binary(self.pixels[0]))
+            zf.writestr('second.png', png.getvalue())
+            zf.writestr('broken.png', b'\x89PNG\r\n\x1a\n' + b'0' * 16)
+
+        response = self.client.post('/api/ingest/?category=a', archive.getvalue(), content_type='application/zip')
+        self.assertEqual(response.status_code, 201)
+        result = response.json()
+        self.assertEqual(result['created'], 2)
+        self.assertEqual([error['name'] for error in result['errors']], ['broken'])
+        np.testing.assert_array_equal(self.stored('first'), self.pixels[0])
+        np.testing.assert_array_equal(self.stored('second'), self.pixels[1])
+
+    def test_limits_and_batches_without_a_saved_image(self):
+        images = [{'name': str(i), 'data': grids.encode_payload(pixels)} for i, pixels in enumerate(self.pixels)]
+        with override_settings(INGEST_MAX_ITEMS=2):
+            self.assertEqual(self.post_json(images).status_code, 413)
+        with override_settings(INGEST_MAX_BYTES=64):
+            self.assertEqual(self.post_json(images).status_code, 413)
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('big.grid', bytes(4096))
+        with override_settings(INGEST_MAX_BYTES=1024):
+            response = self.client.post('/api/ingest/?category=a', archive.getvalue(), content_type='application/zip')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('unpacks', response.json()['error'])
+
+        self.assertEqual(self.post_json([{'name': 'bad', 'data': 'not a grid'}]).status_code, 400)
+        self.assertEqual(self.post_json(images, category='').status_code, 400)
+        self.assertFalse(Image.objects.exists())
+
+class SaveCategoriesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='u')
+        self.client.force_login(self.user)
+        self.data = grids.encode_payload(np.zeros((4, 4, 3), dtype='uint8'))
+
+    def save(self, added):
+        from .models import GalleryVersion
+
+        # the cached version is only refreshed on commit, which a TestCase never reaches
+        version = GalleryVersion.objects.get_or_create(user=self.user)[0].version
+        body = {'base_version': version, 'changes': {'a': {'added': [{'name': name, 'data': self.data} for name in added]}}}
+        return self.client.post('/api/save-categories/', body, content_type='application/json')
+
+    def test_repeated_or_taken_added_names_are_rejected_with_400(self):
+        self.assertEqual(self.save(['x']).status_code, 201)
+        for added in (['y', 'y'], ['x']):
+            with self.subTest(added=added):
+                self.assertEqual(self.save(added).status_code, 400)
+        self.assertEqual(list(Image.objects.values_list('name', flat=True)), ['x'])
+
+class TensorCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        rng = np.random.default_rng(0)
+        self.pixels = [rng.integers(0, 2, (4, 4, 3), dtype='uint8') * 255 for _ in range(12)]
+        self.blobs = [grids.encode_binary(pixels) for pixels in self.pixels]
+
+    def fill(self, cache, blobs):
+        out = np.zeros((len(blobs), 16), dtype='float32')
+        return cache.fill(1, blobs, out), out
+
+    def test_fill_decodes_once_and_gathers_the_same_features(self):
+        from .tensor_cache import TensorCache
+
+        cache = TensorCache(self.root, 1 << 20)
+        expected = grids.to_features(np.stack(self.pixels))
+        decoded, out = self.fill(cache, self.blobs)
+        self.assertEqual(decoded, len({bytes(blob) for blob in self.blobs}))
+        np.testing.assert_array_equal(out, expected)
+
+        decoded, out = self.fill(cache, self.blobs[::-1])
+        self.assertEqual(decoded, 0)
+        np.testing.assert_array_equal(out, expected[::-1])
+
+    def test_least_recently_used_blocks_are_evicted(self):
+        from .tensor_cache import TensorCache
+
+        cache = TensorCache(self.root, 1 << 20)
+        for start in range(0, 12, 4):
+            self.fill(cache, self.blobs[start:start + 4])
+        block_bytes = cache.usage(1) // 3
+
+        cache.max_bytes = 2 * block_bytes
+        # every use is recorded right away
+        with mock.patch('main.tensor_cache.USED_RESOLUTION', 0):
+            self.fill(cache, self.blobs[:4])
+        self.assertEqual(cache.usage(1), 2 * block_bytes)
+        self.assertEqual(self.fill(cache, self.blobs[4:8])[0], 4)
+        self.assertEqual(self.fill(cache, self.blobs[:4])[0], 0)
+        self.assertEqual(len([name for name in os.listdir(os.path.join(self.root, '1')) if name.endswith('.npy')]), 2)
+
+    def test_hits_leave_the_index_alone_until_the_use_is_due(self):
+        from .tensor_cache import TensorCache, USED_RESOLUTION
+
+        cache = TensorCache(self.root, 1 << 20)
+        self.fill(cache, self.blobs)
+        index_path = os.path.join(self.root, '1', 'index.json')
+        written = os.stat(index_path)
+
+        with mock.patch.object(cache, '_fill', side_effect=AssertionError('hit took the exclusive path')):
+            decoded, out = self.fill(cache, self.blobs[::2])
+        self.assertEqual(decoded, 0)
+        np.testing.assert_array_equal(out, grids.to_features(np.stack(self.pixels[::2])))
+        self.assertEqual(os.stat(index_path).st_ino, written.st_ino)
+
+        later = time.time() + USED_RESOLUTION + 1
+        with mock.patch('main.tensor_cache.time.time', return_value=later):
+            self.assertEqual(self.fill(cache, self.blobs)[0], 0)
+        self.assertEqual([block['used'] for block in cache._load_index(1)['blocks'].values()], [later])
+
+    def test_blocks_missing_from_the_index_are_swept(self):
+        from .tensor_cache import TensorCache
+
+        cache = TensorCache(self.root, 1 << 20)
+        os.makedirs(os.path.join(self.root, '1'))
+        np.save(os.path.join(self.root, '1', 'orphan.npy'), np.zeros((2, 16), dtype='float32'))
+        self.fill(cache, self.blobs[:2])
+        self.assertNotIn('orphan.npy', os.listdir(os.path.join(self.root, '1')))
+
+    def test_concurrent_fills_keep_every_entry(self):
+        from .tensor_cache import TensorCache
+
+        threads = [threading.Thread(target=self.fill, args=(TensorCache(self.root, 1 << 20), [blob]))
+                   for blob in self.blobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+        self.assertEqual(self.fill(TensorCache(self.root, 1 << 20), self.blobs)[0], 0)
+
+class AugmentTests(SimpleTestCase):
+    def passes(self, seed, count=2):
+        import tensorflow as tf
+        from .neural_network import augment
+
+        images = np.random.default_rng(0).random((8, 6, 6, 1), dtype='float32')
+        dataset = augment.apply(tf.data.Dataset.from_tensor_slices((images, np.zeros(8))).batch(4), seed=seed)
+        return [np.concatenate([batch.numpy() for batch, _ in dataset]) for _ in range(count)]
+
+    def test_every_pass_draws_new_transforms(self):
+        for seed in (None, 7):
+            with self.subTest(seed=seed):
+                first, second = self.passes(seed)
+                self.assertFalse(np.allclose(first, second))
+
+    def test_a_seed_repeats_the_sequence_of_passes(self):
+        for ours, theirs in zip(self.passes(7), self.passes(7)):
+            np.testing.assert_allclose(ours, theirs)
+
+class SweepSpaceTests(SimpleTestCase):
+    base = {'layers': [{'name': 'Input Layer', 'neurons': 16}, {'name': 'Hidden Layer 1', 'neurons': 8, 'activation': 'relu'},
+                       {'name': 'Output Layer', 'neurons': 2, 'activation': 'softmax'}], 'loss': 0.01}
+
+    def test_combinations_are_drawn_by_product_index(self):
+        import itertools
+        from . import sweeps
+
+        choices = [[1, 2, 3], ['a', 'b'], [0.1], [4, 5]]
+        self.assertEqual([sweeps._combination(choices, index) for index in range(12)],
+                         [list(combination) for combination in itertools.product(*choices)])
+
+    def test_a_large_space_is_sampled_without_repeats(self):
+        from . import sweeps
+
+        space = {'hidden_neurons': list(range(1, 33)), 'activation': ['relu', 'tanh'] * 16,
+                 'learning_rate': [0.001 * i for i in range(1, 33)], 'batch_size': list(range(1, 33))}
+        configs = sweeps.configurations(self.base, space, 64)
+        keys = {(c['layers'][1]['neurons'], c['loss'], c['batch_size'], c['layers'][1]['activation']) for c in configs}
+        self.assertEqual(len(configs), 64)
+        self.assertGreater(len(keys), 1)
+        self.assertEqual(len(sweeps.configurations(self.base, {'hidden_neurons': [4, 8]}, 64)), 2)
+
+    def test_bad_option_lists_raise_value_error(self):
+        from . import sweeps
+
+        for space in ({'activation': 'relu'}, {'learning_rate': []}, {'batch_size': list(range(1, 100))}, ['relu']):
+            with self.subTest(space=space), self.assertRaises(ValueError):
+                sweeps.configurations(self.base, space, 4)
+
+class SweepApiTests(TestCase):
+    def test_bad_max_trials_are_rejected_with_400(self):
+        user = User.objects.create(username='u')
+        self.client.force_login(user)
+        make_images(user, 'a', 2)
+        layers = [{'name': 'Input Layer', 'neurons': 16}, {'name': 'Output Layer', 'neurons': 2}]
+        for max_trials in ('many', 0, -3):
+            with self.subTest(max_trials=max_trials):
+                body = {'name': 's', 'layers': layers, 'parameters': {'loss': 0.01}, 'categories': ['a'], 'max_trials': max_trials}
+                response = self.client.post('/api/sweeps/', body, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(NeuralNetwork.objects.exists())
+
+class AshaPromotionTests(SimpleTestCase):
+    def sweep(self, results, rungs=(1, 3, 9), reduction=3):
+        return types.SimpleNamespace(results=results, rungs=list(rungs), reduction=reduction)
+
+    def trials(self, epochs, status="Trained"):
+        return {nn_id: types.SimpleNamespace(id=int(nn_id), epochs=count, status=status) for nn_id, count in epochs.items()}
+
+    def test_top_share_of_a_rung_moves_on(self):
+        from .sweeps import _promotion
+
+        scores = {'1': 0.5, '2': 0.9, '3': 0.7, '4': 0.1, '5': 0.8, '6': 0.2}
+        sweep = self.sweep({nn_id: {'0': score} for nn_id, score in scores.items()})
+        trials = self.trials({nn_id: 1 for nn_id in scores})
+
+        nn, epochs = _promotion(sweep, trials)
+        self.assertEqual((nn.id, epochs), (2, 3))
+        # only the top 6 // 3 trials may move on
+        nn, _ = _promotion(sweep, trials, skip={'2'})
+        self.assertEqual(nn.id, 5)
+        self.assertIsNone(_promotion(sweep, trials, skip={'2', '5'}))
+
+    def test_too_few_finished_trials_promote_nobody(self):
+        from .sweeps import _promotion
+
+        sweep = self.sweep({'1': {'0': 0.9}, '2': {'0': 0.1}})
+        self.assertIsNone(_promotion(sweep, self.trials({'1': 1, '2': 1})))
+
+    def test_trials_that_moved_on_or_are_busy_are_passed_over(self):
+        from .sweeps import _promotion
+
+        sweep = self.sweep({nn_id: {'0': score} for nn_id, score in (('1', 0.9), ('2', 0.8), ('3', 0.7), ('4', 0.1), ('5', 0.2), ('6', 0.3))})
+        trials = self.trials({'1': 3, '2': 1, '3': 1, '4': 1, '5': 1, '6': 1})
+        trials['2'].status = "Training"
+        self.assertIsNone(_promotion(sweep, trials))
+
+    def test_higher_rungs_are_promoted_first(self):
+        from .sweeps import _promotion
+
+        results = {str(nn_id): {'0': 0.1 * nn_id} for nn_id in range(1, 10)}
+        results['1']['0'] = 1.0  # could move on from rung 0
+        for nn_id in ('7', '8', '9'):
+            results[nn_id]['1'] = float(nn_id) / 10
+        sweep = self.sweep(results)
+        trials = self.trials({nn_id: 3 if nn_id in ('7', '8', '9') else 1 for nn_id in results})
+
+        nn, epochs = _promotion(sweep, trials)
+        self.assertEqual((nn.id, epochs), (9, 9))
+
+class StaleJobTests(TransactionTestCase):
+    def training_job(self, started, heartbeat=None):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        user = User.objects.create(username=f'u{User.objects.count()}')
+        nn = NeuralNetwork.objects.create(user=user, name=user.username, params={}, status="Training")
+        now = timezone.now()
+        return TrainingJob.objects.create(user=user, network=nn, status="Training", attempts=1,
+                                          started_at=now - timedelta(seconds=started),
+                                          heartbeat_at=None if heartbeat is None else now - timedelta(seconds=heartbeat))
+
+    @override_settings(TRAINING_STALE_SECONDS=60)
+    def test_only_jobs_without_a_recent_heartbeat_are_requeued(self):
+        from . import jobs
+
+        beating = self.training_job(started=3600, heartbeat=5)
+        silent = self.training_job(started=3600, heartbeat=300)
+        lost = self.training_job(started=3600)
+        starting = self.training_job(started=5)
+        jobs.requeue_stale_jobs()
+
+        statuses = dict(TrainingJob.objects.values_list('id', 'status'))
+        self.assertEqual([statuses[job.id] for job in (beating, silent, lost, starting)], ["Training", "Queued", "Queued", "Training"])
+
+    @override_settings(TRAINING_HEARTBEAT_SECONDS=1)
+    def test_heartbeat_stamps_the_job_while_it_runs(self):
+        from . import jobs
+
+        job = self.training_job(started=3600)
+        with jobs.heartbeat(job.id):
+            job.refresh_from_db()
+            for _ in range(50):
+                if job.heartbeat_at is not None:
+                    break
+                threading.Event().wait(0.1)
+                job.refresh_from_db()
+        self.assertIsNotNone(job.heartbeat_at)
+
+class CostTests(SimpleTestCase):
+    params = {'layers': [{'neurons': 16}, {'neurons': 8}, {'neurons': 2}]}
+
+    def test_estimate_counts_the_dense_chain(self):
+        from . import costs
+
+        report = costs.estimate(self.params, 100, 16, 4, 3)
+        # 16 inputs -> 16 -> 8 -> 2
+        self.assertEqual(report['parameters'], (16 * 16 + 16) + (16 * 8 + 8) + (8 * 2 + 2))
+        self.assertEqual(report['flops_per_sample'], 2 * (16 * 16 + 16 * 8 + 8 * 2))
+        self.assertEqual(report['activation_bytes'], 4 * (16 + 26) * 4 * 2)
+        self.assertAlmostEqual(report['total_seconds'], 3 * report['epoch_seconds'], places=2)
+
+    def test_workers_split_the_epoch_and_add_memory(self):
+        from . import costs
+
+        single = costs.estimate(self.params, 1000, 16, 4, 1)
+        parallel = costs.estimate(self.params, 1000, 16, 4, 1, workers=4)
+        self.assertLess(parallel['epoch_seconds'], single['epoch_seconds'])
+        self.assertGreater(parallel['peak_memory_bytes'] - single['peak_memory_bytes'], 4 * costs.RUNTIME_BYTES)
+
+    def test_admit_lowers_the_batch_size_until_the_job_fits(self):
+        from . import costs
+
+        full = costs.estimate(self.params, 100, 16, 256, 1)
+        smaller = costs.estimate(self.params, 100, 16, 64, 1)
+        with override_settings(TRAINING_MAX_JOB_BYTES=(full['peak_memory_bytes'] + smaller['peak_memory_bytes']) // 2):
+            report = costs.admit(self.params, 100, 16, 256, 1)
+        self.assertEqual((report['batch_size'], report['requested_batch_size']), (128, 256))
+        self.assertNotIn('requested_batch_size', costs.admit(self.params, 100, 16, 256, 1))
+
+    def test_admit_refuses_jobs_over_budget(self):
+        from . import costs
+
+        limits = {'TRAINING_MAX_PARAMETERS': 100}, {'TRAINING_MAX_JOB_BYTES': costs.RUNTIME_BYTES}, {'TRAINING_MAX_JOB_SECONDS': 0}
+        for limit in limits:
+            with self.subTest(limit=limit), override_settings(**limit), self.assertRaises(costs.OverBudget) as raised:
+                costs.admit(self.params, 100, 16, 4, 3)
+            self.assertIn('parameters', raised.exception.estimate)
+
+class GridShapeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='u')
+        self.client.force_login(self.user)
+        self.small = make_images(self.user, 'small', 3, size=4)
+        self.also_small = make_images(self.user, 'also-small', 2, size=4, seed=1)
+        self.large = make_images(self.user, 'large', 2, size=6, seed=2)
+
+    def test_one_size_is_returned_mixed_sizes_raise(self):
+        from . import costs
+
+        self.assertEqual(costs.grid_shape([self.small, self.also_small]), (4, 4))
+        self.assertEqual(costs.grid_shape([]), (0, 0))
+        with self.assertRaisesMessage(ValueError, '4x4, 6x6'):
+            costs.grid_shape([self.small, self.large])
+
+    def test_training_on_mixed_sizes_is_rejected_with_400(self):
+        layers = [{'name': 'Input Layer', 'neurons': 16}, {'name': 'Output Layer', 'neurons': 2}]
+        body = {'name': 'mixed', 'layers': layers, 'parameters': {'loss': 0.01}, 'categories': ['small', 'large']}
+        response = self.client.post('/api/train_network/', body, content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('different grid sizes', response.json()['error'])
+        self.assertFalse(NeuralNetwork.objects.exists())
+        self.assertFalse(TrainingJob.objects.exists())
+
+class AutoBatchSizeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='u')
+        self.nn = NeuralNetwork.objects.create(user=self.user, name='n', params={
+            'layers': [{'name': 'Input Layer', 'neurons': 16}, {'name': 'Output Layer', 'neurons': 2}], 'loss': 0.01, 'batch_size': 'auto'})
+        self.nn.categories.set([make_images(self.user, 'a', 300), make_images(self.user, 'b', 300, seed=1)])
+
+    def test_auto_follows_the_dataset_size_and_free_memory(self):
+        from . import costs
+        from .jobs import extract_training_options
+
+        # 480 training images make 15 per step at 32 steps, the power of two below is 8
+        self.assertEqual(extract_training_options(self.nn, 600, 16)['batch_size'], 8)
+        self.assertEqual(extract_training_options(self.nn, 10 ** 6, 16)['batch_size'], costs.MAX_BATCH_SIZE)
+        self.assertEqual(extract_training_options(self.nn, 10, 16)['batch_size'], costs.MIN_BATCH_SIZE)
+        with mock.patch.object(costs, 'available_memory', return_value=10 * 2 * 34 * costs.BYTES_PER_VALUE * 3):
+            self.assertEqual(extract_training_options(self.nn, 600, 16)['batch_size'], 2)
+
+    def test_the_worker_trains_with_the_batch_size_admitted_with_the_job(self):
+        from contextlib import nullcontext
+        from . import costs, jobs
+
+        job = jobs.create_job(self.nn)
+        self.assertEqual(job.estimate['batch_size'], 8)
+        self.nn.refresh_from_db()
+        self.assertEqual(self.nn.params['batch_size'], 'auto')
+
+        metrics = {'accuracy': 1.0, 'loss': 0.0, 'val_accuracy': None, 'epochs': 1}
+        # less free memory when the job starts must not change the admitted batch size
+        with mock.patch.object(costs, 'available_memory', return_value=1), \
+             mock.patch.object(jobs, 'heartbeat', return_value=nullcontext()), \
+             mock.patch.object(jobs, 'train_neural_network', return_value=metrics) as train:
+            jobs.run_training_job(job.id)
+        self.assertEqual(train.call_args.kwargs['batch_size'], 8)
+
+class ReuseTests(TestCase):
+    params = {'layers': [{'name': 'Input Layer', 'neurons': 16}, {'name': 'Output Layer', 'neurons': 2}], 'loss': 0.01}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        models_dir = override_settings(MODELS_DIR=directory.name)
+        models_dir.enable()
+        self.addCleanup(models_dir.disable)
+
+        self.user = User.objects.create(username='u')
+        self.categories = [make_images(self.user, 'a', 3, seed=1), make_images(self.user, 'b', 3, seed=2)]
+        self.source = self.trained(self.user, self.categories)
+
+    def trained(self, user, categories):
+        from .jobs import fingerprint
+
+        nn = NeuralNetwork.objects.create(user=user, name=f'{user.username}-source', params=self.params, status="Trained",
+                                          accuracy=0.75, loss=0.5, epochs=10)
+        nn.categories.set(categories)
+        nn.fingerprint = fingerprint(nn)
+        nn.save()
+        os.makedirs(os.path.dirname(nn.artifact_path()), exist_ok=True)
+        with open(nn.artifact_path(), 'wb') as f:
+            f.write(b'keras')
+        return nn
+
+    def submit(self, user, categories, reuse=True):
+        from . import jobs
+
+        nn = NeuralNetwork.objects.create(user=user, name=f'{user.username}-{NeuralNetwork.objects.count()}', params=self.params)
+        nn.categories.set(categories)
+        with mock.patch.object(jobs, 'enqueue', return_value='queued') as enqueue:
+            return nn, jobs.submit(nn, reuse=reuse), enqueue
+
+    def test_identical_config_and_data_reuse_the_artifact(self):
+        nn, job, enqueue = self.submit(self.user, self.categories)
+
+        enqueue.assert_not_called()
+        self.assertEqual(job.status, "Trained")
+        nn.refresh_from_db()
+        self.assertEqual((nn.status, nn.accuracy, nn.loss, nn.epochs), ("Trained", 0.75, 0.5, 10))
+        with open(nn.artifact_path(), 'rb') as f:
+            self.assertEqual(f.read(), b'keras')
+
+    def test_changed_data_or_reuse_false_train_again(self):
+        _, job, enqueue = self.submit(self.user, self.categories, reuse=False)
+        self.assertEqual(job, 'queued')
+        enqueue.assert_called_once()
+
+        Image.objects.create(category=self.categories[0], name='new', data=grids.encode_binary(np.zeros((4, 4, 3), dtype='uint8')))
+        _, job, enqueue = self.submit(self.user, self.categories)
+        self.assertEqual(job, 'queued')
+        enqueue.assert_called_once()
+
+    def test_networks_of_other_users_are_never_reused(self):
+        other = User.objects.create(username='other')
+        # same image contents under other names, the fingerprint matches the source's
+        categories = [make_images(other, 'other-a', 3, seed=1), make_images(other, 'other-b', 3, seed=2)]
+        nn, job, enqueue = self.submit(other, categories)
+
+        self.assertEqual(nn.fingerprint, self.source.fingerprint)
+        self.assertEqual(job, 'queued')
+        enqueue.assert_called_once()
+
+class QuantizedExportTests(TestCase):
+    def setUp(self):
+        from .neural_network.engine import NumpyModel
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        models_dir = override_settings(MODELS_DIR=directory.name)
+        models_dir.enable()
+        self.addCleanup(models_dir.disable)
+
+        rng = np.random.default_rng(0)
+        self.model = NumpyModel([(rng.normal(size=(16, 8)).astype('float32'), np.zeros(8, dtype='float32'), 'relu'),
+                                 (rng.normal(size=(8, 2)).astype('float32'), np.zeros(2, dtype='float32'), 'softmax')])
+        self.sample = rng.random((64, 16), dtype='float32')
+        self.nn = NeuralNetwork.objects.create(user=User.objects.create(username='u'), name='n', params={}, status="Trained")
+        os.makedirs(os.path.dirname(self.nn.artifact_path('npz')), exist_ok=True)
+        open(self.nn.artifact_path('npz'), 'wb').close()
+
+    @override_settings(MODEL_QUANTIZATION='int8', MODEL_QUANTIZATION_MIN_AGREEMENT=0.9)
+    def test_quantized_copy_replaces_the_float_artifact(self):
+        from .jobs import export_quantized_model
+        from .neural_network.engine import NumpyModel, agreement
+
+        self.assertEqual(export_quantized_model(self.model, self.nn, self.sample), 'int8')
+        self.assertFalse(os.path.exists(self.nn.artifact_path('npz')))
+        self.assertGreaterEqual(agreement(self.model, NumpyModel.load(self.nn.artifact_path('q.npz')), self.sample), 0.9)
+
+    def test_float_artifact_stays_without_a_quantized_copy(self):
+        from .jobs import export_quantized_model
+
+        for quantization, min_agreement in (('none', 0.99), ('int8', 1.01)):
+            with self.subTest(quantization=quantization), override_settings(MODEL_QUANTIZATION=quantization, MODEL_QUANTIZATION_MIN_AGREEMENT=min_agreement):
+                self.assertIsNone(export_quantized_model(self.model, self.nn, self.sample))
+                self.assertTrue(os.path.exists(self.nn.artifact_path('npz')))
+                self.assertFalse(os.path.exists(self.nn.artifact_path('q.npz')))
+
+class KerasExportTests(TestCase):
+    def setUp(self):
+        import tensorflow as tf
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        models_dir = override_settings(MODELS_DIR=directory.name)
+        models_dir.enable()
+        self.addCleanup(models_dir.disable)
+
+        tf.keras.utils.set_random_seed(0)
+        self.model = tf.keras.Sequential([tf.keras.Input(shape=(16,)),
+                                          tf.keras.layers.Dense(12, activation='relu'),
+                                          tf.keras.layers.Dense(8, activation='tanh'),
+                                          tf.keras.layers.Dense(3, activation='softmax')])
+        self.sample = np.random.default_rng(0).random((64, 16), dtype='float32')
+        self.nn = NeuralNetwork.objects.create(user=User.objects.create(username='u'), name='n', params={}, status="Trained")
+        os.makedirs(os.path.dirname(self.nn.artifact_path('npz')), exist_ok=True)
+
+    def test_engine_matches_keras_per_dtype(self):
+        from .jobs import export_numpy_model
+        from .registry import artifact_path, forward, load_model
+
+        expected = self.model.predict(self.sample, verbose=0)
+        for quantization, suffix, tolerance in (('none', 'npz', 1e-5), ('float16', 'q.npz', 2e-3), ('int8', 'q.npz', 2e-2)):
+            with self.subTest(quantization), override_settings(MODEL_QUANTIZATION=quantization, MODEL_QUANTIZATION_MIN_AGREEMENT=0.9):
+                export_numpy_model(self.model, self.nn, self.sample)
+                self.assertEqual(artifact_path(self.nn), self.nn.artifact_path(suffix))
+                np.testing.assert_allclose(forward(load_model(artifact_path(self.nn)), self.sample), expected, atol=tolerance)
+                os.remove(artifact_path(self.nn))
+
+    def test_command_reports_the_artifact_it_wrote(self):
+        from django.core.management import call_command
+
+        self.model.save(self.nn.artifact_path())
+        for quantization, expected in (('int8', 'exported .q.npz'), ('none', 'exported .npz')):
+            with self.subTest(quantization), override_settings(MODEL_QUANTIZATION=quantization, MODEL_QUANTIZATION_MIN_AGREEMENT=0.9):
+                out = io.StringIO()
+                call_command('export_numpy_models', stdout=out)
+                self.assertEqual(out.getvalue().strip(), f"n: {expected}")
+                for ext in ('q.npz', 'npz'):
+                    if os.path.exists(self.nn.artifact_path(ext)):
+                        os.remove(self.nn.artifact_path(ext))
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='u')
+        self.categories = [make_images(self.user, 'a', 7, size=32, seed=1), make_images(self.user, 'b', 5, size=6, seed=2)]
+
+    def archive(self):
+        from . import archives
+
+        return io.BytesIO(b''.join(archives.export_stream(self.categories)))
+
+    def gallery(self):
+        return {(name, category, bytes(data)) for name, category, data in Image.objects.values_list('name', 'category__name', 'data')}
+
+    @override_settings(DATASET_SHARD_IMAGES=3)
+    def test_export_import_round_trip(self):
+        from . import archives
+
+        expected = self.gallery()
+        archive = self.archive()
+        Image.objects.all().delete()
+
+        result = archives.import_stream(self.user, archive)
+        self.assertEqual((result['created'], result['updated']), (12, 0))
+        self.assertEqual(self.gallery(), expected)
+
+    def test_oversized_members_are_refused_before_unpacking(self):
+        from . import archives
+
+        archive = self.archive().getvalue()
+        # shard "a" takes about 3 kB in the archive and 21 kB unpacked
+        for limit, error in ((1000, 'is larger than'), (10000, 'unpacks to more than')):
+            with self.subTest(limit=limit), override_settings(INGEST_MAX_BYTES=limit), self.assertRaisesRegex(ValueError, error):
+                archives.import_stream(self.user, io.BytesIO(archive))
+        with override_settings(INGEST_MAX_ITEMS=4), self.assertRaisesRegex(ValueError, 'Malformed'):
+            archives.import_stream(self.user, io.BytesIO(archive))
+
+class CrossValidationTests(TestCase):
+    def test_folds_are_stratified_and_never_empty(self):
+        from .neural_network.dataset import fold_of
+
+        cases = (([1, 2, 1, 2, 1, 2], 5), ([1] * 10 + [2] * 10 + [3] * 10, 5), ([3, 1, 2, 1, 3, 1, 2], 7))
+        for category_ids, k in cases:
+            with self.subTest(category_ids=category_ids, k=k):
+                labels_of = {category_id: label for label, category_id in enumerate(sorted(set(category_ids)))}
+                folds = fold_of(category_ids, labels_of, k)
+                self.assertEqual(set(folds), set(range(k)))
+                for category_id in labels_of:
+                    sizes = np.bincount(folds[np.array(category_ids) == category_id], minlength=k)
+                    self.assertLessEqual(sizes.max() - sizes.min(), 1)
+
+    def test_aggregate_sums_confusion_over_scored_folds(self):
+        from .crossval import aggregate
+
+        folds = [
+            {'fold': 0, 'accuracy': 1.0, 'loss': 0.1, 'confusion': [[2, 0], [0, 1]]},
+            {'fold': 1, 'accuracy': 0.5, 'loss': 0.5, 'confusion': [[1, 1], [0, 0]]},
+            {'fold': 2, 'error': 'Worker died'},
+        ]
+        result = aggregate(folds)
+        self.assertEqual(result['folds'], 2)
+        self.assertAlmostEqual(result['accuracy'], 0.75)
+        self.assertAlmostEqual(result['accuracy_std'], 0.25)
+        self.assertAlmostEqual(result['loss'], 0.3)
+        self.assertEqual(result['confusion'], [[3, 1], [0, 1]])
+        self.assertEqual(result['recall'], [0.75, 1.0])
+        self.assertEqual(result['precision'], [1.0, 0.5])
+        self.assertIsNone(aggregate(folds[2:]))
+
+    def test_a_second_run_is_refused_while_one_is_going(self):
+        import time
+        from . import crossval
+
+        user = User.objects.create(username='u')
+        nn = NeuralNetwork.objects.create(user=user, name='n', status="Trained", evaluation={'status': 'Running', 'k': 2, 'started_at': time.time()},
+                                          params={'layers': [{'neurons': 16}, {'neurons': 2}], 'loss': 0.001})
+        nn.categories.set([make_images(user, 'a', 4), make_images(user, 'b', 4)])
+        # the caller's copy looks idle, the database row does not
+        nn.evaluation = None
+        with self.assertRaises(crossval.AlreadyRunning):
+            crossval.start(nn, 2)
+
+class DataParallelTests(TransactionTestCase):
+    # streamed datasets read the database from a TensorFlow thread, outside a test transaction
+    def setUp(self):
+        user = User.objects.create(username='u')
+        self.categories = [make_images(user, 'a', 23, seed=1), make_images(user, 'b', 18, seed=2)]
+
+    def shard_rows(self, shards, index):
+        from .neural_network import dataset
+
+        train, count = dataset.shard(self.categories, shards, index, batch_size=4)
+        rows = {(tuple(x), tuple(y)) for batch_x, batch_y in train for x, y in zip(batch_x.numpy(), batch_y.numpy())}
+        self.assertEqual(len(rows), count)
+        return rows
+
+    def test_shards_split_the_training_images(self):
+        from .neural_network import dataset
+
+        for shards in (1, 2, 3):
+            with self.subTest(shards=shards):
+                parts = [self.shard_rows(shards, index) for index in range(shards)]
+                self.assertEqual(sum(len(part) for part in parts), dataset.training_images(self.categories))
+                self.assertEqual(len(set().union(*parts)), dataset.training_images(self.categories))
+                self.assertLessEqual(max(map(len, parts)) - min(map(len, parts)), 4)
+
+    def test_streamed_shards_and_holdout_match_the_in_memory_ones(self):
+        from .neural_network import dataset
+
+        in_memory = self.shard_rows(2, 1)
+        x, y = dataset.holdout(self.categories)
+        with override_settings(TRAINING_IN_MEMORY_MAX_IMAGES=0):
+            self.assertEqual(self.shard_rows(2, 1), in_memory)
+        chunks = list(dataset.holdout_chunks(self.categories))
+        np.testing.assert_array_equal(dataset.holdout(self.categories, 3)[0], x[:3])
+        np.testing.assert_array_equal(np.concatenate([chunk_x for chunk_x, _ in chunks]), x)
+        np.testing.assert_array_equal(np.concatenate([chunk_y for _, chunk_y in chunks]), y)
+
+    def test_validation_over_chunks_matches_one_pass(self):
+        import tensorflow as tf
+        from .neural_network.parallel import _validate
+
+        rng = np.random.default_rng(0)
+        weights = tf.constant(rng.normal(size=(16, 2)), dtype=tf.float32)
+        model = lambda x, training: tf.nn.softmax(tf.constant(x) @ weights)
+        x = rng.random((50, 16), dtype='float32')
+        y = np.eye(2, dtype='float32')[rng.integers(0, 2, 50)]
+
+        loss, accuracy = _validate(model, [(x, y)])
+        expected = float(np.mean(np.argmax(model(x, False).numpy(), axis=1) == y.argmax(axis=1)))
+        self.assertAlmostEqual(accuracy, expected, places=5)
+        chunked = _validate(model, [(x[:20], y[:20]), (x[20:], y[20:])], chunk_size=7)
+        np.testing.assert_allclose(chunked, (loss, accuracy), rtol=1e-5)
+
+    def test_receive_gives_up_on_a_silent_or_dead_worker(self):
+        import time
+        import multiprocessing
+        from .neural_network.parallel import WorkerError, _receive
+
+        parent, child = multiprocessing.Pipe()
+        with self.assertRaisesRegex(WorkerError, 'did not answer'):
+            _receive(parent, time.time() + 0.1)
+        child.close()
+        with self.assertRaisesRegex(WorkerError, 'exited'):
+            _receive(parent, time.time() + 5)
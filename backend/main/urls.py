@@ -14,9 +14,20 @@ urlpatterns = [
     path('api/', include(router.urls)),
     #path('api/save-network-config/', views.save_network_config, name='save_network_config'),
     path('api/train_network/', views.train_network, name='train_network'),
+    path('api/networks/<int:network_id>/continue/', views.continue_training, name='continue_training'),
+    path('api/networks/<int:network_id>/cross-validate/', views.cross_validate, name='cross_validate'),
+    path('api/jobs/<uuid:job_id>/', views.job_status, name='job_status'),
+    path('api/jobs/<uuid:job_id>/events/', views.training_events, name='training_events'),
+    path('api/sweeps/', views.create_sweep, name='create_sweep'),
+    path('api/sweeps/<uuid:sweep_id>/', views.sweep_status, name='sweep_status'),
     path('api/models/', views.get_models, name='get_models'),
     path('api/predict/', views.predict, name='predict'),
+    path('api/predict/batch/', views.predict_batch, name='predict_batch'),
+    path('api/predict/stats/', views.predict_stats, name='predict_stats'),
     path('api/save-image/', views.save_image, name='save_image'),
+    path('api/ingest/', views.ingest_images, name='ingest_images'),
+    path('api/datasets/export/', views.export_dataset, name='export_dataset'),
+    path('api/datasets/import/', views.import_dataset, name='import_dataset'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('api/save-categories/', views.save_categories, name='save_categories'),
     path('api/delete-category/', views.delete_category, name='delete_category'),
@@ -0,0 +1,34 @@
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+
+from .models import GalleryVersion
+
+# Short timeout: two concurrent writers can leave the older number in the cache, this bounds how long.
+VERSION_TIMEOUT = 60
+
+def _key(user_id):
+    return f"gallery-version:{user_id}"
+
+def current(user_id):
+    """Gallery version of the user, answered from the shared cache without touching the database when possible"""
+    cache = caches['shared']
+    version = cache.get(_key(user_id))
+    if version is None:
+        version = GalleryVersion.objects.get_or_create(user_id=user_id)[0].version
+        # add never overwrites, a writer that got in first keeps its newer number
+        cache.add(_key(user_id), version, VERSION_TIMEOUT)
+    return version
+
+def lock(user_id):
+    """Row-locks the user's gallery version until the surrounding transaction ends"""
+    GalleryVersion.objects.get_or_create(user_id=user_id)
+    return GalleryVersion.objects.select_for_update().get(user_id=user_id)
+
+def bump(user_id):
+    GalleryVersion.objects.get_or_create(user_id=user_id)
+    GalleryVersion.objects.filter(user_id=user_id).update(version=F('version') + 1)
+    version = GalleryVersion.objects.values_list('version', flat=True).get(user_id=user_id)
+    # inside a transaction the new number must not be visible before the changes are
+    transaction.on_commit(lambda: caches['shared'].set(_key(user_id), version, VERSION_TIMEOUT))
+    return version
@@ -1,34 +1,86 @@
 import os
 import json
-import ast
+import shutil
+import hashlib
+import asyncio
+import tarfile
+import zipfile
+import tempfile
 import numpy as np
-import tensorflow as tf
 
+from django.conf import settings
 from django.contrib.auth import login, authenticate
-from django.shortcuts import render, redirect, get_object_or_404
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.shortcuts import render, redirect
 from rest_framework import viewsets, status
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
 
 from .forms import UserRegisterForm, UserLoginForm
-from .models import Category, Image, NeuralNetwork
-from .serializers import CategorySerializer, ImageSerializer
-from django.http import JsonResponse
+from .models import Category, Image, NeuralNetwork, Sweep, TrainingJob
+from .serializers import CategorySerializer, ImageSerializer, parse_image_fields
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseNotModified
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.permissions import IsAuthenticated
 
 from PIL import Image as PILImage
-from .neural_network import train
-#from train import CustomModel, Layer
+# TensorFlow is only imported inside the training processes and for models without a NumPy artifact
+from . import archives, costs, crossval, grids, ingest, jobs, progress, scoring, sweeps, versions
+from .batching import batcher
+from .registry import registry, forward
+
+FINISHED_STATUSES = ("Trained", "Failed")
+PROGRESS_POLL_INTERVAL = 0.5
+PROGRESS_KEEPALIVE = 15
+
+class CategoryCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+class GalleryVersionMixin:
+    """Listings carry an ETag built from the user's gallery version, writes bump the version
+    A matching If-None-Match is answered with 304 before any query or serialization happens
+    """
+    def list(self, request, *args, **kwargs):
+        version = versions.current(request.user.id)
+        etag = gallery_etag(request, version)
+        if etag_matches(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag, 'X-Gallery-Version': version})
+
+        response = super().list(request, *args, **kwargs)
+        set_gallery_headers(response, etag, version)
+        return response
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        versions.bump(self.request.user.id)
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        versions.bump(self.request.user.id)
 
-UPLOAD_DIR = "uploads"
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        versions.bump(self.request.user.id)
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(GalleryVersionMixin, viewsets.ModelViewSet):
+    """?fields=name,thumbnail lists images without their full grids, ?cursor= and ?page_size= page through categories"""
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = CategoryCursorPagination
 
     def get_queryset(self):
-        return Category.objects.filter(user=self.request.user)
+        return user_categories(self.request.user, self.image_fields())
+
+    def image_fields(self):
+        return parse_image_fields(self.request.query_params.get('fields'))
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'image_fields': self.image_fields()}
 
     def create(self, request, *args, **kwargs):
         request.data['user'] = request.user.id
@@ -36,14 +88,33 @@ class CategoryViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
+        versions.bump(self.request.user.id)
 
-class ImageViewSet(viewsets.ModelViewSet):
+class ImageViewSet(GalleryVersionMixin, viewsets.ModelViewSet):
     serializer_class = ImageSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
         return Image.objects.filter(category__user=self.request.user)
 
+def user_categories(user, image_fields):
+    images = Image.objects.all()
+    if not {'data', 'thumbnail'} & set(image_fields):
+        images = images.defer('data')
+    return Category.objects.filter(user=user).prefetch_related(Prefetch('images', queryset=images))
+
+def gallery_etag(request, version):
+    query = hashlib.md5(request.GET.urlencode().encode()).hexdigest()[:12]
+    return f'"{request.user.id}-{version}-{query}"'
+
+def set_gallery_headers(response, etag, version):
+    response['ETag'] = etag
+    response['X-Gallery-Version'] = version
+    response['Cache-Control'] = 'private, no-cache'
+
+def etag_matches(request, etag):
+    return etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]
+
 # api
 def index(request):
     return render(request, 'index.html')
@@ -83,71 +154,419 @@ def train_network(request):
 
             selected_categories = Category.objects.filter(name__in=categories, user=user)
 
-            training_data = []
-            for category in selected_categories:
-                training_data.extend(category.images)
-
-            if not training_data:
+            if not Image.objects.filter(category__in=selected_categories).exists():
                 return JsonResponse({'error': 'No images found for selected categories'}, status=400)
 
             config = merge_nn_config(layers, parameters)
 
-            nn = NeuralNetwork.objects.create(user=user, params=config, name=name, status="Training")
-            set_nn_params(nn, selected_categories)
+            nn = NeuralNetwork.objects.create(user=user, params=config, name=name, status="Queued")
+            nn.categories.set(selected_categories)
+            try:
+                # "reuse": false trains again even when an identical network exists
+                job = jobs.submit(nn, reuse=data.get('reuse', True) is not False)
+            except costs.OverBudget as e:
+                nn.delete()
+                return JsonResponse({'error': str(e), 'estimate': e.estimate}, status=400)
+            except ValueError as e:
+                # images of different grid sizes
+                nn.delete()
+                return JsonResponse({'error': str(e)}, status=400)
+
+            return JsonResponse({'job_id': str(job.id), 'network_id': nn.id, 'status': job.status,
+                                 'estimate': job.estimate}, status=202)
 
-            return JsonResponse({'accuracy': nn.accuracy, 'loss': nn.loss, 'status': "Trained"}, status=200)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
 
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+@csrf_exempt
+def continue_training(request, network_id):
+    """Warm-starts a trained network from its saved weights on the current images of its categories
+    - epochs (int): additional epochs, jobs.FINE_TUNE_EPOCHS by default
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body.decode('utf-8') or '{}')
+
+            nn = NeuralNetwork.objects.filter(id=network_id, user=request.user).first()
+            if not nn:
+                return JsonResponse({'error': 'Network not found'}, status=404)
+            if nn.status in ("Queued", "Training"):
+                return JsonResponse({'error': 'Network is already training'}, status=409)
+            if not os.path.exists(nn.artifact_path()):
+                return JsonResponse({'error': 'Network has no saved model to continue from'}, status=400)
+            if not Image.objects.filter(category__in=nn.categories.all()).exists():
+                return JsonResponse({'error': 'No images found for selected categories'}, status=400)
+
+            extra = int(data.get('epochs', jobs.FINE_TUNE_EPOCHS))
+            if extra < 1:
+                return JsonResponse({'error': 'epochs must be at least 1'}, status=400)
+
+            job = jobs.enqueue(nn, epochs=nn.epochs + extra)
+
+            return JsonResponse({'job_id': str(job.id), 'network_id': nn.id, 'status': job.status, 'epochs': job.epochs,
+                                 'estimate': job.estimate}, status=202)
+
+        except costs.OverBudget as e:
+            return JsonResponse({'error': str(e), 'estimate': e.estimate}, status=400)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+@csrf_exempt
+def cross_validate(request, network_id):
+    """POST starts a k-fold cross-validation of the network's config, GET returns the latest one (see crossval.py)
+    - k (int): number of folds, CROSSVAL_FOLDS by default
+    """
+    nn = NeuralNetwork.objects.filter(id=network_id, user=request.user).first()
+    if not nn:
+        return JsonResponse({'error': 'Network not found'}, status=404)
+
+    if request.method == 'GET':
+        if not nn.evaluation:
+            return JsonResponse({'error': 'Network was not cross-validated yet'}, status=404)
+        return JsonResponse({'network_id': nn.id, **nn.evaluation}, status=200)
+
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body.decode('utf-8') or '{}')
+            evaluation = crossval.start(nn, data.get('k'))
+            return JsonResponse({'network_id': nn.id, **evaluation}, status=202)
+
+        except crossval.AlreadyRunning as e:
+            return JsonResponse({'error': str(e)}, status=409)
+        except costs.OverBudget as e:
+            return JsonResponse({'error': str(e), 'estimate': e.estimate}, status=400)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
+def job_status(request, job_id):
+    if request.method == 'GET':
+        job = TrainingJob.objects.filter(id=job_id, user=request.user).select_related('network').first()
+        if not job:
+            return JsonResponse({'error': 'Job not found'}, status=404)
+
+        return JsonResponse({
+            'job_id': str(job.id),
+            'network_id': job.network_id,
+            'status': job.status,
+            'accuracy': job.network.accuracy,
+            'loss': job.network.loss,
+            'error': job.error,
+            'estimate': job.estimate,
+            'scaling': job.scaling
+        }, status=200)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+async def training_events(request, job_id):
+    """Server-Sent Events stream of a job's training progress, ends with a "done" event
+    Meant to be served by the ASGI application, an open stream then costs no worker thread
+    """
+    user = await request.auser()
+    job = await TrainingJob.objects.filter(id=job_id, user_id=user.id).select_related('network').afirst()
+    if not job:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+
+    response = StreamingHttpResponse(progress_stream(job), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def progress_stream(job):
+    if job.status in FINISHED_STATUSES:
+        yield sse_event('done', {'status': job.status, 'accuracy': job.network.accuracy, 'loss': job.network.loss, 'error': job.error})
+        return
+
+    last_update = None
+    idle = 0
+    while True:
+        snapshot = await progress.aget(job.id)
+        if snapshot and snapshot['updated_at'] != last_update:
+            last_update = snapshot['updated_at']
+            idle = 0
+            if snapshot.get('status') in FINISHED_STATUSES:
+                yield sse_event('done', snapshot)
+                return
+            yield sse_event('progress', snapshot)
+
+        elif idle >= PROGRESS_KEEPALIVE:
+            # the snapshot can expire or never arrive if a worker dies, the job row is the fallback
+            idle = 0
+            job = await TrainingJob.objects.select_related('network').aget(id=job.id)
+            if job.status in FINISHED_STATUSES:
+                yield sse_event('done', {'status': job.status, 'accuracy': job.network.accuracy, 'loss': job.network.loss, 'error': job.error})
+                return
+            yield ": keep-alive\n\n"
+
+        await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+        idle += PROGRESS_POLL_INTERVAL
+
+def create_sweep(request):
+    """Starts a hyperparameter sweep, the body is a train_network body plus
+    - space (dict): hidden_neurons, activation, learning_rate, batch_size option lists, see sweeps.configurations
+    - max_trials (int), min_epochs (int), max_epochs (int), reduction (int): successive halving settings
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body.decode('utf-8'))
+
+            user = request.user
+            selected_categories = Category.objects.filter(name__in=data.get('categories', []), user=user)
+            if not Image.objects.filter(category__in=selected_categories).exists():
+                return JsonResponse({'error': 'No images found for selected categories'}, status=400)
+
+            base = merge_nn_config(data.get('layers', []), data.get('parameters', {}))
+            sweep = sweeps.create(
+                user, data.get('name') or 'Sweep', base, selected_categories, data.get('space', {}),
+                max_trials=int(data['max_trials']) if data.get('max_trials') is not None else None,
+                min_epochs=int(data.get('min_epochs', 1)),
+                max_epochs=int(data.get('max_epochs', jobs.TRAINING_EPOCHS)),
+                reduction=int(data.get('reduction', 3))
+            )
+            return JsonResponse(sweeps.summary(sweep), status=202)
+
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({'error': f'Invalid sweep: {e}'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+def sweep_status(request, sweep_id):
+    if request.method == 'GET':
+        sweep = Sweep.objects.filter(id=sweep_id, user=request.user).first()
+        if not sweep:
+            return JsonResponse({'error': 'Sweep not found'}, status=404)
+        return JsonResponse(sweeps.summary(sweep), status=200)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
 def get_models(request):
     user = request.user
     models = NeuralNetwork.objects.filter(user=user, status="Trained").values('id', 'name', 'accuracy')
 
     return JsonResponse(list(models), safe=False)
 
-# def load_model():
-#     return tf.keras.models.load_model("trained_model.h5")
+@csrf_exempt
+async def predict(request):
+    """Async so that concurrent calls awaiting the micro-batcher share one event loop instead of a thread each"""
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+
+            user = await request.auser()
+            nn = await NeuralNetwork.objects.filter(id=data.get('model_id'), user_id=user.id, status="Trained").afirst()
+            if not nn:
+                return JsonResponse({"error": "Trained model not found"}, status=404)
+
+            # loading an artifact reads the disk, keep it off the event loop
+            model = await asyncio.to_thread(registry.get, nn)
+            input_data = np.array(data["input"], dtype='float32').reshape(-1)
+            size = scoring.input_size(model)
+            if input_data.shape[0] != size:
+                return JsonResponse({"error": f"Expected {size} input values, got {input_data.shape[0]}"}, status=400)
+
+            row = await batcher.predict(nn.id, lambda batch: forward(model, batch), input_data)
+            await NeuralNetwork.objects.filter(id=nn.id).aupdate(predictions=F('predictions') + 1)
+
+            return JsonResponse({"prediction": [row.tolist()]}, status=200)
+        except FileNotFoundError:
+            return JsonResponse({"error": "Trained model has no saved artifact, train it again"}, status=409)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+    return JsonResponse({"error": "Invalid request method"}, status=405)
 
 @csrf_exempt
-def predict(request): # TODO: create model loading and predicting logic
+def predict_batch(request):
+    """Scores many rows with one trained network and streams NDJSON lines as the batches finish
+    - model_id (int)
+    - inputs (list): feature vectors like /api/predict/ takes, or grids {"name", "data"}
+    - category (str): instead of inputs, every image of one of the user's categories, the last line
+      has the accuracy when the network was trained on that category
+    - top_k (int): adds the k best labels of the network's categories to every line
+    - batch_size (int): rows per forward pass, PREDICT_BATCH_SIZE by default
+    """
     if request.method == 'POST':
         try:
-            model = load_model()
             data = json.loads(request.body)
-            input_data = np.array(data["input"]).reshape(1, -1)
 
-            prediction = model.predict(input_data).tolist()
+            nn = NeuralNetwork.objects.filter(id=data.get('model_id'), user=request.user, status="Trained").first()
+            if not nn:
+                return JsonResponse({"error": "Trained model not found"}, status=404)
+
+            top_k = int(data.get('top_k', 0))
+            batch_size = int(data.get('batch_size', settings.PREDICT_BATCH_SIZE))
+            if top_k < 0 or not 1 <= batch_size <= settings.PREDICT_MAX_BATCH_ROWS:
+                return JsonResponse({"error": f"Expected top_k >= 0 and 1 <= batch_size <= {settings.PREDICT_MAX_BATCH_ROWS}"}, status=400)
+
+            model = registry.get(nn)
+            size = scoring.input_size(model)
+            expected = None
+            if 'category' in data:
+                category = Category.objects.filter(name=data['category'], user=request.user).first()
+                if not category:
+                    return JsonResponse({"error": "Category not found"}, status=404)
+                names = scoring.labels(nn)
+                expected = names.index(category.name) if category.name in names else None
+                rows = scoring.category_rows(category, size)
+            elif isinstance(data.get('inputs'), list):
+                rows = scoring.input_rows(data['inputs'], size)
+            else:
+                return JsonResponse({"error": "Expected inputs (list) or category"}, status=400)
+
+            return StreamingHttpResponse(scoring.stream(nn, model, rows, batch_size, top_k=top_k, expected=expected),
+                                         content_type='application/x-ndjson')
 
-            return JsonResponse({"prediction": prediction}, status=200)
+        except FileNotFoundError:
+            return JsonResponse({"error": "Trained model has no saved artifact, train it again"}, status=409)
+        except (json.JSONDecodeError, ValueError, TypeError) as e:
+            return JsonResponse({"error": str(e)}, status=400)
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=500)
 
     return JsonResponse({"error": "Invalid request method"}, status=405)
 
+def predict_stats(request):
+    if request.method == 'GET':
+        return JsonResponse(batcher.stats(), status=200)
+
+    return JsonResponse({"error": "Invalid request method"}, status=405)
+
 @csrf_exempt
 def save_image(request):
+    """Accepts the grid as JSON {"name", "category", "data"} where data is base64 compact grid data
+    (or the old hex list), or as a raw application/octet-stream body with name and category in the query string
+    """
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
-            image_name = data.get('name')
-            category_name = data.get('category')
-            image_data = ast.literal_eval(data.get('data'))
+            if request.content_type == 'application/octet-stream':
+                image_name = request.GET.get('name')
+                category_name = request.GET.get('category')
+                image_data = request.body
+            else:
+                data = json.loads(request.body)
+                image_name = data.get('name')
+                category_name = data.get('category')
+                image_data = data.get('data')
 
             if not image_name or not category_name or not image_data:
                 return JsonResponse({'error': 'Missing fields (image_name, category_name or image_data)'}, status=400)
 
-            save_as_png(image_data, path=image_path(image_name, 'png'))
+            pixels = grids.decode_payload(image_data)
+            category, _ = Category.objects.get_or_create(name=category_name, user=request.user)
+            Image.objects.update_or_create(category=category, name=image_name, defaults={'data': grids.encode_binary(pixels)})
+            version = versions.bump(request.user.id)
+
+            path = ingest.upload_path(request.user.id, category_name, image_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_as_png(pixels, path=path)
 
-            return JsonResponse({'message': f'Image "{image_name}" saved successfully!'}, status=201)
+            return JsonResponse({'message': f'Image "{image_name}" saved successfully!', 'version': version}, status=201)
 
         except json.JSONDecodeError: return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except ValueError as e: return JsonResponse({'error': str(e)}, status=400)
         except Exception as e: return JsonResponse({'error': str(e)}, status=500)
 
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
+@csrf_exempt
+def ingest_images(request):
+    """Adds or replaces many images of one category in a single request
+    - JSON {"category", "images": [{"name", "data"}, ...]} with data as for save_image
+    - application/zip body with the category in the query string, one compact grid or PNG per entry,
+      the entry's file name without extension is the image name
+    Answers with created, updated, errors (per item, by index) and the new gallery version
+    """
+    if request.method == 'POST':
+        try:
+            if int(request.META.get('CONTENT_LENGTH') or 0) > settings.INGEST_MAX_BYTES:
+                return JsonResponse({'error': f'Request larger than {settings.INGEST_MAX_BYTES} bytes'}, status=413)
+            body = spooled_body(request)
+
+            if request.content_type in ('application/zip', 'application/x-zip-compressed'):
+                category_name = request.GET.get('category')
+                items = list(ingest.read_archive(body))
+            else:
+                data = json.load(body)
+                category_name = data.get('category')
+                items = data.get('images', [])
+
+            if not category_name:
+                return JsonResponse({'error': 'Missing category'}, status=400)
+            if not isinstance(items, list):
+                return JsonResponse({'error': 'images must be a list'}, status=400)
+            if len(items) > settings.INGEST_MAX_ITEMS:
+                return JsonResponse({'error': f'At most {settings.INGEST_MAX_ITEMS} images per request'}, status=413)
+
+            result = ingest.ingest(request.user, category_name, items)
+            # nothing saved means every item was rejected
+            return JsonResponse(result, status=201 if result['version'] is not None else 400)
+
+        except json.JSONDecodeError: return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except zipfile.BadZipFile: return JsonResponse({'error': 'Invalid zip archive'}, status=400)
+        except ValueError as e: return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e: return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+def export_dataset(request):
+    """Streams the user's images as a tar of NPZ shards, see main/archives.py
+    - categories (query, optional): comma separated names, every category of the user by default
+    """
+    if request.method == 'GET':
+        try:
+            categories = Category.objects.filter(user=request.user).order_by('id')
+            names = request.GET.get('categories')
+            if names:
+                categories = categories.filter(name__in=names.split(','))
+
+            response = StreamingHttpResponse(archives.export_stream(categories), content_type='application/x-tar')
+            response['Content-Disposition'] = 'attachment; filename="dataset.tar"'
+            return response
+
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+@csrf_exempt
+def import_dataset(request):
+    """Loads an archive made by export_dataset, read from the request stream one shard at a time
+    Images go into the categories of the same names and into the tensor cache
+    """
+    if request.method == 'POST':
+        try:
+            return JsonResponse(archives.import_stream(request.user, request), status=201)
+
+        except (ValueError, KeyError, IndexError, tarfile.TarError) as e:
+            return JsonResponse({'error': f'Invalid archive: {e}'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+    return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+def spooled_body(request):
+    """Request body copied from the stream into a temporary file (in memory while small),
+    unlike request.body it is not held to DATA_UPLOAD_MAX_MEMORY_SIZE
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    shutil.copyfileobj(request, body)
+    body.seek(0)
+    return body
+
 
 def register(request):
     if request.method == "POST":
@@ -182,21 +601,37 @@ def user_login(request):
 
 @csrf_exempt
 def save_categories(request):
+    """Two payloads are accepted:
+    - Delta: {"base_version": n, "changes": {category: {"added": [...], "changed": [...], "removed": [names]}},
+      "removed_categories": [names]}, applied only if the gallery is still at base_version (409 otherwise)
+    - Full (older clients): {"categories": {category: [images]}}, every listed category is replaced
+    Both answer with the new gallery version.
+    """
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            categories_data = data.get('categories', {})
-
             user = request.user
-            for category_name, images in categories_data.items():
-                category, _ = Category.objects.get_or_create(name=category_name, user=user)
-                category.images = images
-                category.save()
 
-            return JsonResponse({'message': 'Categories and images saved successfully!'}, status=201)
+            with transaction.atomic():
+                gallery = versions.lock(user.id)
+
+                if 'changes' in data:
+                    if data.get('base_version') != gallery.version:
+                        return JsonResponse({'error': 'Gallery changed on the server', 'version': gallery.version}, status=409)
+                    apply_category_changes(user, data['changes'], data.get('removed_categories', []))
+                else:
+                    for category_name, images in data.get('categories', {}).items():
+                        category, _ = Category.objects.get_or_create(name=category_name, user=user)
+                        replace_category_images(category, images)
+
+                version = versions.bump(user.id)
+
+            return JsonResponse({'message': 'Categories and images saved successfully!', 'version': version}, status=201)
 
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except (KeyError, ValueError) as e:
+            return JsonResponse({'error': f'Invalid image data: {e}'}, status=400)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
@@ -206,11 +641,18 @@ def save_categories(request):
 def fetch_categories(request):
     if request.method == 'GET':
         try:
-            categories = Category.objects.filter(user=request.user)
-            categories_data = [
-                {"name": category.name, "images": category.images} for category in categories
-            ]
-            return JsonResponse(categories_data, safe=False, status=200)
+            version = versions.current(request.user.id)
+            etag = gallery_etag(request, version)
+            if etag_matches(request, etag):
+                return HttpResponseNotModified(headers={'ETag': etag, 'X-Gallery-Version': version})
+
+            image_fields = parse_image_fields(request.GET.get('fields'))
+            categories = user_categories(request.user, image_fields)
+            categories_data = CategorySerializer(categories, many=True, context={'image_fields': image_fields}).data
+
+            response = JsonResponse(categories_data, safe=False, status=200)
+            set_gallery_headers(response, etag, version)
+            return response
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
@@ -226,12 +668,13 @@ def delete_category(request):
             if not category_name:
                 return JsonResponse({'error': 'Category name is required'}, status=400)
 
-            category = Category.objects.filter(name=category_name).first()
+            category = Category.objects.filter(name=category_name, user=request.user).first()
             if not category:
                 return JsonResponse({'error': 'Category not found'}, status=404)
 
             category.delete()
-            return JsonResponse({'message': 'Category deleted successfully'})
+            version = versions.bump(request.user.id)
+            return JsonResponse({'message': 'Category deleted successfully', 'version': version})
 
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
@@ -246,53 +689,75 @@ def delete_image(request):
     if not category_name or not image_name:
         return Response({'error': 'Missing category or image name'}, status=400)
 
-    category = get_object_or_404(Category, name=category_name)
+    deleted, _ = Image.objects.filter(category__user=request.user, category__name=category_name, name=image_name).delete()
+
+    if not deleted:
+        return Response({'error': 'Image not found in this category'}, status=404)
+    version = versions.bump(request.user.id)
 
-    if not isinstance(category.images, list):
-        return Response({'error': 'Invalid images format'}, status=500)
+    return Response({'message': f'Image "{image_name}" deleted from category "{category_name}".', 'version': version})
 
-    updated_images = [img for img in category.images if img.get("name") != image_name]
+def replace_category_images(category: Category, images: list):
+    """Makes the category hold exactly the given {"name", "data"} entries, untouched rows are left alone"""
+    incoming = {img['name']: grids.encode_binary(grids.decode_image(img)) for img in images}
+    existing = {img.name: img for img in category.images.all()}
 
-    if len(updated_images) == len(category.images):
-        return Response({'error': 'Image not found in this category'}, status=404)
+    category.images.exclude(name__in=incoming.keys()).delete()
 
-    category.images = updated_images
-    category.save()
+    changed = []
+    for name, data in incoming.items():
+        if name in existing and bytes(existing[name].data) != data:
+            existing[name].data = data
+            changed.append(existing[name])
+    Image.objects.bulk_update(changed, ['data'])
 
-    return Response({'message': f'Image "{image_name}" deleted from category "{category_name}".'})
+    Image.objects.bulk_create([
+        Image(category=category, name=name, data=data) for name, data in incoming.items() if name not in existing
+    ])
 
-def save_as_png(data: list, path: str):
+def apply_category_changes(user, changes: dict, removed_categories: list):
+    """Applies a gallery delta with one bulk statement per kind of change and category
+    Raises ValueError when an added image name is repeated or already taken in its category
+    """
+    Category.objects.filter(user=user, name__in=removed_categories).delete()
+
+    for category_name, change in changes.items():
+        category, _ = Category.objects.get_or_create(name=category_name, user=user)
+
+        removed = change.get('removed', [])
+        if removed:
+            category.images.filter(name__in=removed).delete()
+
+        changed = {img['name']: grids.encode_binary(grids.decode_image(img)) for img in change.get('changed', [])}
+        if changed:
+            rows = list(category.images.filter(name__in=changed.keys()).only('id', 'name'))
+            for row in rows:
+                row.data = changed[row.name]
+            Image.objects.bulk_update(rows, ['data'])
+
+        added = {}
+        for img in change.get('added', []):
+            if img['name'] in added:
+                raise ValueError(f'Image "{img["name"]}" is added to "{category_name}" twice')
+            added[img['name']] = grids.encode_binary(grids.decode_image(img))
+        taken = list(category.images.filter(name__in=added.keys()).values_list('name', flat=True)[:1])
+        if taken:
+            raise ValueError(f'Image "{taken[0]}" already exists in "{category_name}"')
+        Image.objects.bulk_create([Image(category=category, name=name, data=data) for name, data in added.items()])
+
+def save_as_png(data, path: str):
     """Creates and saves image in .png format
-    - Data (list): [["hex color", "hex color", ... "hex color"], ...]
+    - Data (list or np.ndarray): [["hex color", "hex color", ... "hex color"], ...] or uint8 RGB pixels (rows, cols, 3)
     - Path (str): "path/to/your/image" or "path/to/your/image.png"
     """
-    print(f"Image data ({type(data)}): {data}")
-
-    length = len(data)
-    width = len(data[0])
-
-    img = PILImage.new('RGB', (length, width))
+    pixels = data if isinstance(data, np.ndarray) else grids.decode_grid(data)
+    img = PILImage.fromarray(pixels, 'RGB')
 
-    for y in range(length):
-        for x in range(width):
-            hexcol = data[y][x]
-            rgb = tuple(int(hexcol[i:i+2], 16) for i in (1, 3, 5))
-            img.putpixel((x,y), rgb)
-    
     if not '.png' in path:
         img.save(f'{path}.png')
     else:
         img.save(f'{path}')
 
-def image_path(image_name: str, ext: str):
-    if not os.path.exists(UPLOAD_DIR):
-        os.makedirs(UPLOAD_DIR)
-
-    file_path = os.path.join(UPLOAD_DIR, f"{image_name}.{ext}")
-    print(f"Image path: {file_path}")
-
-    return file_path
-
 def merge_nn_config(layers, parameters):
     activations = parameters.get('activationFunctions', {})
     merged_layers = []
@@ -312,51 +777,12 @@ def merge_nn_config(layers, parameters):
 
     return {
         'layers': merged_layers,
-        'loss': parameters.get('loss')
+        'loss': parameters.get('loss'),
+        'augment': parameters.get('augment', False),
+        # training schedule, see jobs.extract_training_options
+        'epochs': parameters.get('epochs'),
+        'batch_size': parameters.get('batch_size', 'auto'),
+        'early_stopping': parameters.get('early_stopping', True),
+        'reduce_lr': parameters.get('reduce_lr', True),
+        'workers': parameters.get('workers', 1)
     }
-
-def set_nn_params(nn: NeuralNetwork, categories: dict):
-    nn.categories.set(categories)
-    print("SET NN REACHED")
-
-    user_model = extract_nn_params(nn)
-
-    accuracy, loss = 99, 0.1  # training function here
-
-    nn.accuracy = accuracy
-    nn.loss = loss
-    nn.status = "Trained"
-    nn.save()
-
-def extract_nn_params(nn):
-    data = nn.params if isinstance(nn.params, dict) else json.loads(nn.params)
-    
-    layers = data.get('layers', [])
-    print(f"Data for extraction ({type(layers)}): {layers}")
-    
-    lr = float(data.get('loss'))
-    print(f"Learning rate ({type(lr)}): {lr}")
-
-    model_layers = []
-    start_shape = 0
-    num_classes = 0
-
-    for layer_data in layers:
-        lrname = layer_data.get('name')
-        neurons = int(layer_data.get('neurons'))
-        activation = layer_data.get('activation')
-
-        if lrname == 'Input Layer':
-            start_shape = (neurons**0.5, neurons**0.5)
-            print(f'Shape: {start_shape}')
-        elif lrname == 'Output Layer':
-            num_classes = neurons
-            print(f'Classes amount: {num_classes}')
-
-        model_layers.append(train.Layer(neurons, activation))
-
-    user_model = train.CustomModel(start_shape, num_classes)
-    print(f'Model Layers: {model_layers}')
-    user_model.build(model_layers)
-
-    return user_model
\ No newline at end of file
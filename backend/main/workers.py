@@ -0,0 +1,25 @@
+import os
+
+# Set-up of spawned worker processes: the training pool, the cross-validation pool and data-parallel workers.
+# A spawned process loads its initializer or target before Django is set up, so this module imports no models.
+
+def init(threads=None):
+    """Runs once in every worker process, workers are spawned so Django has to be set up again
+    - threads (int): caps TensorFlow's thread pools, so the processes of a pool do not oversubscribe the cores
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    import django
+    django.setup()
+
+    if threads:
+        # read when TensorFlow and its OpenMP kernels start, before the first op runs in this process
+        for variable in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+            os.environ[variable] = str(threads)
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+def threads_per_process(processes):
+    """TensorFlow threads per worker process, TRAINING_WORKER_THREADS or the cores shared out between the processes"""
+    from django.conf import settings
+    return settings.TRAINING_WORKER_THREADS or max(1, (os.cpu_count() or 1) // processes)